@@ -2,15 +2,20 @@
 import re
 from contextlib import contextmanager
 import errno
+import fcntl
 import itertools
+import mmap
 import os
 import stat
+import struct
 import sys
 import tempfile
+import time
 
 from curtin import util
 from curtin.block import lvm
 from curtin.block import multipath
+from curtin.block import signatures
 from curtin.log import LOG
 from curtin.udev import udevadm_settle, udevadm_info
 from curtin import storage_config
@@ -18,6 +23,9 @@ from curtin import storage_config
 
 SECTOR_SIZE_BYTES = 512
 
+# ioctl from linux/fs.h taking a (start, length) pair of u64 byte offsets
+BLKZEROOUT = 0x127f
+
 
 def get_dev_name_entry(devname):
     """
@@ -1168,12 +1176,91 @@ def exclusive_open(path, exclusive=True):
         raise
 
 
+def get_queue_attr(devpath, name):
+    """Return the sysfs queue attribute name of the disk holding devpath.
+
+    Partitions have no queue directory of their own, the attributes of
+    their parent disk are returned for them."""
+    sysfs = os.path.realpath(sys_block_path(devpath))
+    if os.path.exists(os.path.join(sysfs, 'partition')):
+        sysfs = os.path.dirname(sysfs)
+    return util.load_file(os.path.join(sysfs, 'queue', name)).strip()
+
+
+def fast_zero(fd, devpath, offset, length):
+    """Make length bytes at offset of open block device fd read as zeroes
+    without writing them, if the device can do so.
+
+    BLKZEROOUT is used when the device offloads zeroing, otherwise the
+    kernel would write zero pages itself.  Devices whose discard reliably
+    zeroes data report write zeroes support too, and the kernel unmaps
+    the range for BLKZEROOUT on them.  Returns True if the range was
+    zeroed, False if the caller has to write zeroes itself."""
+    try:
+        supported = int(get_queue_attr(devpath,
+                                       'write_zeroes_max_bytes')) > 0
+    except (IOError, OSError, ValueError):
+        return False
+    if not supported:
+        return False
+    try:
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+    except (IOError, OSError) as e:
+        LOG.debug("%s: BLKZEROOUT failed: %s", devpath, e)
+        return False
+    LOG.debug("%s: zeroed %d bytes at %d with BLKZEROOUT", devpath, length,
+              offset)
+    return True
+
+
+def _direct_write(fd, path, readfunc, buflen, size):
+    """Write size bytes from readfunc to block device fd with O_DIRECT.
+
+    The data is copied into a page aligned buffer, as O_DIRECT needs, and
+    written with pwrite so it bypasses the page cache.  If readfunc is None
+    the buffer is left zeroed.  Returns False, having written nothing, if
+    the device can not be opened for direct I/O."""
+    if buflen % mmap.PAGESIZE:
+        return False
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+    except (IOError, OSError) as e:
+        LOG.debug("%s: O_DIRECT not supported: %s", path, e)
+        return False
+
+    buf = mmap.mmap(-1, buflen)
+    try:
+        with memoryview(buf) as view:
+            pos = 0
+            while pos < size:
+                wlen = min(buflen, size - pos)
+                if readfunc:
+                    data = readfunc(buflen)
+                    if len(data) < wlen:
+                        raise ValueError(
+                            "short read on reader got %d expected %d after "
+                            "%d" % (len(data), buflen, pos))
+                    buf[0:wlen] = data[0:wlen]
+                with view[0:wlen] as chunk:
+                    os.pwrite(fd, chunk, pos)
+                pos += wlen
+    finally:
+        buf.close()
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    return True
+
+
 def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
     """
     wipe the existing file at path.
     if reader is provided, it will be called as a 'reader(buflen)'
     to provide data for each write.  Otherwise, zeros are used.
     writes will be done in size of buflen.
+
+    Block devices wiped with zeros are zeroed by the device itself where it
+    can (see fast_zero).  Otherwise block devices are written with O_DIRECT
+    from a page aligned buffer, and regular files through the file object.
     """
     if reader:
         readfunc = reader
@@ -1187,8 +1274,16 @@ def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
     LOG.debug("%s is %s bytes. wiping with buflen=%s",
               path, size, buflen)
 
+    start = time.time()
     with exclusive_open(path, exclusive=exclusive) as fp:
-        while True:
+        method = None
+        if is_block_device(path):
+            if not reader and fast_zero(fp.fileno(), path, 0, size):
+                method = 'device zeroing'
+            elif _direct_write(fp.fileno(), path, reader, buflen, size):
+                method = 'O_DIRECT writes'
+
+        while method is None:
             pbuf = readfunc(buflen)
             pos = fp.tell()
             if len(pbuf) != buflen and len(pbuf) + pos < size:
@@ -1198,16 +1293,22 @@ def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
 
             if pos + buflen >= size:
                 fp.write(pbuf[0:size-pos])
-                break
+                method = 'buffered writes'
             else:
                 fp.write(pbuf)
 
+    elapsed = time.time() - start
+    LOG.info("%s: wiped %d bytes with %s in %.3f seconds (%.1f MiB/s)",
+             path, size, method, elapsed,
+             size / (1024 * 1024) / max(elapsed, 0.001))
+
 
 def quick_zero(path, partitions=True, exclusive=True, strict=False):
     """
     zero 1M at front, 1M at end, and 1M at front
     if this is a block device and partitions is true, then
     zero 1M at front and end of each partition.
+    signatures found elsewhere on each are zeroed too, see wipe_signatures.
     """
     buflen = 1024
     count = 1024
@@ -1230,8 +1331,27 @@ def quick_zero(path, partitions=True, exclusive=True, strict=False):
         quick_zero(pt, partitions=False, strict=strict)
 
     LOG.debug("wiping 1M on %s at offsets %s", path, offsets)
-    return zero_file_at_offsets(path, offsets, buflen=buflen, count=count,
-                                exclusive=exclusive, strict=strict)
+    zero_file_at_offsets(path, offsets, buflen=buflen, count=count,
+                         exclusive=exclusive, strict=strict)
+    wipe_signatures(path, exclusive=exclusive)
+
+
+def wipe_signatures(path, exclusive=True):
+    """
+    zero the signatures of storage formats found anywhere on path, such
+    as md superblocks, zfs labels and btrfs mirrors past the first and last
+    1M (see curtin.block.signatures).  returns the signatures zeroed.
+    """
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fd = fp.fileno()
+        size = os.lseek(fd, 0, os.SEEK_END)
+        found = signatures.find_signatures(fd, size)
+        if found:
+            LOG.info('%s: zeroing signatures: %s', path,
+                     ', '.join('%s@%d' % (sig.name, sig.offset)
+                               for sig in found))
+            signatures.zero_signatures(fd, found)
+    return found
 
 
 def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
@@ -1246,9 +1366,9 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
         m_short += " Shortened to {wsize} bytes."
         m_badoff += " Skipping."
 
-    buf = b'\0' * buflen
     tot = buflen * count
-    msg_vals = {'path': path, 'tot': buflen * count}
+    buf = memoryview(b'\0' * tot)
+    msg_vals = {'path': path, 'tot': tot}
 
     # allow caller to control if we require exclusive open
     with exclusive_open(path, exclusive=exclusive) as fp:
@@ -1278,12 +1398,27 @@ def zero_file_at_offsets(path, offsets, buflen=1024, count=1024, strict=False,
                 else:
                     LOG.debug(m_short.format(**msg_vals))
             fp.seek(pos)
-            for i in range(count):
-                pos = fp.tell()
-                if pos + buflen > size:
-                    fp.write(buf[0:size-pos])
-                else:
-                    fp.write(buf)
+            fp.write(buf[0:min(tot, size - pos)])
+
+
+def is_zeroed(path, samples=3, length=1024 * 1024):
+    """
+    Return True if samples ranges of length bytes spread over path, from its
+    start to its end, read as zeroes.  This checks that a wipe with zeroes
+    took effect without reading the whole volume back.
+    """
+    with open(path, 'rb') as fp:
+        fp.seek(0, 2)
+        size = fp.tell()
+        length = min(length, size)
+        for i in range(samples):
+            pos = (size - length) * i // max(1, samples - 1)
+            fp.seek(pos)
+            if fp.read(length).strip(b'\0'):
+                LOG.debug('%s: non-zero data within %d bytes at %d', path,
+                          length, pos)
+                return False
+    return True
 
 
 def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
@@ -1308,9 +1443,9 @@ def wipe_volume(path, mode="superblock", exclusive=True, strict=False):
         # If pvremove is run and there is no label on the system,
         # then it exits with 5. That is also okay, because we might be
         # wiping something that is already blank
-        util.subp(['pvremove', '--force', '--force', '--yes', path],
-                  rcs=[0, 5], capture=True)
-        lvm.lvm_scan()
+        lvm.run_lvm(['pvremove', '--force', '--force', '--yes', path],
+                    rcs=[0, 5])
+        lvm.lvm_refresh()
     elif mode == "zero":
         wipe_file(path, exclusive=exclusive)
     elif mode == "random":
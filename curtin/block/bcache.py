@@ -1,17 +1,35 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import errno
+import glob
 import os
 import time
 
 from curtin import util
 from curtin.log import LOG
-from curtin.udev import udevadm_settle
+from curtin import udev
 from . import dev_path, sys_block_path
 
 # Wait up to 20 minutes (150 + 300 + 750 = 1200 seconds)
 BCACHE_RETRIES = [sleep for nap in [1, 2, 5] for sleep in [nap] * 150]
-BCACHE_REGISTRATION_RETRY = [0.2] * 60
+# seconds to wait for the udev rules of bcache-tools to register a new
+# bcache device, and then for a registration of our own to show in sysfs
+BCACHE_UDEV_REGISTRATION_TIMEOUT = 5
+BCACHE_REGISTRATION_TIMEOUT = 12
+# seconds between checks of a registered bcache device until it validates
+BCACHE_VALIDATE_INTERVAL = 0.2
+# config keys of the tunables of a bcache device and their sysfs attribute
+# below /sys/block/bcacheN/bcache; the congested thresholds are those of
+# the cache set the device is attached to
+BCACHE_TUNABLES = {
+    'sequential_cutoff': 'sequential_cutoff',
+    'writeback_percent': 'writeback_percent',
+    'congested_read_threshold_us': 'cache/congested_read_threshold_us',
+    'congested_write_threshold_us': 'cache/congested_write_threshold_us',
+}
+
+# backing device kname to the kname of its bcache device
+_BCACHE_KNAMES = {}
 
 
 def superblock_asdict(device=None, data=None):
@@ -379,64 +397,121 @@ def validate_bcache_ready(bcache_device, bcache_sys_path):
         return ValueError(msg)
 
 
-def ensure_bcache_is_registered(bcache_device, expected, retry=None):
+def _bcache_ready_path(expected):
+    """ Return the sysfs path that shows bcache registered the device
+        at expected: the cache0 link of a cache set, the dev link of a
+        backing device. """
+    if expected.startswith('/sys/fs/bcache'):
+        return os.path.join(expected, 'cache0')
+    return os.path.join(expected, 'dev')
+
+
+def _wait_for_bcache(bcache_device, expected, timeout):
+    """ Wait up to timeout seconds for bcache_device to be registered at
+        expected and to validate, return True if it does.
+
+        The sysfs link shows up before the rest of the registration, like
+        the slaves of the bcache device, so validation is retried until the
+        timeout expires. """
+    deadline = time.time() + timeout
+    if not udev.wait_for(_bcache_ready_path(expected), timeout=timeout):
+        LOG.debug('bcache device %s not registered at %s after %ss',
+                  bcache_device, expected, timeout)
+        return False
+    while True:
+        try:
+            validate_bcache_ready(bcache_device, expected)
+            return True
+        except (OSError, IndexError, ValueError) as e:
+            if time.time() >= deadline:
+                LOG.debug('bcache device %s at %s is not ready: %s',
+                          bcache_device, expected, e)
+                return False
+        time.sleep(BCACHE_VALIDATE_INTERVAL)
+
+
+def ensure_bcache_is_registered(bcache_device, expected, timeout=None):
     """ Test that bcache_device is found at an expected path and
-        re-register the device if it's not ready.
+        register the device if it's not.
 
-        Retry the validation and registration as needed.
+        Some versions of bcache-tools register the bcache device from udev
+        rules as soon as make-bcache wrote it, so first wait for that, then
+        register it ourselves.  Both waits return as soon as the sysfs
+        attribute of the registered device appears.
     """
-    if not retry:
-        retry = BCACHE_REGISTRATION_RETRY
-
-    for attempt, wait in enumerate(retry):
-        # find the actual bcache device name via sysfs using the
-        # backing device's holders directory.
-        LOG.debug('check just created bcache %s if it is registered,'
-                  ' try=%s', bcache_device, attempt + 1)
-        try:
-            udevadm_settle()
-            if os.path.exists(expected):
-                LOG.debug('Found bcache dev %s at expected path %s',
-                          bcache_device, expected)
-                validate_bcache_ready(bcache_device, expected)
-            else:
-                msg = 'bcache device path not found: %s' % expected
-                LOG.debug(msg)
-                raise ValueError(msg)
-
-            # if bcache path exists and holders are > 0 we can return
-            LOG.debug('bcache dev %s at path %s successfully registered'
-                      ' on attempt %s/%s',  bcache_device, expected,
-                      attempt + 1, len(retry))
-            return
-
-        except (OSError, IndexError, ValueError):
-            # Some versions of bcache-tools will register the bcache device
-            # as soon as we run make-bcache using udev rules, so wait for
-            # udev to settle, then try to locate the dev, on older versions
-            # we need to register it manually though
-            LOG.debug('bcache device was not registered, registering %s '
-                      'at /sys/fs/bcache/register', bcache_device)
-            try:
-                register_bcache(bcache_device)
-            except IOError:
-                # device creation is notoriously racy and this can trigger
-                # "Invalid argument" IOErrors if it got created in "the
-                # meantime" - just restart the function a few times to
-                # check it all again
-                pass
-
-        LOG.debug("bcache dev %s not ready, waiting %ss",
-                  bcache_device, wait)
-        time.sleep(wait)
-
-    # we've exhausted our retries
+    if timeout is None:
+        timeout = BCACHE_REGISTRATION_TIMEOUT
+
+    LOG.debug('check just created bcache %s if it is registered at %s',
+              bcache_device, expected)
+    if _wait_for_bcache(bcache_device, expected,
+                        BCACHE_UDEV_REGISTRATION_TIMEOUT):
+        LOG.debug('bcache dev %s at path %s registered by udev',
+                  bcache_device, expected)
+        return
+
+    LOG.debug('bcache device was not registered, registering %s '
+              'at /sys/fs/bcache/register', bcache_device)
+    try:
+        register_bcache(bcache_device)
+    except IOError as e:
+        # device creation is notoriously racy and this can trigger
+        # "Invalid argument" IOErrors if it got registered in "the
+        # meantime", the wait below tells if it was
+        LOG.debug('Error registering bcache device %s: %s',
+                  bcache_device, e)
+
+    if _wait_for_bcache(bcache_device, expected, timeout):
+        LOG.debug('bcache dev %s at path %s successfully registered',
+                  bcache_device, expected)
+        return
+
     LOG.warning('Repetitive error registering the bcache dev %s',
                 bcache_device)
     raise RuntimeError("bcache device %s can't be registered" %
                        bcache_device)
 
 
+def _walk_bcache_knames():
+    """ Return a dict of the kname of every registered backing device to
+        the kname of its bcache device, from its bcache/dev link. """
+    knames = {}
+    for dev_link in glob.glob('/sys/class/block/*/bcache/dev'):
+        backing_kname = dev_link.split(os.path.sep)[4]
+        try:
+            knames[backing_kname] = os.path.basename(os.readlink(dev_link))
+        except OSError as e:
+            LOG.debug('Transient race, bcache dev link not found: %s', e)
+    return knames
+
+
+def get_bcache_kname(backing_kname):
+    """ Return the kname of the bcacheN device of backing device
+        backing_kname, or None if it has none.
+
+        The bcache devices of all backing devices are looked up with a
+        single walk of sysfs, which is repeated only if backing_kname is
+        not in it or its bcache device is gone.
+    """
+    global _BCACHE_KNAMES
+    kname = _BCACHE_KNAMES.get(backing_kname)
+    if kname and os.path.exists(
+            '/sys/class/block/%s/slaves/%s' % (kname, backing_kname)):
+        return kname
+    _BCACHE_KNAMES = _walk_bcache_knames()
+    return _BCACHE_KNAMES.get(backing_kname)
+
+
+def set_tunables(bcache_kname, tunables):
+    """ Write tunables, a dict of BCACHE_TUNABLES keys to values, to the
+        sysfs attributes of bcache device bcache_kname. """
+    for key, value in sorted(tunables.items()):
+        attr = os.path.join('/sys/block', bcache_kname, 'bcache',
+                            BCACHE_TUNABLES[key])
+        LOG.info("Setting %s on %s to %s", key, bcache_kname, value)
+        util.write_file(attr, str(value), mode=None)
+
+
 def create_cache_device(cache_device):
     # /sys/class/block/XXX/YYY/
     cache_device_sysfs = sys_block_path(cache_device)
@@ -9,8 +9,11 @@ having to reboot the system
 import glob
 import os
 import time
+from collections import OrderedDict
+from concurrent import futures
 
 from curtin import (block, udev, util)
+from curtin.reporter import events
 from curtin.swap import is_swap_device
 from curtin.block import bcache
 from curtin.block import lvm
@@ -22,6 +25,9 @@ from curtin.log import LOG
 # poll frequenty, but wait up to 60 seconds total
 MDADM_RELEASE_RETRIES = [0.4] * 150
 
+# default number of physical devices wiped at once
+CLEAR_HOLDERS_JOBS = 4
+
 
 def _define_handlers_registry():
     """
@@ -135,21 +141,21 @@ def shutdown_lvm(device):
 
     # remove the logical volume
     LOG.debug('using "lvremove" on %s', vg_lv_name)
-    util.subp(['lvremove', '--force', '--force', vg_lv_name])
+    lvm.run_lvm(['lvremove', '--force', '--force', vg_lv_name])
+    lvm.lvm_refresh()
 
     # if that was the last lvol in the volgroup, get rid of volgroup
     if len(lvm.get_lvols_in_volgroup(vg_name)) == 0:
         pvols = lvm.get_pvols_in_volgroup(vg_name)
-        util.subp(['vgremove', '--force', '--force', vg_name], rcs=[0, 5])
+        lvm.run_lvm(['vgremove', '--force', '--force', vg_name],
+                    rcs=[0, 5])
+        lvm.lvm_refresh()
 
         # wipe the underlying physical volumes
         for pv in pvols:
             LOG.info('Wiping lvm physical volume: %s', pv)
             block.quick_zero(pv, partitions=False)
 
-    # refresh lvmetad
-    lvm.lvm_scan()
-
 
 def shutdown_crypt(device):
     """
@@ -601,27 +607,46 @@ def assert_clear(base_paths):
                           .format(format_holders_tree(holders_tree)))
 
 
-def clear_holders(base_paths, try_preserve=False):
+def wipe_device_key(dev_info):
     """
-    Clear all storage layers depending on the devices specified in 'base_paths'
-    A single device or list of devices can be specified.
-    Device paths can be specified either as paths in /dev or /sys/block
-    Will throw OSError if any holders could not be shut down
+    Return the sysfs path of the physical device under a shutdown plan entry.
+    Partitions are wiped on the device they are a partition of; the
+    partitions of device mapper devices all share one key.
     """
-    # handle single path
-    if not isinstance(base_paths, (list, tuple)):
-        base_paths = [base_paths]
-    LOG.info('Generating device storage trees for path(s): %s', base_paths)
+    syspath = os.path.realpath(dev_info['device'])
+    if dev_info['dev_type'] == 'partition':
+        return os.path.dirname(syspath)
+    return syspath
 
-    # get current holders and plan how to shut them down
-    holder_trees = [gen_holders_tree(path) for path in base_paths]
-    LOG.info('Current device storage tree:\n%s',
-             '\n'.join(format_holders_tree(tree) for tree in holder_trees))
-    ordered_devs = plan_shutdown_holder_trees(holder_trees)
-    LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
-    # run shutdown functions
+def group_shutdown_plan(ordered_devs):
+    """
+    Split a shutdown plan into steps that run one after the other.
+
+    Consecutive entries of the same level that are wiped by a data destroying
+    handler share a step; any other entry is a step of its own.  Each step is
+    an OrderedDict of physical device key to the list of its entries in plan
+    order, the lists of a step are independent of each other.
+    """
+    steps = []
+    wipe_level = None
     for dev_info in ordered_devs:
+        shutdown_function = DEV_TYPES[dev_info['dev_type']].get('shutdown')
+        wipes = shutdown_function in DATA_DESTROYING_HANDLERS
+        if not wipes or wipe_level != dev_info['level'] or not steps:
+            steps.append(OrderedDict())
+        wipe_level = dev_info['level'] if wipes else None
+        steps[-1].setdefault(
+            wipe_device_key(dev_info), []).append(dev_info)
+    return steps
+
+
+def shutdown_devices(dev_infos, try_preserve=False, report_prefix=None):
+    """
+    Run the shutdown function of each of the entries in dev_infos in order,
+    reporting an event for each under report_prefix if that is set.
+    """
+    for dev_info in dev_infos:
         dev_type = DEV_TYPES.get(dev_info['dev_type'])
         shutdown_function = dev_type.get('shutdown')
         if not shutdown_function:
@@ -636,7 +661,74 @@ def clear_holders(base_paths, try_preserve=False):
         if os.path.exists(dev_info['device']):
             LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
                      dev_info['dev_type'], dev_info['device'])
-            shutdown_function(dev_info['device'])
+            with events.ReportEventStack(
+                    name=report_prefix or 'clear-holders',
+                    reporting_enabled=report_prefix is not None,
+                    level='INFO',
+                    description="clearing %s: %s" % (
+                        dev_info['dev_type'],
+                        os.path.basename(dev_info['device']))):
+                shutdown_function(dev_info['device'])
+
+
+def run_shutdown_step(step, try_preserve=False, jobs=None,
+                      report_prefix=None):
+    """
+    Shut down the devices of a step of group_shutdown_plan, up to jobs
+    physical devices at once.  After a failure no more devices are started
+    and the first error is raised once the running ones finish.
+    """
+    if jobs is None:
+        jobs = CLEAR_HOLDERS_JOBS
+    jobs = max(1, int(jobs))
+    if jobs == 1 or len(step) == 1:
+        for dev_infos in step.values():
+            shutdown_devices(dev_infos, try_preserve, report_prefix)
+        return
+
+    LOG.debug('clearing %d devices with up to %d jobs', len(step), jobs)
+    error = None
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = [pool.submit(shutdown_devices, dev_infos, try_preserve,
+                               report_prefix)
+                   for dev_infos in step.values()]
+        for future in futures.as_completed(running):
+            if future.cancelled() or future.exception() is None:
+                continue
+            if error is None:
+                error = future.exception()
+                for other in running:
+                    other.cancel()
+    if error is not None:
+        raise error
+
+
+def clear_holders(base_paths, try_preserve=False, jobs=None,
+                  report_prefix=None):
+    """
+    Clear all storage layers depending on the devices specified in 'base_paths'
+    A single device or list of devices can be specified.
+    Device paths can be specified either as paths in /dev or /sys/block
+    Devices at the same place in the shutdown plan that are wiped, such as the
+    disks and partitions of different physical devices, are wiped up to
+    'jobs' physical devices at once.
+    Will throw OSError if any holders could not be shut down
+    """
+    # handle single path
+    if not isinstance(base_paths, (list, tuple)):
+        base_paths = [base_paths]
+    LOG.info('Generating device storage trees for path(s): %s', base_paths)
+
+    # get current holders and plan how to shut them down
+    holder_trees = [gen_holders_tree(path) for path in base_paths]
+    LOG.info('Current device storage tree:\n%s',
+             '\n'.join(format_holders_tree(tree) for tree in holder_trees))
+    ordered_devs = plan_shutdown_holder_trees(holder_trees)
+    LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
+
+    # run shutdown functions
+    for step in group_shutdown_plan(ordered_devs):
+        run_shutdown_step(step, try_preserve, jobs, report_prefix)
 
 
 def start_clear_holders_deps():
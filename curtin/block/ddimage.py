@@ -0,0 +1,323 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Write dd-* disk images to a block device.
+
+The image is decompressed as it streams in (see curtin.decompress) and
+written with pwrite.  When the target could be zeroed up front
+(BLKZEROOUT on devices that offload zeroing, or truncating a regular
+file), blocks of the image that are all zeroes are skipped rather
+than written.  A bmaptool style block map
+limits writing to the mapped ranges of the image and verifies their
+checksums.
+
+The first buffer of the image, which carries the partition table, is only
+written once the whole image was read and its checksum verified, so an
+image that fails verification does not leave a bootable half-written disk.
+"""
+
+from collections import namedtuple
+import hashlib
+import os
+import stat
+import tarfile
+import time
+from xml.etree import ElementTree
+
+from curtin.block import exclusive_open, fast_zero
+from curtin.checksum import ChecksumReader
+from curtin import decompress
+from curtin.log import LOG
+
+# size of reads from the decompressed image
+WRITE_BUFLEN = 4 * 1024 * 1024
+# granularity at which zero blocks are detected and skipped
+ZERO_BLOCK_SIZE = 64 * 1024
+# seconds between progress messages
+PROGRESS_INTERVAL = 10
+
+# compression of the data of each image type, 'auto' to detect it
+_COMPRESSION = {
+    'dd-tgz': 'gz',
+    'dd-txz': 'xz',
+    'dd-tbz': 'bz2',
+    'dd-tar': 'auto',
+    'dd-gz': 'gz',
+    'dd-bz2': 'bz2',
+    'dd-xz': 'xz',
+    'dd-zst': 'zst',
+    'dd-raw': None,
+}
+_TAR_TYPES = ('dd-tgz', 'dd-txz', 'dd-tbz', 'dd-tar')
+
+BlockMap = namedtuple('BlockMap', ('image_size', 'checksum_type', 'ranges'))
+MappedRange = namedtuple('MappedRange', ('start', 'end', 'checksum'))
+
+
+class WriteStats(object):
+    """Counters for a write_image run."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.written = 0
+        self.start = time.time()
+        self.elapsed = 0
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    @property
+    def skipped(self):
+        """Image bytes not written to the target."""
+        return self.bytes - self.written
+
+    @property
+    def rate(self):
+        """Image bytes per second processed."""
+        elapsed = self.elapsed or time.time() - self.start
+        if not elapsed:
+            return 0
+        return self.bytes / elapsed
+
+    def __str__(self):
+        return ("%d bytes (%d written, %d skipped) in %.3f seconds "
+                "(%.1f MiB/s)" %
+                (self.bytes, self.written, self.skipped,
+                 self.elapsed or time.time() - self.start,
+                 self.rate / (1024 * 1024)))
+
+
+class _TarImage(object):
+    """Read the regular files of a tar stream back to back, like
+    'tar -xO' does."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.tar = tarfile.open(fileobj=fp, mode='r|')
+        self.members = iter(self.tar)
+        self.member = None
+        self.done = False
+
+    def close(self):
+        self.tar.close()
+        self.fp.close()
+
+    def _drain(self):
+        # read the padding after the end of the archive too, so that a
+        # checksum of the source covers all of it
+        while self.fp.read(WRITE_BUFLEN):
+            pass
+
+    def read(self, size=-1):
+        while not self.done:
+            if self.member is None:
+                info = next(self.members, None)
+                if info is None:
+                    self.done = True
+                    self._drain()
+                    break
+                if not info.isfile():
+                    continue
+                self.member = self.tar.extractfile(info)
+            # a stream can not seek back, each member is read to its end
+            # before moving on to the next one
+            data = self.member.read(size)
+            if data:
+                return data
+            self.member = None
+        return b''
+
+
+def open_image(fp, image_type):
+    """Return a file-like object reading the uncompressed image of type
+    image_type from fp."""
+    if image_type not in _COMPRESSION:
+        raise ValueError("unsupported image type: %s" % image_type)
+    image = decompress.open_decompressed(fp, _COMPRESSION[image_type])
+    if image_type in _TAR_TYPES:
+        return _TarImage(image)
+    return image
+
+
+def _read_full(fp, size):
+    """Read size bytes from fp, less only at the end of the stream."""
+    chunks = []
+    remaining = size
+    while remaining:
+        data = fp.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+def parse_bmap(content):
+    """Parse the content of a bmaptool block map file into a BlockMap.
+
+    Ranges are returned as byte offsets into the uncompressed image."""
+    root = ElementTree.fromstring(content)
+    block_size = int(root.findtext('BlockSize'))
+    image_size = int(root.findtext('ImageSize'))
+    # version 1 block maps only have sha1 attributes on ranges
+    checksum_type = (root.findtext('ChecksumType') or 'sha1').strip()
+    ranges = []
+    for rng in root.find('BlockMap').iter('Range'):
+        first, _, last = rng.text.strip().partition('-')
+        start = int(first) * block_size
+        end = min((int(last or first) + 1) * block_size, image_size)
+        checksum = rng.get('chksum') or rng.get('sha1')
+        ranges.append(MappedRange(start, end, checksum))
+    return BlockMap(image_size, checksum_type, sorted(ranges))
+
+
+def _zero_target(fd, path):
+    """Zero the target up front if that is cheap, returning True if it
+    now reads back as zeroes."""
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode):
+        os.ftruncate(fd, 0)
+        return True
+    if not stat.S_ISBLK(st.st_mode):
+        return False
+    size = os.lseek(fd, 0, os.SEEK_END)
+    return fast_zero(fd, path, 0, size)
+
+
+class _ImageWriter(object):
+
+    def __init__(self, fd, bmap, skip_zeroes, stats):
+        self.fd = fd
+        self.skip_zeroes = skip_zeroes
+        self.stats = stats
+        self.zeroes = bytes(ZERO_BLOCK_SIZE)
+        self.ranges = list(bmap.ranges) if bmap else None
+        self.checksum_type = bmap.checksum_type if bmap else None
+        self.range_digest = None
+
+    def _pieces(self, offset, data):
+        """Yield (offset, data) of the parts of data to be written,
+        verifying block map checksums along the way."""
+        if self.ranges is None:
+            yield offset, data
+            return
+        end = offset + len(data)
+        while self.ranges and self.ranges[0].start < end:
+            rng = self.ranges[0]
+            lo = max(rng.start, offset)
+            hi = min(rng.end, end)
+            piece = data[lo - offset:hi - offset]
+            if rng.checksum:
+                if self.range_digest is None:
+                    self.range_digest = hashlib.new(self.checksum_type)
+                self.range_digest.update(piece)
+            yield lo, piece
+            if rng.end > end:
+                return
+            if rng.checksum:
+                found = self.range_digest.hexdigest()
+                self.range_digest = None
+                if found != rng.checksum.lower():
+                    raise ValueError(
+                        "%s checksum of image bytes %d-%d is %s, block map "
+                        "has %s" % (self.checksum_type, rng.start,
+                                    rng.end - 1, found, rng.checksum))
+            self.ranges.pop(0)
+
+    def _blocks(self, offset, data):
+        """Yield (offset, data) runs of non-zero blocks of data."""
+        if not self.skip_zeroes:
+            yield offset, data
+            return
+        view = memoryview(data)
+        run = None
+        for pos in range(0, len(data), ZERO_BLOCK_SIZE):
+            block = view[pos:pos + ZERO_BLOCK_SIZE]
+            if len(block) == ZERO_BLOCK_SIZE:
+                is_zero = block == self.zeroes
+            else:
+                is_zero = block == bytes(len(block))
+            if is_zero:
+                if run is not None:
+                    yield offset + run, view[run:pos]
+                    run = None
+            elif run is None:
+                run = pos
+        if run is not None:
+            yield offset + run, view[run:]
+
+    def plan(self, offset, data):
+        """Return the list of (offset, data) writes for data at offset."""
+        writes = []
+        for poffset, piece in self._pieces(offset, data):
+            writes.extend(self._blocks(poffset, piece))
+        return writes
+
+    def write(self, writes):
+        for offset, data in writes:
+            while data:
+                done = os.pwrite(self.fd, data, offset)
+                self.stats.written += done
+                offset += done
+                data = data[done:]
+
+    def check_complete(self):
+        if self.ranges:
+            raise ValueError("image ended before mapped range %d-%d" %
+                             (self.ranges[0].start, self.ranges[0].end - 1))
+
+
+def write_image(fp, path, image_type='dd-raw', bmap=None, checksum=None,
+                buflen=None):
+    """Write the image of type image_type read from fp to path.
+
+    bmap is an optional BlockMap of the image, checksum an optional
+    curtin.checksum.Checksum of the data read from fp.  Returns a
+    WriteStats of the write."""
+    if buflen is None:
+        buflen = WRITE_BUFLEN
+    if checksum:
+        checksum.reset()
+        fp = ChecksumReader(fp, checksum)
+    image = open_image(fp, image_type)
+    try:
+        stats = WriteStats()
+        with exclusive_open(path) as target:
+            fd = target.fileno()
+            is_block = stat.S_ISBLK(os.fstat(fd).st_mode)
+            skip_zeroes = _zero_target(fd, path)
+            LOG.debug("writing %s image to %s, %s zero blocks", image_type,
+                      path, 'skipping' if skip_zeroes else 'writing')
+            writer = _ImageWriter(fd, bmap, skip_zeroes, stats)
+            head = None
+            last_report = time.time()
+            while True:
+                data = _read_full(image, buflen)
+                if not data:
+                    break
+                writes = writer.plan(stats.bytes, data)
+                if head is None:
+                    head = writes
+                else:
+                    writer.write(writes)
+                stats.bytes += len(data)
+                if time.time() - last_report >= PROGRESS_INTERVAL:
+                    LOG.info("writing image to %s: %s", path, stats)
+                    last_report = time.time()
+            writer.check_complete()
+            if is_block and stats.bytes > os.lseek(fd, 0, os.SEEK_END):
+                raise ValueError("image of %d bytes does not fit on %s" %
+                                 (stats.bytes, path))
+            if checksum:
+                checksum.verify()
+            writer.write(head or [])
+            if not is_block:
+                os.ftruncate(fd, stats.bytes)
+            os.fsync(fd)
+    finally:
+        if image is not fp:
+            image.close()
+    stats.finish()
+    LOG.info("wrote image to %s: %s", path, stats)
+    return stats
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,119 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""
+Pick ciphers and performance options for dm-crypt volumes set up with
+cryptsetup.
+"""
+
+import re
+import threading
+
+from curtin import config
+from curtin import util
+from curtin.log import LOG
+
+# ciphers the 'auto' cipher picks the fastest of, in order of preference
+# when they are as fast
+DMCRYPT_AUTO_CIPHERS = ['aes-xts-plain64', 'serpent-xts-plain64',
+                        'twofish-xts-plain64']
+# key size in bits of the 'auto' cipher, 256 bit keys for both xts halves
+DMCRYPT_AUTO_KEY_SIZE = 512
+# dm_crypt config keys turning off a kernel workqueue, with the flag of
+# cryptsetup open and the crypttab option for each
+DMCRYPT_PERF_OPTIONS = {
+    'perf_no_read_workqueue': ('--perf-no_read_workqueue',
+                               'no-read-workqueue'),
+    'perf_no_write_workqueue': ('--perf-no_write_workqueue',
+                                'no-write-workqueue'),
+}
+
+# '    aes-xts        512b      2741.4 MiB/s      2749.7 MiB/s'
+_BENCHMARK_RE = re.compile(
+    r'^\s*(?P<cipher>\S+)\s+(?P<key_size>\d+)b\s+'
+    r'(?P<encryption>[\d.]+)\s+MiB/s\s+(?P<decryption>[\d.]+)\s+MiB/s')
+
+# (cipher, key size) to its MiB/s, measured once per run of curtin
+_BENCHMARKS = {}
+_BENCHMARKS_LOCK = threading.Lock()
+
+
+def parse_benchmark(output):
+    """
+    Parse the output of cryptsetup benchmark.
+
+    :param output: String output of `cryptsetup benchmark`.
+    :returns: A dict of (cipher, key size) to the lower of the encryption
+              and decryption speeds in MiB/s, ciphers named like the
+              benchmark names them, 'aes-xts'.
+    """
+    speeds = {}
+    for line in output.splitlines():
+        match = _BENCHMARK_RE.match(line)
+        if match:
+            speeds[(match.group('cipher'), int(match.group('key_size')))] = (
+                min(float(match.group('encryption')),
+                    float(match.group('decryption'))))
+    return speeds
+
+
+def cipher_speed(cipher, key_size):
+    """
+    Return the speed in MiB/s of cipher with key_size bits, or None if the
+    kernel does not support it.  Each cipher is benchmarked once.
+    """
+    with _BENCHMARKS_LOCK:
+        if (cipher, key_size) not in _BENCHMARKS:
+            try:
+                out, _err = util.subp(
+                    ['cryptsetup', 'benchmark', '--cipher', cipher,
+                     '--key-size', str(key_size)], capture=True)
+                speeds = parse_benchmark(out)
+            except util.ProcessExecutionError as e:
+                LOG.debug('cryptsetup benchmark of %s failed: %s', cipher, e)
+                speeds = {}
+            # the benchmark names the cipher without its iv mode
+            name = cipher.rsplit('-', 1)[0]
+            _BENCHMARKS[(cipher, key_size)] = speeds.get((name, key_size))
+            LOG.debug('cryptsetup benchmark: %s %sb %s MiB/s', cipher,
+                      key_size, _BENCHMARKS[(cipher, key_size)])
+        return _BENCHMARKS[(cipher, key_size)]
+
+
+def auto_cipher(key_size=None):
+    """
+    Return the fastest cipher of DMCRYPT_AUTO_CIPHERS on this system with
+    key_size bits, default DMCRYPT_AUTO_KEY_SIZE.
+
+    :returns: Tuple of cipher and key size, the cipher None if none could
+              be benchmarked, leaving the choice to cryptsetup.
+    """
+    if key_size is None:
+        key_size = DMCRYPT_AUTO_KEY_SIZE
+    best, best_speed = None, 0
+    for cipher in DMCRYPT_AUTO_CIPHERS:
+        speed = cipher_speed(cipher, int(key_size))
+        if speed is not None and speed > best_speed:
+            best, best_speed = cipher, speed
+    if best is None:
+        LOG.warning('Could not benchmark any of the ciphers %s, using the '
+                    'cryptsetup default', DMCRYPT_AUTO_CIPHERS)
+        return (None, None)
+    LOG.info('Selected cipher %s with %s bit key, %s MiB/s', best, key_size,
+             best_speed)
+    return (best, key_size)
+
+
+def perf_options(info):
+    """
+    Return the cryptsetup open flags and the crypttab options for the
+    DMCRYPT_PERF_OPTIONS set in dm_crypt config info.
+    """
+    flags = []
+    options = []
+    for key, (flag, option) in sorted(DMCRYPT_PERF_OPTIONS.items()):
+        if config.value_as_boolean(info.get(key)):
+            flags.append(flag)
+            options.append(option)
+    return (flags, options)
+
+# vi: ts=4 expandtab syntax=python
@@ -7,46 +7,325 @@ This module provides some helper functions for manipulating lvm devices
 from curtin import distro
 from curtin import util
 from curtin.log import LOG
+import contextlib
+import json
 import os
+import select
+import subprocess
+import threading
+import time
 
 # separator to use for lvm/dm tools
 _SEP = '='
 
+# prompt the lvm shell prints when it is ready for the next command
+LVM_SHELL_PROMPT = b'lvm> '
+# seconds to wait for the lvm shell to start
+LVM_SHELL_TIMEOUT = 30
+# config of every command run in the lvm shell, so that the log report of
+# the command, with its return code, is written as json to LVM_REPORT_FD
+LVM_SHELL_CONFIG = ('log{report_command_log=1 command_log_selection="all"} '
+                    'report{output_format="json"}')
+# lvm return code of a command that succeeded, the process exits 0 for it
+_ECMD_PROCESSED = 1
+
+# lvm shell of the lvm_shell() session run_lvm runs commands in
+_LVM_SHELL = None
+_LVM_SHELL_LOCK = threading.Lock()
+
+# snapshot of the lvm state taken by lvm_state(), dropped by lvm_refresh()
+_LVM_STATE = None
+_LVM_STATE_LOCK = threading.Lock()
+
 
 def _filter_lvm_info(lvtool, match_field, query_field, match_key, args=None):
     """
     filter output of pv/vg/lvdisplay tools
     """
+    return [qf for (mf, qf) in _lvm_info(lvtool, [match_field, query_field],
+                                         args=args)
+            if mf == match_key]
+
+
+def _lvm_info(lvtool, fields, args=None):
+    """
+    return a list of the values of fields for every line output by lvtool
+    """
     if args is None:
         args = []
     (out, _) = util.subp([lvtool, '-C', '--separator', _SEP, '--noheadings',
-                          '-o', ','.join([match_field, query_field])] + args,
+                          '-o', ','.join(fields)] + args,
                          capture=True)
-    return [qf for (mf, qf) in
-            [line.strip().split(_SEP) for line in out.strip().splitlines()]
-            if mf == match_key]
+    return [line.strip().split(_SEP) for line in out.strip().splitlines()]
+
+
+def parse_fullreport(output):
+    """
+    parse the json output of 'lvm fullreport' into a dict mapping the name
+    of every volgroup to the 'pvs' list of its physical volumes and the
+    'lvs' dict mapping the names of its logical volumes to their size.
+    Physical volumes not in any volgroup are under the empty name.
+    """
+    state = {}
+    for report in json.loads(output).get('report', []):
+        vgs = report.get('vg', [])
+        vg_name = vgs[0]['vg_name'] if vgs else ''
+        vg = state.setdefault(vg_name, {'pvs': [], 'lvs': {}})
+        vg['pvs'].extend(pv['pv_name'] for pv in report.get('pv', []))
+        vg['lvs'].update((lv['lv_name'], lv['lv_size'])
+                         for lv in report.get('lv', []))
+    return state
+
+
+def _load_lvm_state():
+    """
+    read the lvm state with a single 'lvm fullreport', or with one pvs and
+    one lvs run if the lvm tools are too old to have it
+    """
+    try:
+        (out, _) = util.subp(['lvm', 'fullreport', '--reportformat', 'json',
+                              '--units=B'], capture=True)
+        return parse_fullreport(out)
+    except util.ProcessExecutionError as e:
+        LOG.debug('lvm fullreport failed, using pvs and lvs: %s', e)
+    state = {}
+    for (vg_name, pv_name) in _lvm_info('pvs', ['vg_name', 'pv_name']):
+        state.setdefault(vg_name, {'pvs': [], 'lvs': {}})
+        state[vg_name]['pvs'].append(pv_name)
+    for (vg_name, lv_name, lv_size) in _lvm_info(
+            'lvs', ['vg_name', 'lv_name', 'lv_size'], args=['--units=B']):
+        state.setdefault(vg_name, {'pvs': [], 'lvs': {}})
+        state[vg_name]['lvs'][lv_name] = lv_size
+    return state
+
+
+def lvm_state():
+    """
+    return the snapshot of the lvm state, see parse_fullreport, reading it
+    if there is none since the last lvm_refresh
+    """
+    global _LVM_STATE
+    with _LVM_STATE_LOCK:
+        if _LVM_STATE is None:
+            _LVM_STATE = _load_lvm_state()
+        return _LVM_STATE
+
+
+def lvm_refresh():
+    """
+    refresh lvm state after changing it: update the lvmetad cache, if it is
+    running, and drop the snapshot so the next lookup reads a new one
+    """
+    if lvmetad_running():
+        lvm_scan()
+    _drop_lvm_state()
+
+
+def _drop_lvm_state():
+    global _LVM_STATE
+    with _LVM_STATE_LOCK:
+        _LVM_STATE = None
 
 
 def get_pvols_in_volgroup(vg_name):
     """
     get physical volumes used by volgroup
     """
-    return _filter_lvm_info('pvdisplay', 'vg_name', 'pv_name', vg_name)
+    return list(lvm_state().get(vg_name, {}).get('pvs', []))
 
 
 def get_lvols_in_volgroup(vg_name):
     """
     get logical volumes in volgroup
     """
-    return _filter_lvm_info('lvdisplay', 'vg_name', 'lv_name', vg_name)
+    return list(lvm_state().get(vg_name, {}).get('lvs', {}))
 
 
 def get_lv_size_bytes(lv_name):
     """ get the size in bytes of a logical volume specified by lv_name."""
-    result = _filter_lvm_info('lvdisplay', 'lv_name', 'lv_size', lv_name,
-                              args=['--units=B'])
-    if result:
-        return util.human2bytes(result[0])
+    for vg in lvm_state().values():
+        if lv_name in vg['lvs']:
+            return util.human2bytes(vg['lvs'][lv_name])
+
+
+class LvmShell(object):
+    """
+    a persistent lvm shell process running lvm commands one at a time, so
+    the lvm tools are not started again for every command
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.report_fd = None
+        self.failed = False
+
+    def available(self):
+        """
+        start the lvm shell on first use, return False if it is not
+        available
+        """
+        if self.proc is None and not self.failed:
+            self.failed = not self._start()
+        return self.proc is not None
+
+    def _start(self):
+        report_fd, lvm_fd = os.pipe()
+        # the log of a long session must not hit the lines limit of lvm
+        env = dict(os.environ, LC_ALL='C', LVM_REPORT_FD=str(lvm_fd),
+                   LVM_LOG_FILE_MAX_LINES='0')
+        try:
+            self.proc = subprocess.Popen(
+                ['lvm'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, env=env, pass_fds=(lvm_fd,))
+        except OSError as e:
+            LOG.debug('lvm shell not available: %s', e)
+            os.close(report_fd)
+            return False
+        finally:
+            os.close(lvm_fd)
+        self.report_fd = report_fd
+        try:
+            self._read_until_prompt(timeout=LVM_SHELL_TIMEOUT)
+        except IOError as e:
+            LOG.debug('lvm shell not available: %s', e)
+            self.close()
+            return False
+        LOG.debug('started lvm shell, pid %s', self.proc.pid)
+        return True
+
+    def _read_until_prompt(self, timeout=None):
+        """
+        read the output of the shell until its next prompt, return the
+        (out, err, report) of the command run before it
+        """
+        out_fd = self.proc.stdout.fileno()
+        output = {out_fd: b'', self.proc.stderr.fileno(): b'',
+                  self.report_fd: b''}
+        open_fds = set(output)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not output[out_fd].endswith(LVM_SHELL_PROMPT):
+            if out_fd not in open_fds:
+                raise IOError('lvm shell exited: %s' %
+                              output[out_fd].decode(errors='replace'))
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.monotonic())
+            (ready, _, _) = select.select(list(open_fds), [], [], wait)
+            if not ready:
+                raise IOError('timed out waiting for the lvm shell')
+            for fd in ready:
+                data = os.read(fd, 65536)
+                output[fd] += data
+                if not data:
+                    open_fds.discard(fd)
+        # the report of the command is written before the prompt
+        while (self.report_fd in open_fds and
+               select.select([self.report_fd], [], [], 0)[0]):
+            data = os.read(self.report_fd, 65536)
+            output[self.report_fd] += data
+            if not data:
+                break
+        output[out_fd] = output[out_fd][:-len(LVM_SHELL_PROMPT)]
+        return tuple(output[fd].decode(errors='replace') for fd in
+                     (out_fd, self.proc.stderr.fileno(), self.report_fd))
+
+    def run(self, cmd):
+        """
+        run cmd, a list of an lvm command and its arguments, in the shell
+        and return its (rc, out, err)
+        """
+        args = list(cmd)
+        if '--config' in args:
+            index = args.index('--config') + 1
+            args[index] += ' ' + LVM_SHELL_CONFIG
+        else:
+            args += ['--config', LVM_SHELL_CONFIG]
+        line = ' '.join(_shell_quote(arg) for arg in args)
+        try:
+            self.proc.stdin.write(line.encode() + b'\n')
+            self.proc.stdin.flush()
+            (out, err, report) = self._read_until_prompt()
+        except IOError as e:
+            # the shell is gone, run the next commands as processes
+            self.close()
+            self.failed = True
+            raise util.ProcessExecutionError(cmd=cmd, reason=e)
+        try:
+            ret_code = int(json.loads(report)['log'][-1]['log_ret_code'])
+        except (ValueError, KeyError, IndexError) as e:
+            raise util.ProcessExecutionError(
+                stdout=out, stderr=err, cmd=cmd,
+                reason='no result in lvm shell report: %s' % e)
+        return (0 if ret_code == _ECMD_PROCESSED else ret_code, out, err)
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.write(b'exit\n')
+            self.proc.stdin.close()
+            self.proc.wait(timeout=LVM_SHELL_TIMEOUT)
+        except (IOError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        os.close(self.report_fd)
+        self.proc = None
+        self.report_fd = None
+
+
+def _shell_quote(arg):
+    """
+    quote arg for the lvm shell, which splits command lines at whitespace
+    but keeps words in single or double quotes together
+    """
+    if arg and not any(c.isspace() or c in '"\'#' for c in arg):
+        return arg
+    for quote in ('"', "'"):
+        if quote not in arg:
+            return quote + arg + quote
+    raise ValueError('cannot quote %s for the lvm shell' % arg)
+
+
+@contextlib.contextmanager
+def lvm_shell():
+    """
+    run the commands of run_lvm in a single lvm shell until the end of the
+    with block.  The shell is started by the first command.
+    """
+    global _LVM_SHELL
+    with _LVM_SHELL_LOCK:
+        _LVM_SHELL = LvmShell()
+    try:
+        yield
+    finally:
+        with _LVM_SHELL_LOCK:
+            (shell, _LVM_SHELL) = (_LVM_SHELL, None)
+            shell.close()
+
+
+def run_lvm(cmd, rcs=None):
+    """
+    run the lvm command cmd and return its (out, err) like util.subp.  In
+    an lvm_shell() session the command runs in its shell, otherwise, or if
+    the shell is not available, in a process of its own.
+    """
+    if rcs is None:
+        rcs = [0]
+    with _LVM_SHELL_LOCK:
+        if _LVM_SHELL is not None and _LVM_SHELL.available():
+            LOG.debug('Running lvm shell command: %s', cmd)
+            try:
+                (rc, out, err) = _LVM_SHELL.run(cmd)
+            except ValueError as e:
+                LOG.debug('not running command in lvm shell: %s', e)
+            else:
+                if rc not in rcs:
+                    raise util.ProcessExecutionError(
+                        stdout=out, stderr=err, exit_code=rc, cmd=cmd)
+                return (out, err)
+    return util.subp(cmd, rcs=rcs, capture=True)
 
 
 def split_lvm_name(full):
@@ -87,7 +366,8 @@ def activate_volgroups(multipath=False):
 
     # vgchange handles syncing with udev by default
     # see man 8 vgchange and flag --noudevsync
-    out, _ = util.subp(cmd, capture=True)
+    out, _ = run_lvm(cmd)
+    _drop_lvm_state()
     if out:
         LOG.info(out)
 
@@ -134,6 +414,7 @@ def lvm_scan(activate=True, multipath=False):
             cmd.append('--cache')
         if multipath:
             cmd.extend(['--config', mponly])
-        util.subp(cmd, capture=True)
+        run_lvm(cmd)
+    _drop_lvm_state()
 
 # vi: ts=4 expandtab syntax=python
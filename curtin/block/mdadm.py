@@ -7,6 +7,7 @@
 
 import os
 import re
+import select
 import shlex
 import time
 
@@ -39,6 +40,9 @@ SPARE_RAID_LEVELS = [
 
 VALID_RAID_LEVELS = NOSPARE_RAID_LEVELS + SPARE_RAID_LEVELS
 
+# seconds between progress reports while waiting for an array to sync
+MD_SYNC_PROGRESS_INTERVAL = 10
+
 #  https://www.kernel.org/doc/Documentation/md.txt
 '''
      clear
@@ -147,7 +151,7 @@ def mdadm_assemble(md_devname=None, devices=[], spares=[], scan=False,
 
 
 def mdadm_create(md_devname, raidlevel, devices, spares=None, container=None,
-                 md_name="", metadata=None):
+                 md_name="", metadata=None, assume_clean=False, bitmap=None):
     LOG.debug('mdadm_create: ' +
               'md_name=%s raidlevel=%s ' % (md_devname, raidlevel) +
               ' devices=%s spares=%s name=%s' % (devices, spares, md_name))
@@ -186,6 +190,11 @@ def mdadm_create(md_devname, raidlevel, devices, spares=None, container=None,
     if md_name:
         cmd.append("--name=%s" % md_name)
 
+    if assume_clean:
+        cmd.append("--assume-clean")
+    if bitmap:
+        cmd.append("--bitmap=%s" % bitmap)
+
     if container:
         cmd.append(container)
 
@@ -750,7 +759,8 @@ def md_check_raidlevel(raidlevel):
     return True
 
 
-def md_block_until_in_sync(md_devname):
+def md_block_until_in_sync(md_devname, timeout=None, progress=None,
+                           interval=MD_SYNC_PROGRESS_INTERVAL):
     '''
     sync_completed
     This shows the number of sectors that have been completed of
@@ -761,9 +771,49 @@ def md_block_until_in_sync(md_devname):
     A 'select' on this attribute will return when resync completes,
     when it reaches the current sync_max (below) and possibly at
     other times.
+
+    Wait for sync_completed of md_devname to read 'none', polling for its
+    notifications and rereading it at least every interval seconds.  Each
+    time it shows the sync going on progress(completed, total) is called
+    with the sectors done.  Returns True once the array is in sync and
+    False if timeout seconds passed first.
     '''
-    # FIXME: use selectors to block on: /sys/class/block/mdX/md/sync_completed
-    pass
+    sync_completed = md_sysfs_attr_path(md_devname, 'sync_completed')
+    if not os.path.exists(sync_completed):
+        # arrays without redundancy never sync
+        return True
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    poller = select.poll()
+    with open(sync_completed) as fp:
+        poller.register(fp, select.POLLPRI | select.POLLERR)
+        while True:
+            # sysfs only notifies pollers after the attribute was read
+            fp.seek(0)
+            value = fp.read().strip()
+            if value in ('', 'none'):
+                LOG.debug('%s is in sync', md_devname)
+                return True
+            done, _, total = value.partition('/')
+            if progress and total:
+                progress(int(done), int(total))
+            wait = interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    LOG.debug('%s still syncing: %s', md_devname, value)
+                    return False
+            poller.poll(wait * 1000)
+
+
+def md_set_sync_speed_max(md_devname, speed):
+    '''Limit the sync of md_devname to speed KiB/s, or to the system wide
+    limit if speed is 'system'.'''
+    LOG.debug('setting sync_speed_max of %s to %s', md_devname, speed)
+    util.write_file(md_sysfs_attr_path(md_devname, 'sync_speed_max'),
+                    content=str(speed))
 
 
 def md_check_array_state(md_devname):
@@ -4,6 +4,7 @@
 # for each filesystem type
 
 from curtin import block
+from curtin import config
 from curtin import distro
 from curtin import util
 
@@ -50,6 +51,9 @@ label_length_limits = {
 }
 
 family_flag_mappings = {
+    # flags of the fast profile, that leave work mkfs would do up front to
+    # the kernel once the filesystem is mounted
+    "fast": {"ext": ("-E", "lazy_itable_init=1,lazy_journal_init=1")},
     "fatsize": {"fat": ("-F", "{fatsize}")},
     # flag with no parameter
     "force": {"btrfs": "--force",
@@ -68,6 +72,10 @@ family_flag_mappings = {
               "reiserfs": ("--label", "{label}"),
               "swap": ("--label", "{label}"),
               "xfs": ("-L", "{label}")},
+    # skip discarding the device, used by the fast profile if it was wiped
+    "nodiscard": {"btrfs": "--nodiscard",
+                  "ext": ("-E", "nodiscard"),
+                  "xfs": "-K"},
     # flag with no parameter, N.B: this isn't used/exposed
     "quiet": {"ext": "-q",
               "ntfs": "-q",
@@ -121,7 +129,10 @@ def get_flag_mapping(flag_name, fs_family, param=None, strict=False):
             return ret
 
     if param is None:
-        ret.append(flag_sym)
+        if isinstance(flag_sym, tuple):
+            ret.extend(flag_sym)
+        else:
+            ret.append(flag_sym)
     else:
         params = [k.format(**{flag_name: param}) for k in flag_sym]
         if list(params) == list(flag_sym):
@@ -132,8 +143,26 @@ def get_flag_mapping(flag_name, fs_family, param=None, strict=False):
     return ret
 
 
+def join_extended_options(flags):
+    """Return flags with the values of all its -E flags joined into one,
+       as mke2fs only honours the last -E it is given."""
+    ret = []
+    extended = []
+    args = iter(flags)
+    for flag in args:
+        if flag == '-E':
+            extended.append(next(args))
+        elif flag.startswith('-E'):
+            extended.append(flag[2:])
+        else:
+            ret.append(flag)
+    if extended:
+        ret.extend(['-E', ','.join(extended)])
+    return ret
+
+
 def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
-         extra_options=None):
+         extra_options=None, fast=False, nodiscard=False):
     """Make filesystem on block device with given path using given fstype and
        appropriate flags for filesystem family.
 
@@ -148,7 +177,13 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
        Force can be specified to force the mkfs command to continue even if it
        finds old data or filesystems on the partition.
 
-       If extra_options are supplied they are appended to mkfs command.
+       If extra_options are supplied they are appended to mkfs command,
+       their -E options are merged with those of the fast profile.
+
+       If fast is true, the flags of the fast profile are used: ext inode
+       tables and journal are initialized lazily after mount.  If nodiscard
+       is true as well the device is not discarded by mkfs, for devices
+       a wipe already zeroed.
        """
 
     if path is None:
@@ -198,13 +233,24 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
         uuid = str(uuid4())
     cmd.extend(get_flag_mapping("uuid", fs_family, param=uuid, strict=strict))
 
+    profile = []
+    if fast:
+        profile = get_flag_mapping("fast", fs_family, strict=strict)
+        if nodiscard:
+            profile.extend(get_flag_mapping("nodiscard", fs_family,
+                                            strict=strict))
+
     if fs_family == "fat":
         fat_size = fstype.strip(string.ascii_letters)
         if fat_size in ["12", "16", "32"]:
             cmd.extend(get_flag_mapping("fatsize", fs_family, param=fat_size,
                                         strict=strict))
 
-    if extra_options:
+    if profile:
+        # the profile goes through join_extended_options together with the
+        # extra options, so that a -E of the user does not override its own
+        cmd.extend(join_extended_options(profile + list(extra_options or [])))
+    elif extra_options:
         cmd.extend(extra_options)
 
     cmd.append(path)
@@ -223,15 +269,19 @@ def mkfs(path, fstype, strict=False, label=None, uuid=None, force=False,
     return uuid
 
 
-def mkfs_from_config(path, info, strict=False):
+def mkfs_from_config(path, info, strict=False, nodiscard=False):
     """Make filesystem on block device with given path according to storage
-       config given"""
+       config given.  nodiscard is passed to mkfs with the fast profile.
+       Returns the uuid of the new filesystem, if known."""
     fstype = info.get('fstype')
     if fstype is None:
         raise ValueError("fstype must be specified")
     # NOTE: Since old metadata on partitions that have not been wiped can cause
     #       some mkfs commands to refuse to work, it's best to use force=True
-    mkfs(path, fstype, strict=strict, force=True, uuid=info.get('uuid'),
-         label=info.get('label'), extra_options=info.get('extra_options'))
+    return mkfs(path, fstype, strict=strict, force=True,
+                uuid=info.get('uuid'), label=info.get('label'),
+                extra_options=info.get('extra_options'),
+                fast=config.value_as_boolean(info.get('fast')),
+                nodiscard=nodiscard)
 
 # vi: ts=4 expandtab syntax=python
@@ -8,6 +8,8 @@ SHOW_PATHS_FMT = ("device='%d' serial='%z' multipath='%m' host_wwpn='%N' "
                   "target_wwnn='%n' host_wwpn='%R' target_wwpn='%r' "
                   "host_adapter='%a'")
 SHOW_MAPS_FMT = "name='%n' multipath='%w' sysfs='%d' paths='%N'"
+# seconds to wait for a removed mapping to go away before retrying
+REMOVE_WAIT = 2
 
 
 def _extract_mpath_data(cmd, show_verb):
@@ -101,11 +103,10 @@ def remove_partition(devpath, retries=10):
     LOG.debug('multipath: removing multipath partition: %s', devpath)
     for _ in range(0, retries):
         util.subp(['dmsetup', 'remove', '--force', '--retry', devpath])
-        udev.udevadm_settle()
-        if not os.path.exists(devpath):
+        if udev.wait_for_removal(devpath, timeout=REMOVE_WAIT):
             return
 
-    util.wait_for_removal(devpath)
+    raise OSError('Timeout exceeded for removal of %s' % devpath)
 
 
 def remove_map(map_id, retries=10):
@@ -114,11 +115,10 @@ def remove_map(map_id, retries=10):
     devpath = '/dev/mapper/%s' % map_id
     for _ in range(0, retries):
         util.subp(['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
-        udev.udevadm_settle()
-        if not os.path.exists(devpath):
+        if udev.wait_for_removal(devpath, timeout=REMOVE_WAIT):
             return
 
-    util.wait_for_removal(devpath)
+    raise OSError('Timeout exceeded for removal of %s' % devpath)
 
 
 def find_mpath_members(multipath_id, paths=None):
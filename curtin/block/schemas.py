@@ -72,6 +72,11 @@ BCACHE = {
             'type': ['string'],
             'enum': ['writethrough', 'writeback', 'writearound', 'none'],
         },
+        'sequential_cutoff': {'$ref': '#/definitions/size'},
+        'writeback_percent': {'type': 'integer',
+                              'minimum': 0, 'maximum': 40},
+        'congested_read_threshold_us': {'type': 'integer', 'minimum': 0},
+        'congested_write_threshold_us': {'type': 'integer', 'minimum': 0},
     },
 }
 DASD = {
@@ -168,7 +173,17 @@ DM_CRYPT = {
         'volume': {'$ref': '#/definitions/ref_id'},
         'key': {'$ref': '#/definitions/id'},
         'keyfile': {'$ref': '#/definitions/id'},
+        'cipher': {'type': 'string'},
+        'keysize': {'type': ['integer', 'string']},
+        'sector_size': {
+            'type': ['integer', 'string'],
+            'oneOf': [{'enum': [512, 1024, 2048, 4096]},
+                      {'enum': ['512', '1024', '2048', '4096']}],
+        },
+        'perf_no_read_workqueue': {'type': 'boolean'},
+        'perf_no_write_workqueue': {'type': 'boolean'},
         'preserve': {'$ref': '#/definitions/preserve'},
+        'wipe': {'$ref': '#/definitions/wipe'},
         'type': {'const': 'dm_crypt'},
     },
 }
@@ -191,6 +206,7 @@ FORMAT = {
         'label': {'type': 'string'},
         'volume': {'$ref': '#/definitions/ref_id'},
         'extra_options': {'type': 'array', 'items': {'type': 'string'}},
+        'fast': {'type': 'boolean'},
     }
 }
 LVM_PARTITION = {
@@ -317,6 +333,8 @@ RAID = {
         'ptable': {'$ref': '#/definitions/ptable'},
         'spare_devices': {'$ref': '#/definitions/devices'},
         'container': {'$ref': '#/definitions/id'},
+        'resync': {'enum': ['full', 'assume-clean', 'throttle']},
+        'sync_speed_max': {'type': 'integer', 'minimum': 1},
         'type': {'const': 'raid'},
         'raidlevel': {
             'type': ['integer', 'string'],
@@ -345,6 +363,8 @@ ZFS = {
     'properties': {
         'id': {'$ref': '#/definitions/id'},
         'pool': {'$ref': '#/definitions/ref_id'},
+        'profile': {'type': 'string',
+                    'enum': ['general', 'database', 'bulk']},
         'properties': {'$ref': '#/definitions/params'},
         'volume': {'$ref': '#/definitions/name'},
         'type': {'const': 'zfs'},
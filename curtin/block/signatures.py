@@ -0,0 +1,104 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Find and zero the signatures of storage formats on a block device.
+
+Only the few places where each format keeps its magic are read, wherever
+on the device they are: the md 0.90 and 1.0 superblocks and the last two
+ZFS labels near the end, btrfs superblock mirrors and LUKS2 secondary
+headers past the first megabyte, the backup GPT header in the last
+sector.  The superblock or header holding each magic found is zeroed, so
+blkid and the tools probing the device no longer detect the format.
+"""
+
+from collections import namedtuple
+import os
+import struct
+
+from curtin.log import LOG
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+# md superblock magic 0xa92b4efc, little endian for 1.x and on x86 for 0.90
+MD_MAGIC = struct.pack('<I', 0xa92b4efc)
+BCACHE_MAGIC = bytes(bytearray([0xc6, 0x85, 0x73, 0xf6, 0x4e, 0x1a, 0x45,
+                                0xca, 0x82, 0x65, 0xf5, 0x7f, 0x48, 0xba,
+                                0x6d, 0x81]))
+# uberblock magic 0x00bab10c in either byte order
+ZFS_MAGICS = (struct.pack('<Q', 0x00bab10c), struct.pack('>Q', 0x00bab10c))
+ZFS_LABEL_SIZE = 256 * KiB
+# the uberblock ring fills the second half of each zfs label
+ZFS_UBERBLOCKS = (128 * KiB, 256 * KiB)
+# offsets a LUKS2 secondary header may be at
+LUKS2_SECONDARY = [16 * KiB << n for n in range(9)]
+
+Signature = namedtuple('Signature', ['name', 'offset', 'length'])
+
+
+def signature_locations(size):
+    """Yield (name, offset, length, magic offsets, magics) for every place
+    a signature may be on a device of size bytes.
+
+    The magic offsets are relative to offset and any of the magics at any
+    of them identifies the format; length bytes from offset are what is
+    read and zeroed."""
+    yield ('ext', 1 * KiB, 1 * KiB, (0x38,), (b'\x53\xef',))
+    yield ('xfs', 0, 512, (0,), (b'XFSB',))
+    for offset in (64 * KiB, 64 * MiB, 256 * GiB):
+        yield ('btrfs', offset, 4 * KiB, (0x40,), (b'_BHRfS_M',))
+    for pagesize in (4 * KiB, 8 * KiB, 16 * KiB, 64 * KiB):
+        yield ('swap', 0, pagesize, (pagesize - 10,),
+               (b'SWAPSPACE2', b'SWAP-SPACE'))
+    yield ('LVM2_member', 0, 4 * 512, (0, 512, 1024, 1536), (b'LABELONE',))
+    # md 1.1 at the start, 1.2 at 4k and 1.0 at the end of the device
+    yield ('linux_raid_member', 0, 4 * KiB, (0,), (MD_MAGIC,))
+    yield ('linux_raid_member', 4 * KiB, 4 * KiB, (0,), (MD_MAGIC,))
+    yield ('linux_raid_member', (size - 8 * KiB) & ~(4 * KiB - 1), 4 * KiB,
+           (0,), (MD_MAGIC,))
+    # md 0.90 in the last 64k aligned 64k of the device
+    yield ('linux_raid_member', (size & ~(64 * KiB - 1)) - 64 * KiB,
+           4 * KiB, (0,), (MD_MAGIC,))
+    yield ('bcache', 4 * KiB, 4 * KiB, (24,), (BCACHE_MAGIC,))
+    yield ('crypto_LUKS', 0, 4 * KiB, (0,), (b'LUKS\xba\xbe',))
+    for offset in LUKS2_SECONDARY:
+        yield ('crypto_LUKS', offset, 4 * KiB, (0,), (b'SKUL\xba\xbe',))
+    # two zfs labels at the start and two at the end of the 256k aligned
+    # device; the label is zeroed where an uberblock is found in its ring
+    aligned = size & ~(ZFS_LABEL_SIZE - 1)
+    for offset in (0, ZFS_LABEL_SIZE, aligned - 2 * ZFS_LABEL_SIZE,
+                   aligned - ZFS_LABEL_SIZE):
+        yield ('zfs_member', offset, ZFS_LABEL_SIZE,
+               range(ZFS_UBERBLOCKS[0], ZFS_UBERBLOCKS[1], 1 * KiB),
+               ZFS_MAGICS)
+    for lbs in (512, 4 * KiB):
+        yield ('gpt', lbs, lbs, (0,), (b'EFI PART',))
+        yield ('gpt', size - lbs, lbs, (0,), (b'EFI PART',))
+    yield ('dos', 0, 512, (510,), (b'\x55\xaa',))
+
+
+def find_signatures(fd, size):
+    """Return the list of Signatures found on open block device fd of size
+    bytes.  Locations that do not fit in the device are skipped."""
+    found = []
+    for name, offset, length, magic_offsets, magics in (
+            signature_locations(size)):
+        if offset < 0 or offset + length > size:
+            continue
+        data = os.pread(fd, length, offset)
+        for moff in magic_offsets:
+            if any(data[moff:moff + len(magic)] == magic
+                   for magic in magics):
+                found.append(Signature(name, offset, length))
+                break
+    return found
+
+
+def zero_signatures(fd, signatures):
+    """Zero the bytes of every signature in signatures on open fd."""
+    for sig in signatures:
+        LOG.debug('zeroing %s signature: %d bytes at %d', sig.name,
+                  sig.length, sig.offset)
+        os.pwrite(fd, b'\0' * sig.length, sig.offset)
+
+# vi: ts=4 expandtab syntax=python
@@ -9,12 +9,15 @@ import os
 from curtin.config import merge_config
 from curtin import distro
 from curtin import util
-from . import blkid, get_supported_filesystems
+from curtin.log import LOG
+from . import blkid, get_blockdev_sector_size, get_supported_filesystems
 
 ZPOOL_DEFAULT_PROPERTIES = {
     'ashift': 12,
     'version': 28,
 }
+# largest ashift zfs supports, 64k sectors
+ZPOOL_MAX_ASHIFT = 16
 
 ZFS_DEFAULT_PROPERTIES = {
     'atime': 'off',
@@ -22,6 +25,17 @@ ZFS_DEFAULT_PROPERTIES = {
     'normalization': 'formD',
 }
 
+# dataset properties of each zfs 'profile': lz4 compression, no access time
+# updates and xattrs kept in the dnode, with the record size of the workload
+ZFS_PROFILES = {
+    'general': {'recordsize': '128K', 'compression': 'lz4', 'atime': 'off',
+                'xattr': 'sa'},
+    'database': {'recordsize': '16K', 'compression': 'lz4', 'atime': 'off',
+                 'xattr': 'sa', 'logbias': 'throughput'},
+    'bulk': {'recordsize': '1M', 'compression': 'lz4', 'atime': 'off',
+             'xattr': 'sa'},
+}
+
 ZFS_UNSUPPORTED_ARCHES = ['i386']
 ZFS_UNSUPPORTED_RELEASES = ['precise', 'trusty']
 
@@ -73,6 +87,47 @@ def _join_pool_volume(poolname, volume):
     return os.path.normpath("%s/%s" % (poolname, volume))
 
 
+def get_vdevs_ashift(vdevs):
+    """
+    Return the ashift of a pool on vdevs: that of the largest logical or
+    physical sector size of the vdevs, so no write to any of them is a
+    read-modify-write of a sector, and no less than the default ashift.
+
+    :param vdevs: An iterable of block device paths.
+    :returns: Integer ashift, log2 of the pool sector size.
+    """
+    ashift = ZPOOL_DEFAULT_PROPERTIES['ashift']
+    for vdev in vdevs:
+        sector_size = max(get_blockdev_sector_size(vdev))
+        ashift = max(ashift, sector_size.bit_length() - 1)
+    if ashift > ZPOOL_MAX_ASHIFT:
+        LOG.warning('sector size of vdevs %s above zfs maximum, using '
+                    'ashift=%s', vdevs, ZPOOL_MAX_ASHIFT)
+        ashift = ZPOOL_MAX_ASHIFT
+    return ashift
+
+
+def zfs_profile_properties(profile, properties=None):
+    """
+    Return the dataset properties of profile, updated with properties.
+
+    :param profile: Name of a profile in ZFS_PROFILES, or None.
+    :param properties: A dictionary of properties set on top of those of
+                       the profile.
+    :raises: ValueError: if profile is unknown
+    """
+    if profile is None:
+        profile_properties = {}
+    elif profile in ZFS_PROFILES:
+        profile_properties = ZFS_PROFILES[profile].copy()
+    else:
+        raise ValueError("Invalid zfs profile '%s', expected one of: %s" %
+                         (profile, ', '.join(sorted(ZFS_PROFILES))))
+    if properties:
+        profile_properties.update(properties)
+    return profile_properties
+
+
 def zfs_supported():
     """Return a boolean indicating if zfs is supported."""
     try:
@@ -0,0 +1,144 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Verify install images against checksums as they are read.
+
+A source entry may give the checksum of its image directly, or the url of
+a checksums file in the format of sha256sum(1) listing it:
+
+  sources:
+    - type: fsimage
+      uri: http://example.io/root.squashfs
+      sha256: 8f434346648f6b96df89dda901c5176b10a6d83961dd3c1ac88b59b2dc327aa4
+    - type: fsimage-layered
+      uri: http://example.io/main.upper.squashfs
+      sha256sums: http://example.io/SHA256SUMS
+
+The digest is updated by the loop that downloads or writes the image, so
+verification needs no extra pass over the data.
+"""
+
+import hashlib
+import os
+
+from curtin.log import LOG
+from curtin import url_helper
+from curtin import util
+
+# algorithms accepted in source entries, strongest first
+CHECKSUM_ALGORITHMS = ('sha512', 'sha256')
+
+
+class ChecksumError(ValueError):
+    """Data did not match its expected checksum."""
+
+
+class Checksum(object):
+    """Expected digest of an image together with the running digest of the
+    data seen so far."""
+
+    def __init__(self, algorithm, expected, name=None):
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError("unsupported checksum algorithm: %s" % algorithm)
+        self.algorithm = algorithm
+        self.expected = expected.strip().lower()
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        """Start over, for when the data is read again from the start."""
+        self._digest = hashlib.new(self.algorithm)
+
+    def update(self, data):
+        self._digest.update(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    @property
+    def key(self):
+        """A string identifying the expected content."""
+        return '%s-%s' % (self.algorithm, self.expected)
+
+    def verify(self):
+        """Raise ChecksumError unless the data seen matches."""
+        found = self.hexdigest()
+        if found != self.expected:
+            raise ChecksumError("%s of %s is %s, expected %s" %
+                                (self.algorithm, self.name, found,
+                                 self.expected))
+        LOG.debug("verified %s of %s", self.algorithm, self.name)
+
+    def verify_file(self, path):
+        """Raise ChecksumError unless the content of local file path
+        matches."""
+        self.reset()
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(url_helper.DOWNLOAD_BUFLEN)
+                if not data:
+                    break
+                self.update(data)
+        self.verify()
+
+
+class ChecksumReader(object):
+    """File-like wrapper passing everything read to a Checksum."""
+
+    def __init__(self, fp, checksum):
+        self.fp = fp
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.checksum.update(data)
+        return data
+
+
+def parse_sums(content, name):
+    """Return the checksum of file name from the content of a sha256sum
+    style checksums file, or None if it is not listed."""
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    for line in content.splitlines():
+        toks = line.strip().split(None, 1)
+        if len(toks) != 2:
+            continue
+        # binary mode entries are marked with a leading '*'
+        if toks[1].lstrip('*') == name:
+            return toks[0]
+    return None
+
+
+def _load_sums(url):
+    path = url[7:] if url.startswith('file://') else url
+    if os.path.isfile(path):
+        return util.load_file(path)
+    return url_helper.geturl(url)
+
+
+def source_checksum(source, url=None):
+    """Return a Checksum for url from the checksum keys of source, or None
+    if source gives none.
+
+    url defaults to the uri of source.  Checksums given directly apply to
+    the uri of the source only, checksums files to any url listed in them
+    by file name."""
+    uri = source['uri']
+    if url is None:
+        url = uri
+    if url == uri:
+        for algorithm in CHECKSUM_ALGORITHMS:
+            if source.get(algorithm):
+                return Checksum(algorithm, source[algorithm], url)
+    name = os.path.basename(url_helper.urlparse(url).path)
+    for algorithm in CHECKSUM_ALGORITHMS:
+        sums = source.get(algorithm + 'sums')
+        if not sums:
+            continue
+        expected = parse_sums(_load_sums(sums), name)
+        if not expected:
+            raise ChecksumError("%s is not listed in %s" % (name, sums))
+        return Checksum(algorithm, expected, url)
+    return None
+
+# vi: ts=4 expandtab syntax=python
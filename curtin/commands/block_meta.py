@@ -1,28 +1,30 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from collections import OrderedDict, namedtuple
-from curtin import (block, config, paths, util)
+from concurrent import futures
+from curtin import (block, config, paths, url_helper, util)
 from curtin.block import schemas
-from curtin.block import (bcache, clear_holders, dasd, iscsi, lvm, mdadm, mkfs,
-                          multipath, zfs)
+from curtin.block import (bcache, clear_holders, dasd, ddimage, dmcrypt,
+                          iscsi, lvm,
+                          mdadm, mkfs, multipath, zfs)
+from curtin.checksum import source_checksum
 from curtin import distro
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
-from curtin.storage_config import (extract_storage_ordered_dict,
+from curtin.storage_config import (GPT_GUID_TO_CURTIN_MAP, StorageConfig,
+                                   extract_storage_ordered_dict,
                                    ptable_uuid_to_flag_entry)
 
 
 from . import populate_one_subcmd
 from curtin.udev import (compose_udev_equality, udevadm_settle,
-                         udevadm_trigger, udevadm_info)
+                         udevadm_trigger, udevadm_info, wait_for)
 
-import glob
 import os
 import platform
 import string
 import sys
 import tempfile
-import time
 
 FstabData = namedtuple(
     "FstabData", ('spec', 'path', 'fstype', 'options', 'freq', 'passno',
@@ -54,8 +56,34 @@ MSDOS_FLAGS = {
     'logical': 'logical',
 }
 
+# sfdisk label of each partition table write_partition_table can create, and
+# partition type guid of each partition flag on gpt
+SFDISK_LABELS = {
+    'gpt': 'gpt',
+    'msdos': 'dos',
+}
+SFDISK_GPT_TYPES = dict((flag, guid) for guid, (flag, _code)
+                        in GPT_GUID_TO_CURTIN_MAP.items()
+                        if flag in SGDISK_FLAGS)
+
 DNAME_BYID_KEYS = ['DM_UUID', 'ID_WWN_WITH_EXTENSION', 'ID_WWN', 'ID_SERIAL',
                    'ID_SERIAL_SHORT']
+
+# default number of storage config items configured at once in custom mode,
+# one by one in config order unless block-meta/jobs or --jobs says otherwise
+BLOCK_META_JOBS = 1
+# item types that run one after the other in config order: mounts nest in
+# the target, and every raid rewrites mdadm.conf.  zfs datasets run between
+# the serial items around them, see zfs_dataset_depends
+SERIAL_TYPES = ('mount', 'zpool', 'raid')
+# item types whose handlers leave the block devices they use as they are
+KEEPS_VOLUMES_TYPES = ('format', 'mount', 'zfs')
+# initial resync of new raid arrays, see raid_handler
+RAID_RESYNC_MODES = (None, 'full', 'assume-clean', 'throttle')
+# sync_speed_max in KiB/s of arrays created with resync: throttle
+RAID_SYNC_SPEED_MAX = 10000
+# seconds devsync waits for a device path after udev settled
+DEVSYNC_TIMEOUT = 10
 CMD_ARGUMENTS = (
     ((('-D', '--devices'),
       {'help': 'which devices to operate on', 'action': 'append',
@@ -72,6 +100,12 @@ CMD_ARGUMENTS = (
                         'choices': ['ext4', 'ext3'], 'default': None}),
      ('--umount', {'help': 'unmount any mounted filesystems before exit',
                    'action': 'store_true', 'default': False}),
+     (('-j', '--jobs'),
+      {'help': ('number of storage config items to configure, and of '
+                'devices to clear, at once. default is block-meta/jobs or '
+                '%d' % BLOCK_META_JOBS),
+       'action': 'store', 'type': int, 'metavar': 'JOBS',
+       'default': None}),
      ('mode', {'help': 'meta-mode to use',
                'choices': [CUSTOM, SIMPLE, SIMPLE_BOOT]}),
      )
@@ -98,25 +132,32 @@ def block_meta(args):
         LOG.debug('Declared block devices: %s', devices)
         args.devices = devices
 
-    LOG.debug('clearing devices=%s', devices)
-    meta_clear(devices, state.get('report_stack_prefix', ''))
-
-    # dd-images requires use of meta_simple
-    if len(dd_images) > 0 and args.force_mode is False:
-        LOG.info('blockmeta: detected dd-images, using mode=simple')
-        return meta_simple(args)
-
-    if cfg.get("storage") and args.force_mode is False:
-        LOG.info('blockmeta: detected storage config, using mode=custom')
-        return meta_custom(args)
-
-    LOG.info('blockmeta: mode=%s force=%s', args.mode, args.force_mode)
-    if args.mode == CUSTOM:
-        return meta_custom(args)
-    elif args.mode in (SIMPLE, SIMPLE_BOOT):
-        return meta_simple(args)
-    else:
-        raise NotImplementedError("mode=%s is not implemented" % args.mode)
+    jobs = args.jobs
+    if jobs is None:
+        jobs = cfg.get('block-meta', {}).get('jobs', BLOCK_META_JOBS)
+
+    # lvm commands of the whole run go through a single lvm shell
+    with lvm.lvm_shell():
+        LOG.debug('clearing devices=%s', devices)
+        meta_clear(devices, state.get('report_stack_prefix', ''), jobs=jobs)
+
+        # dd-images requires use of meta_simple
+        if len(dd_images) > 0 and args.force_mode is False:
+            LOG.info('blockmeta: detected dd-images, using mode=simple')
+            return meta_simple(args)
+
+        if cfg.get("storage") and args.force_mode is False:
+            LOG.info('blockmeta: detected storage config, using mode=custom')
+            return meta_custom(args)
+
+        LOG.info('blockmeta: mode=%s force=%s', args.mode, args.force_mode)
+        if args.mode == CUSTOM:
+            return meta_custom(args)
+        elif args.mode in (SIMPLE, SIMPLE_BOOT):
+            return meta_simple(args)
+        else:
+            raise NotImplementedError("mode=%s is not implemented" %
+                                      args.mode)
 
 
 def logtime(msg, func, *args, **kwargs):
@@ -124,26 +165,31 @@ def logtime(msg, func, *args, **kwargs):
         return func(*args, **kwargs)
 
 
-def write_image_to_disk(source, dev):
+def _open_image_source(uri):
+    if os.path.exists(uri):
+        return open(uri, 'rb')
+    return url_helper.ResumingUrlReader(uri)
+
+
+def write_image_to_disk(source, dev, report_prefix=''):
     """
     Write disk image to block device
     """
     LOG.info('writing image to disk %s, %s', source, dev)
-    extractor = {
-        'dd-tgz': '|tar -xOzf -',
-        'dd-txz': '|tar -xOJf -',
-        'dd-tbz': '|tar -xOjf -',
-        'dd-tar': '|smtar -xOf -',
-        'dd-bz2': '|bzcat',
-        'dd-gz': '|zcat',
-        'dd-xz': '|xzcat',
-        'dd-raw': ''
-    }
     (devname, devnode) = block.get_dev_name_entry(dev)
-    util.subp(args=['sh', '-c',
-                    ('wget "$1" --progress=dot:mega -O - ' +
-                     extractor[source['type']] + '| dd bs=4M of="$2"'),
-                    '--', source['uri'], devnode])
+    bmap = None
+    if source.get('bmap'):
+        bmap = ddimage.parse_bmap(url_helper.geturl(source['bmap']))
+    with events.ReportEventStack(
+            name=report_prefix + '/write-image', reporting_enabled=True,
+            level="INFO",
+            description="writing image %s to %s" % (
+                source['uri'], devnode)) as rs:
+        with _open_image_source(source['uri']) as fp:
+            stats = ddimage.write_image(fp, devnode, source['type'],
+                                        bmap=bmap,
+                                        checksum=source_checksum(source))
+        rs.message = "wrote image to %s: %s" % (devnode, stats)
     util.subp(['partprobe', devnode])
     udevadm_settle()
     # Images from MAAS have well-known/required paths present
@@ -202,46 +248,14 @@ def get_partition_format_type(cfg, machine=None, uefi_bootable=None):
 
 def devsync(devpath):
     util.subp(['partprobe', devpath], rcs=[0, 1])
-    udevadm_settle()
-    for x in range(0, 10):
-        if os.path.exists(devpath):
-            LOG.debug('devsync happy - path %s now exists', devpath)
-            return
-        else:
-            LOG.debug('Waiting on device path: %s', devpath)
-            time.sleep(1)
+    if wait_for(devpath, timeout=DEVSYNC_TIMEOUT):
+        LOG.debug('devsync happy - path %s now exists', devpath)
+        return
     raise OSError('Failed to find device at path: %s', devpath)
 
 
 def determine_partition_number(partition_id, storage_config):
-    vol = storage_config.get(partition_id)
-    partnumber = vol.get('number')
-    if vol.get('flag') == "logical":
-        if not partnumber:
-            LOG.warn('partition \'number\' key not set in config:\n%s',
-                     util.json_dumps(vol))
-            partnumber = 5
-            for key, item in storage_config.items():
-                if item.get('type') == "partition" and \
-                        item.get('device') == vol.get('device') and\
-                        item.get('flag') == "logical":
-                    if item.get('id') == vol.get('id'):
-                        break
-                    else:
-                        partnumber += 1
-    else:
-        if not partnumber:
-            LOG.warn('partition \'number\' key not set in config:\n%s',
-                     util.json_dumps(vol))
-            partnumber = 1
-            for key, item in storage_config.items():
-                if item.get('type') == "partition" and \
-                        item.get('device') == vol.get('device'):
-                    if item.get('id') == vol.get('id'):
-                        break
-                    else:
-                        partnumber += 1
-    return partnumber
+    return StorageConfig.of(storage_config).partition_number(partition_id)
 
 
 def sanitize_dname(dname):
@@ -418,6 +432,12 @@ def get_path_to_storage_volume(volume, storage_config):
     # Get path to block device for volume. Volume param should refer to id of
     # volume in storage config
 
+    # a StorageConfig remembers paths that were synced once, until
+    # forget_volume_paths drops them
+    volume_paths = getattr(storage_config, 'volume_paths', None)
+    if volume_paths is not None and volume in volume_paths:
+        return volume_paths[volume]
+
     devsync_vol = None
     vol = storage_config.get(volume)
     LOG.debug('get_path_to_storage_volume for volume %s(%s)', volume, vol)
@@ -502,18 +522,16 @@ def get_path_to_storage_volume(volume, storage_config):
 
     elif vol.get('type') == "bcache":
         # For bcache setups, the only reliable way to determine the name of the
-        # block device is to look in all /sys/block/bcacheX/ dirs and see what
-        # block devs are in the slaves dir there. Then, those blockdevs can be
-        # checked against the kname of the devs in the config for the desired
-        # bcache device. This is not very elegant though
+        # block device is through sysfs, where the backing device in the
+        # config links to the bcacheN device it is registered as.
         backing_device_path = get_path_to_storage_volume(
             vol.get('backing_device'), storage_config)
         backing_device_kname = block.path_to_kname(backing_device_path)
-        sys_path = list(filter(lambda x: backing_device_kname in x,
-                               glob.glob("/sys/block/bcache*/slaves/*")))[0]
-        while "bcache" not in os.path.split(sys_path)[-1]:
-            sys_path = os.path.split(sys_path)[0]
-        bcache_kname = block.path_to_kname(sys_path)
+        bcache_kname = bcache.get_bcache_kname(backing_device_kname)
+        if not bcache_kname:
+            raise RuntimeError("no bcache device found for backing device "
+                               "'%s' of volume '%s'" %
+                               (backing_device_path, volume))
         volume_path = block.kname_to_path(bcache_kname)
         LOG.debug('got bcache volume path %s', volume_path)
 
@@ -525,11 +543,35 @@ def get_path_to_storage_volume(volume, storage_config):
     if not devsync_vol:
         devsync_vol = volume_path
     devsync(devsync_vol)
+    if devsync_vol != volume_path:
+        # partitions appear once the rescan of their disk was processed
+        udevadm_settle(exists=volume_path)
+    if volume_paths is not None:
+        volume_paths[volume] = volume_path
 
     LOG.debug('return volume path %s', volume_path)
     return volume_path
 
 
+def forget_volume_paths(item_id, storage_config):
+    """Drop the cached paths of the volumes built on item_id once its
+    handler changed the devices below them.
+
+    Creating a partition rereads the partition table of its device, which
+    recreates every partition of it, so the volumes on the device are
+    dropped.  Other items drop their own volume and those built on it."""
+    volume_paths = getattr(storage_config, 'volume_paths', None)
+    if not volume_paths:
+        return
+    item = storage_config[item_id]
+    if item['type'] == 'partition':
+        changed = storage_config.all_dependents(item['device'])
+    else:
+        changed = [item_id] + storage_config.all_dependents(item_id)
+    for volume in changed:
+        volume_paths.pop(volume, None)
+
+
 def dasd_handler(info, storage_config):
     """ Prepare the specified dasd device per configuration
 
@@ -624,28 +666,12 @@ def disk_handler(info, storage_config):
 
 
 def getnumberoflogicaldisks(device, storage_config):
-    logicaldisks = 0
-    for key, item in storage_config.items():
-        if item.get('device') == device and item.get('flag') == "logical":
-            logicaldisks = logicaldisks + 1
-    return logicaldisks
+    return StorageConfig.of(storage_config).logical_partitions(device)
 
 
 def find_previous_partition(disk_id, part_id, storage_config):
-    last_partnum = None
-    for item_id, command in storage_config.items():
-        if item_id == part_id:
-            break
-
-        # skip anything not on this disk, not a 'partition' or 'extended'
-        if command['type'] != 'partition' or command['device'] != disk_id:
-            continue
-        if command.get('flag') == "extended":
-            continue
-
-        last_partnum = determine_partition_number(item_id, storage_config)
-
-    return last_partnum
+    return StorageConfig.of(storage_config).previous_partition(disk_id,
+                                                               part_id)
 
 
 def find_extended_partition(part_device, storage_config):
@@ -656,11 +682,7 @@ def find_extended_partition(part_device, storage_config):
         :param: storage_config: Ordered dict of storage configation
         :returns: string: item_id if found or None
     """
-    for item_id, item in storage_config.items():
-        if item.get('type') == "partition" and \
-           item.get('device') == part_device and \
-           item.get('flag') == "extended":
-            return item_id
+    return StorageConfig.of(storage_config).extended_partition(part_device)
 
 
 def calc_dm_partition_info(partition_kname):
@@ -792,55 +814,44 @@ def partition_verify_fdasd(disk_path, partnumber, info):
         raise RuntimeError("dasd partitions do not support flags")
 
 
-def partition_handler(info, storage_config):
-    device = info.get('device')
-    size = info.get('size')
-    flag = info.get('flag')
+def _previous_partition_number(info, storage_config, partnumber):
+    """Return the number of the partition the partition info is placed
+    after: the extended partition for the first logical partition, else
+    the partition before it in the config."""
+    device = info['device']
     disk_ptable = storage_config.get(device).get('ptable')
-    partition_type = None
-    if not device:
-        raise ValueError("device must be set for partition to be created")
-    if not size:
-        raise ValueError("size must be specified for partition to be created")
-
-    disk = get_path_to_storage_volume(device, storage_config)
-    partnumber = determine_partition_number(info.get('id'), storage_config)
-    disk_kname = block.path_to_kname(disk)
+    if partnumber == 5 and disk_ptable == "msdos":
+        extended_part_id = find_extended_partition(device, storage_config)
+        if not extended_part_id:
+            msg = ("Logical partition id=%s requires an extended partition"
+                   " and no extended partition '(type: partition, flag: "
+                   "extended)' was found in the storage config.")
+            LOG.error(msg, info['id'])
+            raise RuntimeError(msg, info['id'])
+        pnum = determine_partition_number(extended_part_id, storage_config)
+    else:
+        pnum = find_previous_partition(device, info['id'], storage_config)
 
-    # consider the disks logical sector size when calculating sectors
-    try:
-        (logical_block_size_bytes, _) = block.get_blockdev_sector_size(disk)
-        LOG.debug("%s logical_block_size_bytes: %s",
-                  disk_kname, logical_block_size_bytes)
-    except OSError as e:
-        LOG.warning("Couldn't read block size, using default size 512: %s", e)
-        logical_block_size_bytes = 512
+    # In case we fail to find previous partition let's error out now
+    if pnum is None:
+        raise RuntimeError(
+            'Cannot find previous partition on disk %s' % device)
 
-    if partnumber > 1:
-        pnum = None
-        if partnumber == 5 and disk_ptable == "msdos":
-            extended_part_id = find_extended_partition(device, storage_config)
-            if not extended_part_id:
-                msg = ("Logical partition id=%s requires an extended partition"
-                       " and no extended partition '(type: partition, flag: "
-                       "extended)' was found in the storage config.")
-                LOG.error(msg, info['id'])
-                raise RuntimeError(msg, info['id'])
-            pnum = determine_partition_number(extended_part_id, storage_config)
-        else:
-            pnum = find_previous_partition(device, info['id'], storage_config)
+    LOG.debug("previous partition number for '%s' found to be '%s'",
+              info.get('id'), pnum)
+    return pnum
 
-        # In case we fail to find previous partition let's error out now
-        if pnum is None:
-            raise RuntimeError(
-                'Cannot find previous partition on disk %s' % disk)
 
-        LOG.debug("previous partition number for '%s' found to be '%s'",
-                  info.get('id'), pnum)
-        partition_kname = block.partition_kname(disk_kname, pnum)
-        LOG.debug('partition_kname=%s', partition_kname)
-        (previous_start_sectors, previous_size_sectors) = (
-            calc_partition_info(partition_kname, logical_block_size_bytes))
+def calc_partition_geometry(info, storage_config, partnumber,
+                            logical_block_size_bytes,
+                            previous_start_sectors=None,
+                            previous_size_sectors=None):
+    """Return (offset_sectors, length_sectors) of partition info placed
+    after the previous partition, length_sectors not counting the start
+    sector."""
+    device = info['device']
+    flag = info.get('flag')
+    disk_ptable = storage_config.get(device).get('ptable')
 
     # Align to 1M at the beginning of the disk and at logical partitions
     alignment_offset = int((1 << 20) / logical_block_size_bytes)
@@ -867,17 +878,167 @@ def partition_handler(info, storage_config):
                                       previous_size_sectors +
                                       alignment_offset)
 
-    length_bytes = util.human2bytes(size)
+    length_bytes = util.human2bytes(info['size'])
     # start sector is part of the sectors that define the partitions size
     # so length has to be "size in sectors - 1"
     length_sectors = int(length_bytes / logical_block_size_bytes) - 1
     # logical partitions can't share their start sector with the extended
     # partition and logical partitions can't go head-to-head, so we have to
     # realign and for that increase size as required
-    if info.get('flag') == "extended":
+    if flag == "extended":
         logdisks = getnumberoflogicaldisks(device, storage_config)
         length_sectors = length_sectors + (logdisks * alignment_offset)
 
+    return (offset_sectors, length_sectors)
+
+
+def calc_partition_layout(device, storage_config, logical_block_size_bytes):
+    """Return a list of (item_id, partnumber, offset_sectors, length_sectors)
+    for every partition of device, in config order, computed from the
+    config alone as partition_handler would place them one at a time."""
+    storage_config = StorageConfig.of(storage_config)
+    layout = []
+    placed = {}
+    for item_id in storage_config.partitions(device):
+        item = storage_config[item_id]
+        partnumber = determine_partition_number(item_id, storage_config)
+        previous = (None, None)
+        if partnumber > 1:
+            pnum = _previous_partition_number(item, storage_config,
+                                              partnumber)
+            if pnum not in placed:
+                raise RuntimeError(
+                    'Cannot find previous partition on disk %s' % device)
+            previous = placed[pnum]
+        offset_sectors, length_sectors = calc_partition_geometry(
+            item, storage_config, partnumber, logical_block_size_bytes,
+            *previous)
+        # the kernel reports an extended partition as 1k long
+        if item.get('flag') == 'extended':
+            placed[partnumber] = (offset_sectors,
+                                  1024 // logical_block_size_bytes or 1)
+        else:
+            placed[partnumber] = (offset_sectors, length_sectors + 1)
+        layout.append((item_id, partnumber, offset_sectors, length_sectors))
+    return layout
+
+
+def _partition_path(disk, partnumber):
+    if multipath.is_mpath_device(disk):
+        return disk + "-part%s" % partnumber
+    return block.dev_path(block.partition_kname(block.path_to_kname(disk),
+                                                partnumber))
+
+
+def use_partition_script(device, storage_config):
+    """Return True if the partitions of device are created all at once
+    by write_partition_table.
+
+    That is the case for new gpt and msdos partition tables without any
+    preserved partition, which have to be created one at a time."""
+    storage_config = StorageConfig.of(storage_config)
+    disk_cfg = storage_config.get(device)
+    if disk_cfg.get('ptable') not in SFDISK_LABELS:
+        return False
+    if config.value_as_boolean(disk_cfg.get('preserve')):
+        return False
+    for item_id in storage_config.partitions(device):
+        if config.value_as_boolean(storage_config[item_id].get('preserve')):
+            return False
+    return bool(util.which('sfdisk'))
+
+
+def write_partition_table(device, storage_config, disk,
+                          logical_block_size_bytes):
+    """Create every partition of device on disk with a single sfdisk run,
+    then rescan the disk and wait for udev once."""
+    disk_ptable = storage_config.get(device).get('ptable')
+    layout = calc_partition_layout(device, storage_config,
+                                   logical_block_size_bytes)
+    lines = ['label: %s' % SFDISK_LABELS[disk_ptable], 'unit: sectors', '']
+    wipe_offsets = []
+    for item_id, partnumber, offset_sectors, length_sectors in layout:
+        item = storage_config[item_id]
+        flag = item.get('flag')
+        LOG.info("adding partition '%s' to disk '%s' (ptable: '%s')",
+                 item_id, device, disk_ptable)
+        LOG.debug("partnum: %s offset_sectors: %s length_sectors: %s",
+                  partnumber, offset_sectors, length_sectors)
+        attrs = ['start=%s' % offset_sectors,
+                 'size=%s' % (length_sectors + 1)]
+        if disk_ptable == 'msdos':
+            if flag == 'prep':
+                raise ValueError(
+                    'PReP partitions require a GPT partition table')
+            attrs.append('type=%s' % ('f' if flag == 'extended' else '83'))
+            if flag == 'boot':
+                attrs.append('bootable')
+        else:
+            attrs.append('type=%s' % SFDISK_GPT_TYPES.get(
+                flag, SFDISK_GPT_TYPES['linux']))
+        lines.append('%s : %s' % (_partition_path(disk, partnumber),
+                                  ', '.join(attrs)))
+        # do not wipe dos extended partitions, they hold the logical ones
+        if config.value_as_boolean(item.get('wipe')):
+            if flag == 'extended':
+                LOG.warn("extended partitions do not need wiping, "
+                         "so skipping: '%s'" % item_id)
+            else:
+                wipe_offsets.append(
+                    int(offset_sectors * logical_block_size_bytes))
+
+    if wipe_offsets:
+        # wipe the start of the new partitions first by zeroing 1M at their
+        # offsets.  We don't require exclusive access as we're wiping data
+        # at an offset and the current holder maybe part of the current
+        # storage configuration.
+        LOG.debug('Wiping 1M on %s at offsets %s', disk, wipe_offsets)
+        block.zero_file_at_offsets(disk, wipe_offsets, exclusive=False)
+
+    script = '\n'.join(lines) + '\n'
+    LOG.debug('writing partition table of %s:\n%s', disk, script)
+    util.subp(['sfdisk', '--no-reread', disk], data=script.encode(),
+              capture=True)
+
+    last_path = _partition_path(disk, layout[-1][1])
+    if multipath.is_mpath_device(disk):
+        udevadm_settle()  # allow partition creation to happen
+        # sometimes multipath lib creates a block device instead of
+        # a udev symlink, remove these and allow kpartx to create them
+        for _, partnumber, _, _ in layout:
+            part_path = _partition_path(disk, partnumber)
+            if os.path.exists(part_path) and not os.path.islink(part_path):
+                util.del_file(part_path)
+        util.subp(['kpartx', '-v', '-a', '-s', '-p', '-part', disk])
+    else:
+        block.rescan_block_devices([disk])
+    udevadm_settle(exists=last_path)
+
+
+def partition_handler(info, storage_config):
+    device = info.get('device')
+    size = info.get('size')
+    flag = info.get('flag')
+    disk_ptable = storage_config.get(device).get('ptable')
+    partition_type = None
+    if not device:
+        raise ValueError("device must be set for partition to be created")
+    if not size:
+        raise ValueError("size must be specified for partition to be created")
+
+    disk = get_path_to_storage_volume(device, storage_config)
+    partnumber = determine_partition_number(info.get('id'), storage_config)
+    disk_kname = block.path_to_kname(disk)
+
+    # consider the disks logical sector size when calculating sectors
+    try:
+        (logical_block_size_bytes, _) = block.get_blockdev_sector_size(disk)
+        LOG.debug("%s logical_block_size_bytes: %s",
+                  disk_kname, logical_block_size_bytes)
+    except OSError as e:
+        LOG.warning("Couldn't read block size, using default size 512: %s", e)
+        logical_block_size_bytes = 512
+
     # Handle preserve flag
     create_partition = True
     if config.value_as_boolean(info.get('preserve')):
@@ -892,7 +1053,29 @@ def partition_handler(info, storage_config):
             disk, partnumber)
         create_partition = False
 
-    if create_partition:
+    if create_partition and use_partition_script(device, storage_config):
+        # the first partition of the disk creates all of them
+        part_path = _partition_path(disk, partnumber)
+        first_id = StorageConfig.of(storage_config).partitions(device)[0]
+        if info['id'] == first_id:
+            write_partition_table(device, storage_config, disk,
+                                  logical_block_size_bytes)
+        if flag in ('extended', 'logical', 'primary'):
+            partition_type = flag
+    elif create_partition:
+        previous = (None, None)
+        if partnumber > 1:
+            pnum = _previous_partition_number(info, storage_config,
+                                              partnumber)
+            partition_kname = block.partition_kname(disk_kname, pnum)
+            LOG.debug('partition_kname=%s', partition_kname)
+            previous = calc_partition_info(partition_kname,
+                                           logical_block_size_bytes)
+        (offset_sectors, length_sectors) = calc_partition_geometry(
+            info, storage_config, partnumber, logical_block_size_bytes,
+            *previous)
+        length_bytes = util.human2bytes(size)
+
         # Set flag
         # 'sgdisk --list-types'
         LOG.info("adding partition '%s' to disk '%s' (ptable: '%s')",
@@ -917,7 +1100,6 @@ def partition_handler(info, storage_config):
                 # storage configuration.
                 block.zero_file_at_offsets(disk, [wipe_offset],
                                            exclusive=False)
-
         if disk_ptable == "msdos":
             if flag and flag == 'prep':
                 raise ValueError(
@@ -979,6 +1161,38 @@ def partition_handler(info, storage_config):
         make_dname(info.get('id'), storage_config)
 
 
+def volume_zeroed(volume, storage_config):
+    """Return True if the storage item volume reads as zeroes once created:
+    it was wiped with zeroes itself, or it is a new partition, lvm volume
+    or raid array on devices that all read as zeroes.  Encrypted and
+    cached volumes do not, whatever is below them."""
+    info = storage_config.get(volume)
+    if not info:
+        return False
+    if info.get('wipe') == 'zero':
+        return True
+    if config.value_as_boolean(info.get('preserve')):
+        return False
+    if info.get('wipe') == 'random':
+        return False
+    vtype = info.get('type')
+    if vtype == 'partition':
+        devices = [info.get('device')]
+    elif vtype == 'lvm_partition':
+        devices = [info.get('volgroup')]
+    elif vtype == 'lvm_volgroup':
+        devices = info.get('devices')
+    elif vtype == 'raid':
+        if info.get('resync') == 'assume-clean':
+            # see zero_raid_members
+            return True
+        devices = info.get('devices')
+    else:
+        return False
+    return bool(devices) and all(volume_zeroed(dev, storage_config)
+                                 for dev in devices)
+
+
 def format_handler(info, storage_config):
     volume = info.get('volume')
     if not volume:
@@ -993,9 +1207,15 @@ def format_handler(info, storage_config):
         # Volume marked to be preserved, not formatting
         return
 
-    # Make filesystem using block library
+    # Make filesystem using block library, a volume on devices wiped with
+    # zeroes needs no discard from a fast format
     LOG.debug("mkfs %s info: %s", volume_path, info)
-    mkfs.mkfs_from_config(volume_path, info)
+    uuid = mkfs.mkfs_from_config(
+        volume_path, info,
+        nodiscard=volume_zeroed(volume, storage_config))
+    if uuid:
+        # the mounts look up the by-uuid link of the new filesystem
+        udevadm_settle(exists='/dev/disk/by-uuid/%s' % uuid)
 
     device_type = storage_config.get(volume).get('type')
     LOG.debug('Formated device type: %s', device_type)
@@ -1268,11 +1488,11 @@ def lvm_volgroup_handler(info, storage_config):
         # Create vgrcreate command and run
         # capture output to avoid printing it to log
         # Use zero to clear target devices of any metadata
-        util.subp(['vgcreate', '--force', '--zero=y', '--yes',
-                   name] + device_paths, capture=True)
+        lvm.run_lvm(['vgcreate', '--force', '--zero=y', '--yes',
+                     name] + device_paths)
 
-    # refresh lvmetad
-    lvm.lvm_scan()
+    # refresh lvmetad and the lvm state lookups go through
+    lvm.lvm_refresh()
 
 
 def verify_lv_in_vg(lv_name, vg_name):
@@ -1332,10 +1552,10 @@ def lvm_partition_handler(info, storage_config):
         else:
             cmd.extend(["--extents", "100%FREE"])
 
-        util.subp(cmd)
+        lvm.run_lvm(cmd)
 
-    # refresh lvmetad
-    lvm.lvm_scan()
+    # refresh lvmetad and the lvm state lookups go through
+    lvm.lvm_refresh()
 
     wipe_mode = info.get('wipe', 'superblock')
     if wipe_mode and create_lv:
@@ -1367,10 +1587,12 @@ def dm_crypt_handler(info, storage_config):
     volume = info.get('volume')
     keysize = info.get('keysize')
     cipher = info.get('cipher')
+    sector_size = info.get('sector_size')
     dm_name = info.get('dm_name')
     if not dm_name:
         dm_name = info.get('id')
     dmcrypt_dev = os.path.join("/dev", "mapper", dm_name)
+    perf_flags, crypttab_options = dmcrypt.perf_options(info)
     preserve = config.value_as_boolean(info.get('preserve'))
     if not volume:
         raise ValueError("volume for cryptsetup to operate on must be \
@@ -1430,16 +1652,23 @@ def dm_crypt_handler(info, storage_config):
         if not zkey_used:
             LOG.debug('Using cryptsetup on %s', volume_path)
             luks_type = "luks"
+            if cipher == 'auto':
+                cipher, keysize = dmcrypt.auto_cipher(keysize)
             cmd = ["cryptsetup"]
             if cipher:
                 cmd.extend(["--cipher", cipher])
             if keysize:
-                cmd.extend(["--key-size", keysize])
+                cmd.extend(["--key-size", str(keysize)])
+            if sector_size:
+                # sector sizes other than 512 need a luks2 header
+                luks_type = "luks2"
+                cmd.extend(["--type", luks_type,
+                            "--sector-size", str(sector_size)])
             cmd.extend(["luksFormat", volume_path, keyfile])
             util.subp(cmd)
 
         cmd = ["cryptsetup", "open", "--type", luks_type, volume_path, dm_name,
-               "--key-file", keyfile]
+               "--key-file", keyfile] + perf_flags
 
         util.subp(cmd)
 
@@ -1463,7 +1692,9 @@ def dm_crypt_handler(info, storage_config):
         crypt_tab_location = os.path.join(state_dir, "crypttab")
         uuid = block.get_volume_uuid(volume_path)
         util.write_file(crypt_tab_location,
-                        "%s UUID=%s none luks\n" % (dm_name, uuid), omode="a")
+                        "%s UUID=%s none %s\n" %
+                        (dm_name, uuid, ','.join(['luks'] + crypttab_options)),
+                        omode="a")
     else:
         LOG.info("fstab configuration is not present in environment, so \
             cannot locate an appropriate directory to write crypttab in \
@@ -1534,10 +1765,33 @@ def raid_handler(info, storage_config):
         LOG.debug('raid %s already present, skipping create', md_devname)
         create_raid = False
 
+    resync = info.get('resync')
+    if resync not in RAID_RESYNC_MODES:
+        raise ValueError("invalid resync '%s' for raid '%s'" %
+                         (resync, info.get('id')))
+    if resync == 'assume-clean' and container:
+        # the members of the container are not zeroed for the array
+        raise ValueError("resync 'assume-clean' is not supported for raid "
+                         "'%s' in a container" % info.get('id'))
+    if raidlevel in mdadm.NOSPARE_RAID_LEVELS:
+        # nothing to resync without redundancy
+        resync = None
+
     if create_raid:
+        if resync == 'assume-clean':
+            zero_raid_members(devices or [], spare_devices or [],
+                              storage_config)
         mdadm.mdadm_create(md_devname, raidlevel,
                            device_paths, spare_device_paths, container_dev,
-                           info.get('mdname', ''), metadata)
+                           info.get('mdname', ''), metadata,
+                           assume_clean=resync == 'assume-clean',
+                           bitmap='internal' if resync == 'throttle' else None)
+        if resync == 'throttle':
+            mdadm.md_set_sync_speed_max(
+                md_devname, info.get('sync_speed_max', RAID_SYNC_SPEED_MAX))
+        elif resync == 'full':
+            wait_for_raid_sync(md_devname, info['id'],
+                               state.get('report_stack_prefix', ''))
 
     wipe_mode = info.get('wipe')
     if wipe_mode:
@@ -1573,6 +1827,40 @@ def raid_handler(info, storage_config):
         disk_handler(info, storage_config)
 
 
+def zero_raid_members(devices, spare_devices, storage_config):
+    """Zero the members of a raid array created with --assume-clean, so
+    the array is consistent without a resync.  Members that their own item
+    already wiped with zeroes are not zeroed again.  Every member is then
+    checked to read as zeroes, raising RuntimeError if one does not."""
+    for dev in devices + spare_devices:
+        volume_path = get_path_to_storage_volume(dev, storage_config)
+        if storage_config[dev].get('wipe') != 'zero':
+            LOG.debug('zeroing raid member %s before assume-clean',
+                      volume_path)
+            block.wipe_volume(volume_path, mode='zero', exclusive=False)
+        if not block.is_zeroed(volume_path):
+            raise RuntimeError(
+                "raid member %s does not read as zeroes after its wipe, "
+                "refusing to create the array with --assume-clean" %
+                volume_path)
+
+
+def wait_for_raid_sync(md_devname, item_id, report_prefix=''):
+    """Wait for the initial resync of a new raid array to complete,
+    reporting its progress."""
+    name = report_prefix + '/raid-sync-' + item_id
+
+    def progress(done, total):
+        msg = 'resync of %s: %d%%' % (md_devname, 100 * done // total)
+        LOG.info(msg)
+        events.report_progress_event(name, msg)
+
+    with events.ReportEventStack(
+            name=name, reporting_enabled=True, level="INFO",
+            description="waiting for resync of %s" % md_devname):
+        mdadm.md_block_until_in_sync(md_devname, progress=progress)
+
+
 def verify_bcache_cachedev(cachedev):
     """ verify that the specified cache_device is a bcache cache device."""
     result = bcache.is_caching(cachedev)
@@ -1637,6 +1925,31 @@ def bcache_verify(cachedev, backingdev, cache_mode):
     return True
 
 
+def make_bcache_tuning_rule(info, backing_device, tunables):
+    """Write a udev rule setting tunables on the bcache device of
+    backing_device whenever it appears, as they are not kept in its
+    superblock.  Like dname rules it is copied to the target."""
+    state = util.load_command_environment(strict=True)
+    rules_dir = os.path.join(state['scratch'], "rules.d")
+    bcache_super = bcache.superblock_asdict(device=backing_device)
+    if not bcache_super or 'dev.uuid' not in bcache_super:
+        raise RuntimeError("cannot find bcache uuid of backing device %s" %
+                           backing_device)
+    rule = [
+        compose_udev_equality("SUBSYSTEM", "block"),
+        compose_udev_equality("ACTION", "add|change"),
+        compose_udev_equality("ENV{CACHED_UUID}", bcache_super['dev.uuid']),
+        ]
+    for key, value in sorted(tunables.items()):
+        rule.append('ATTR{bcache/%s}="%s"' % (bcache.BCACHE_TUNABLES[key],
+                                              value))
+    content = ['# Written by curtin', ', '.join(rule) + '\n']
+    util.ensure_dir(rules_dir)
+    rule_file = os.path.join(
+        rules_dir, 'bcache-tuning-%s.rules' % sanitize_dname(info['id']))
+    util.write_file(rule_file, '\n'.join(content))
+
+
 def bcache_handler(info, storage_config):
     backing_device = get_path_to_storage_volume(info.get('backing_device'),
                                                 storage_config)
@@ -1675,6 +1988,17 @@ def bcache_handler(info, storage_config):
         raise ValueError("cache mode specified which can only be set on "
                          "backing devices, but none was specified")
 
+    tunables = dict((key, info[key]) for key in bcache.BCACHE_TUNABLES
+                    if key in info)
+    if 'sequential_cutoff' in tunables:
+        tunables['sequential_cutoff'] = util.human2bytes(
+            tunables['sequential_cutoff'])
+    if tunables:
+        bcache_kname = bcache.get_bcache_kname(
+            block.path_to_kname(backing_device))
+        bcache.set_tunables(bcache_kname, tunables)
+        make_bcache_tuning_rule(info, backing_device, tunables)
+
     wipe_mode = info.get('wipe')
     if wipe_mode and bcache_dev:
         LOG.debug('Wiping bcache device %s mode=%s', bcache_dev, wipe_mode)
@@ -1711,6 +2035,11 @@ def zpool_handler(info, storage_config):
     if not vdevs or not poolname:
         raise ValueError("pool and vdevs for zpool must be specified")
 
+    if 'ashift' not in pool_properties:
+        # match the sector size of the vdevs, zfs cannot change it later
+        pool_properties = dict(pool_properties,
+                               ashift=zfs.get_vdevs_ashift(vdevs))
+
     # map storage volume to by-id path for persistent path
     vdevs_byid = []
     for vdev in vdevs:
@@ -1739,7 +2068,8 @@ def zfs_handler(info, storage_config):
     state = util.load_command_environment(strict=True)
     poolname = get_poolname(info, storage_config)
     volume = info.get('volume')
-    properties = info.get('properties', {})
+    properties = zfs.zfs_profile_properties(info.get('profile'),
+                                            info.get('properties', {}))
 
     LOG.info('Creating zfs dataset %s/%s with properties %s',
              poolname, volume, properties)
@@ -1760,6 +2090,7 @@ def get_device_paths_from_storage_config(storage_config):
 
     :param: storage_config: Ordered dict of storage configation
     """
+    storage_config = StorageConfig.of(storage_config)
     dpaths = []
     for (k, v) in storage_config.items():
         if v.get('type') in ['disk', 'partition']:
@@ -1873,11 +2204,12 @@ def zfsroot_update_storage_config(storage_config):
     return ret
 
 
-def meta_clear(devices, report_prefix=''):
+def meta_clear(devices, report_prefix='', jobs=None):
     """ Run clear_holders on specified list of devices.
 
     :param: devices: a list of block devices (/dev/XXX) to be cleared
     :param: report_prefix: a string to pass to the ReportEventStack
+    :param: jobs: the number of physical devices wiped at once
     """
     # shut down any already existing storage layers above any disks used in
     # config that have 'wipe' set
@@ -1886,11 +2218,145 @@ def meta_clear(devices, report_prefix=''):
             reporting_enabled=True, level='INFO',
             description="removing previous storage devices"):
         clear_holders.start_clear_holders_deps()
-        clear_holders.clear_holders(devices)
+        clear_holders.clear_holders(
+            devices, jobs=jobs,
+            report_prefix=report_prefix + '/clear-holders')
         # if anything was not properly shut down, stop installation
         clear_holders.assert_clear(devices)
 
 
+def zfs_dataset_depends(item, earlier):
+    """Return the ids of the zfs datasets in earlier, those of the pool of
+    zfs item created before it, that item must be created after: its
+    parent datasets, and the datasets mounted at or above its mountpoint.
+    A dataset inheriting its mountpoint goes after every mounted one."""
+    volume = item['volume'].strip('/')
+    mountpoint = item.get('properties', {}).get('mountpoint')
+    deps = set()
+    for other in earlier:
+        other_mount = other.get('properties', {}).get('mountpoint')
+        if volume.startswith(other['volume'].strip('/') + '/'):
+            deps.add(other['id'])
+        elif not other_mount or not other_mount.startswith('/'):
+            continue
+        elif mountpoint is None or (
+                mountpoint == other_mount or
+                mountpoint.startswith(other_mount.rstrip('/') + '/')):
+            deps.add(other['id'])
+    return deps
+
+
+def storage_item_depends(storage_config):
+    """Return an OrderedDict of item id to the set of item ids that must
+    be configured before it.
+
+    Besides the references of each item type, partitions of a disk are
+    created one after the other, and items on a partition wait for every
+    partition of its disk so the partition table is no longer changing
+    under them.  Logical volumes of a volume group are created in order
+    as their extents are allocated in that order.  Items of SERIAL_TYPES
+    run in config order, zfs datasets after the serial item before them and
+    before the one after them."""
+    storage_config = StorageConfig.of(storage_config)
+    depends = OrderedDict()
+    dasds = {}
+    for item_id, item in storage_config.items():
+        if item['type'] == 'dasd' and item.get('device_id'):
+            dasds.setdefault(item['device_id'], set()).add(item_id)
+    # id of the partitioned device of each partition and its last partition
+    partition_disk = {}
+    last_partition = {}
+    last_lv = {}
+    last_serial = None
+    # zfs datasets of each pool, and those since the last serial item
+    pool_datasets = {}
+    datasets = []
+    for item_id, item in storage_config.items():
+        deps = set(storage_config.depends(item_id))
+        if item['type'] == 'disk' and item.get('device_id'):
+            deps.update(dasds.get(item['device_id'], ()))
+        if item['type'] == 'partition':
+            if item['device'] in last_partition:
+                deps.add(last_partition[item['device']])
+            partition_disk[item_id] = item['device']
+            last_partition[item['device']] = item_id
+        elif item['type'] == 'lvm_partition':
+            if item['volgroup'] in last_lv:
+                deps.add(last_lv[item['volgroup']])
+            last_lv[item['volgroup']] = item_id
+        elif item['type'] == 'zfs':
+            earlier = pool_datasets.setdefault(item['pool'], [])
+            deps.update(zfs_dataset_depends(item, earlier))
+            earlier.append(item)
+            if last_serial:
+                deps.add(last_serial)
+            datasets.append(item_id)
+        if item['type'] in SERIAL_TYPES:
+            if last_serial:
+                deps.add(last_serial)
+            deps.update(datasets)
+            datasets = []
+            last_serial = item_id
+        depends[item_id] = set(dep for dep in deps if dep in storage_config)
+
+    for item_id, deps in depends.items():
+        if storage_config[item_id]['type'] == 'partition':
+            continue
+        for dep in list(deps):
+            if dep in partition_disk:
+                deps.add(last_partition[partition_disk[dep]])
+    return depends
+
+
+def run_storage_handlers(storage_config, handle, jobs=None):
+    """Call handle(item_id) for every item of storage_config, up to jobs
+    at once, each once the items it depends on are done.
+
+    With jobs of 1 the items are handled one by one in config order.  After
+    a failure no more items are started and the first error is raised once
+    the running ones finish."""
+    if jobs is None:
+        jobs = BLOCK_META_JOBS
+    jobs = max(1, int(jobs))
+    if jobs == 1:
+        for item_id in storage_config:
+            handle(item_id)
+        return
+
+    depends = storage_item_depends(storage_config)
+    pending = list(depends)
+    done = set()
+    running = {}
+    error = None
+    LOG.debug('configuring storage with up to %d jobs', jobs)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            if error is None:
+                for item_id in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if depends[item_id].issubset(done):
+                        pending.remove(item_id)
+                        running[pool.submit(handle, item_id)] = item_id
+            if not running:
+                if error is None:
+                    raise ValueError(
+                        "storage config has circular dependencies between: "
+                        "%s" % ', '.join(pending))
+                break
+            finished, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                item_id = running.pop(future)
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                else:
+                    done.add(item_id)
+    if error is not None:
+        raise error
+
+
 def meta_custom(args):
     """Does custom partitioning based on the layout provided in the config
     file. Section with the name storage contains information on which
@@ -1918,15 +2384,19 @@ def meta_custom(args):
 
     storage_config_dict = extract_storage_ordered_dict(cfg)
 
-    storage_config_dict = zfsroot_update_storage_config(storage_config_dict)
+    storage_config_dict = StorageConfig(
+        zfsroot_update_storage_config(storage_config_dict))
 
     # set up reportstack
     stack_prefix = state.get('report_stack_prefix', '')
 
-    for item_id, command in storage_config_dict.items():
-        handler = command_handlers.get(command['type'])
-        if not handler:
+    for command in storage_config_dict.values():
+        if command['type'] not in command_handlers:
             raise ValueError("unknown command type '%s'" % command['type'])
+
+    def handle(item_id):
+        command = storage_config_dict[item_id]
+        handler = command_handlers[command['type']]
         with events.ReportEventStack(
                 name=stack_prefix, reporting_enabled=True, level="INFO",
                 description="configuring %s: %s" % (command['type'],
@@ -1937,6 +2407,13 @@ def meta_custom(args):
                 LOG.error("An error occured handling '%s': %s - %s" %
                           (item_id, type(error).__name__, error))
                 raise
+            if command['type'] not in KEEPS_VOLUMES_TYPES:
+                forget_volume_paths(item_id, storage_config_dict)
+
+    jobs = args.jobs
+    if jobs is None:
+        jobs = cfg.get('block-meta', {}).get('jobs', BLOCK_META_JOBS)
+    run_storage_handlers(storage_config_dict, handle, jobs)
 
     if args.umount:
         util.do_umount(state['target'], recursive=True)
@@ -2032,7 +2509,9 @@ def meta_simple(args):
     if len(dd_images):
         # we have at least one dd-able image
         # we will only take the first one
-        rootdev = write_image_to_disk(dd_images[0], devname)
+        rootdev = write_image_to_disk(
+            dd_images[0], devname,
+            report_prefix=state.get('report_stack_prefix', ''))
         util.subp(['mount', rootdev, state['target']])
         return 0
 
@@ -43,7 +43,8 @@ def clear_holders_main(args):
         LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
     else:
-        block.clear_holders.clear_holders(devices, try_preserve=args.preserve)
+        block.clear_holders.clear_holders(devices, try_preserve=args.preserve,
+                                          jobs=args.jobs)
         if args.preserve:
             print('ran clear_holders attempting to preserve data. however, '
                   'hotplug support for some devices may cause holders to '
@@ -60,6 +61,10 @@ CMD_ARGUMENTS = (
      (('-p', '--preserve'),
       {'help': 'try to shut down holders without erasing anything',
        'default': False, 'action': 'store_true'}),
+     (('-j', '--jobs'),
+      {'help': 'number of physical devices to wipe at once. default is %d' %
+               block.clear_holders.CLEAR_HOLDERS_JOBS,
+       'action': 'store', 'type': int, 'metavar': 'JOBS', 'default': None}),
      )
 )
 
@@ -1,12 +1,19 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from concurrent import futures
+import functools
 import os
 import shutil
 import sys
 import tempfile
+import threading
 
 import curtin.config
+from curtin.checksum import source_checksum
 from curtin.log import LOG
+from curtin import copytree
+from curtin import image_cache
+from curtin import prefetch
 from curtin import util
 from curtin.futil import write_files
 from curtin.reporter import events
@@ -14,6 +21,9 @@ from curtin import url_helper
 
 from . import populate_one_subcmd
 
+# number of layers of a remote fsimage-layered source to download at once
+LAYER_DOWNLOAD_JOBS = 4
+
 CMD_ARGUMENTS = (
     ((('-t', '--target'),
       {'help': ('target directory to extract to (root) '
@@ -41,13 +51,36 @@ def tar_xattr_opts(cmd=None):
     return []
 
 
-def extract_root_tgz_url(url, target):
+def extract_root_tgz_file(path, target):
+    util.subp(args=['smtar', '-C', target] + tar_xattr_opts() +
+              ['-Sxpf', path, '--numeric-owner'])
+
+
+def extract_root_tgz_url(url, target, cache=None, checksum=None):
     # extract a -root.tar.gz url in the 'target' directory
     path = _path_from_file_url(url)
     if path != url or os.path.isfile(path):
-        util.subp(args=['smtar', '-C', target] + tar_xattr_opts() +
-                  ['-Sxpf', path, '--numeric-owner'])
-        return
+        if checksum:
+            checksum.verify_file(path)
+        return extract_root_tgz_file(path, target)
+
+    if cache:
+        path = cache.fetch(url, checksum=checksum)
+        try:
+            return extract_root_tgz_file(path, target)
+        finally:
+            cache.release(path)
+
+    if checksum:
+        # stage the tarball so that it is verified before tar writes
+        # anything to target
+        wfp = tempfile.NamedTemporaryFile(suffix=".tgz", delete=False)
+        wfp.close()
+        try:
+            url_helper.download(url, wfp.name, retries=3, checksum=checksum)
+            return extract_root_tgz_file(wfp.name, target)
+        finally:
+            os.unlink(wfp.name)
 
     # Uses smtar to avoid specifying the compression type
     util.subp(args=['sh', '-cf',
@@ -57,15 +90,28 @@ def extract_root_tgz_url(url, target):
                     '--', url, target])
 
 
-def extract_root_fsimage_url(url, target):
+def extract_root_fsimage_url(url, target, cache=None, checksum=None):
     path = _path_from_file_url(url)
     if path != url or os.path.isfile(path):
+        if checksum:
+            checksum.verify_file(path)
+        return _extract_root_fsimage(path, target)
+
+    path = prefetch.get_prefetched(url)
+    if path:
         return _extract_root_fsimage(path, target)
 
+    if cache:
+        path = cache.fetch(url, checksum=checksum)
+        try:
+            return _extract_root_fsimage(path, target)
+        finally:
+            cache.release(path)
+
     wfp = tempfile.NamedTemporaryFile(suffix=".img", delete=False)
     wfp.close()
     try:
-        url_helper.download(url, wfp.name, retries=3)
+        url_helper.download(url, wfp.name, retries=3, checksum=checksum)
         return _extract_root_fsimage(wfp.name, target)
     finally:
         os.unlink(wfp.name)
@@ -86,11 +132,15 @@ def _extract_root_fsimage(path, target):
         os.rmdir(mp)
 
 
-def extract_root_layered_fsimage_url(uri, target):
+def extract_root_layered_fsimage_url(uri, target, cache=None, jobs=None,
+                                     checksums=None):
     ''' Build images list to consider from a layered structure
 
     uri: URI of the layer file
     target: Target file system to provision
+    cache: optional ImageCache to fetch remote layers through
+    jobs: number of remote layers to download at once
+    checksums: optional dict of layer url to the Checksum to verify it with
 
     return: None
     '''
@@ -104,32 +154,108 @@ def extract_root_layered_fsimage_url(uri, target):
         # Download every remote images if remote url
         if url_helper.urlparse(path).scheme != "":
             tmp_dir = tempfile.mkdtemp()
-            image_stack = _download_layered_images(image_stack, tmp_dir)
+            image_stack = _download_layered_images(image_stack, tmp_dir,
+                                                   cache=cache, jobs=jobs,
+                                                   checksums=checksums)
 
         # Check that all images exists on disk and are not empty
         for img in image_stack:
-            if not os.path.isfile(img) or os.path.getsize(img) <= 0:
-                raise ValueError("Failed to use fsimage: '%s' doesn't exist " +
-                                 "or is invalid", img)
+            _check_layer_image(img)
+        if tmp_dir is None and checksums:
+            # downloaded layers were verified as they were fetched
+            for img in image_stack:
+                if checksums.get(img):
+                    checksums[img].verify_file(img)
 
         return _extract_root_layered_fsimage(image_stack, target)
     finally:
         if tmp_dir and os.path.exists(tmp_dir):
             shutil.rmtree(tmp_dir)
+        if cache and tmp_dir:
+            for img in image_stack:
+                cache.release(img)
 
 
-def _download_layered_images(image_stack, tmp_dir):
-    local_image_stack = []
-    try:
-        for img_url in image_stack:
-            dest_path = os.path.join(tmp_dir,
-                                     os.path.basename(img_url))
-            url_helper.download(img_url, dest_path, retries=3)
-            local_image_stack.append(dest_path)
-    except url_helper.UrlError as e:
-        LOG.error("Failed to download '%s'" % img_url)
-        raise e
-    return local_image_stack
+def _check_layer_image(img):
+    if not os.path.isfile(img) or os.path.getsize(img) <= 0:
+        raise ValueError("Failed to use fsimage: '%s' doesn't exist "
+                         "or is invalid" % img)
+
+
+class _DownloadCancelled(Exception):
+    pass
+
+
+def _download_layered_images(image_stack, tmp_dir, cache=None, jobs=None,
+                             checksums=None):
+    """Download the layers of image_stack, up to jobs at a time.
+
+    Each layer is checked as soon as it has been downloaded.  If a layer
+    fails, layers not yet started are cancelled, downloads in progress are
+    interrupted and the error is raised."""
+    if jobs is None:
+        jobs = LAYER_DOWNLOAD_JOBS
+    if checksums is None:
+        checksums = {}
+    cancelled = threading.Event()
+
+    def _check_cancelled(*args):
+        if cancelled.is_set():
+            raise _DownloadCancelled()
+
+    def _download_layer(img_url):
+        _check_cancelled()
+        download = functools.partial(url_helper.download,
+                                     reporthook=_check_cancelled)
+        checksum = checksums.get(img_url)
+        try:
+            dest_path = prefetch.get_prefetched(img_url)
+            if dest_path is None and cache:
+                dest_path = cache.fetch(img_url, checksum=checksum,
+                                        download=download)
+            elif dest_path is None:
+                dest_path = os.path.join(tmp_dir, os.path.basename(img_url))
+                download(img_url, dest_path, retries=3, checksum=checksum)
+            try:
+                _check_layer_image(dest_path)
+            except ValueError:
+                if cache:
+                    cache.release(dest_path)
+                raise
+        except _DownloadCancelled:
+            raise
+        except Exception:
+            cancelled.set()
+            raise
+        return dest_path
+
+    workers = max(1, min(jobs, len(image_stack)))
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        downloads = [(img_url, pool.submit(_download_layer, img_url))
+                     for img_url in image_stack]
+        try:
+            for job in futures.as_completed([d[1] for d in downloads]):
+                job.result()
+        except Exception:
+            cancelled.set()
+            for img_url, job in downloads:
+                job.cancel()
+            futures.wait([d[1] for d in downloads])
+            errors = []
+            for img_url, job in downloads:
+                if job.cancelled():
+                    continue
+                error = job.exception()
+                if error is None:
+                    if cache:
+                        cache.release(job.result())
+                elif not isinstance(error, _DownloadCancelled):
+                    LOG.error("Failed to download '%s': %s", img_url, error)
+                    errors.append(error)
+            if errors:
+                raise errors[0]
+            raise
+    return [job.result() for _img_url, job in downloads]
 
 
 def _extract_root_layered_fsimage(image_stack, target):
@@ -201,15 +327,29 @@ def _get_image_stack(uri):
     return image_stack
 
 
+def get_layer_checksums(source):
+    """Return a dict of layer url to Checksum for a fsimage-layered
+    source, for the layers source gives checksums for."""
+    checksums = {}
+    for img_url in _get_image_stack(_path_from_file_url(source['uri'])):
+        checksum = source_checksum(source, img_url)
+        if checksum:
+            checksums[img_url] = checksum
+    return checksums
+
+
 def copy_to_target(source, target):
     if source.startswith("cp://"):
         source = source[5:]
     source = os.path.abspath(source)
 
-    util.subp(args=['sh', '-c',
-                    ('mkdir -p "$2" && cd "$2" && '
-                     'rsync -aXHAS --one-file-system "$1/" .'),
-                    '--', source, target])
+    stack_prefix = util.load_command_environment().get('report_stack_prefix')
+    with events.ReportEventStack(
+            name=(stack_prefix or '') + '/copy-to-target',
+            reporting_enabled=True, level="INFO",
+            description="copying %s to %s" % (source, target)) as rs:
+        stats = copytree.copy_tree(source, target)
+        rs.message = "copied %s to %s: %s" % (source, target, stats)
 
 
 def _path_from_file_url(url):
@@ -237,6 +377,7 @@ def extract(args):
 
     LOG.debug("Installing sources: %s to target at %s" % (sources, target))
     stack_prefix = state.get('report_stack_prefix', '')
+    cache = image_cache.ImageCache.from_config(cfg.get('image_cache'))
 
     for source in sources:
         with events.ReportEventStack(
@@ -248,11 +389,26 @@ def extract(args):
             if source['uri'].startswith("cp://"):
                 copy_to_target(source['uri'], target)
             elif source['type'] == "fsimage":
-                extract_root_fsimage_url(source['uri'], target=target)
+                extract_root_fsimage_url(source['uri'], target=target,
+                                         cache=cache,
+                                         checksum=source_checksum(source))
             elif source['type'] == "fsimage-layered":
-                extract_root_layered_fsimage_url(source['uri'], target=target)
+                extract_root_layered_fsimage_url(
+                    source['uri'], target=target, cache=cache,
+                    jobs=source.get('download_jobs'),
+                    checksums=get_layer_checksums(source))
             else:
-                extract_root_tgz_url(source['uri'], target=target)
+                extract_root_tgz_url(source['uri'], target=target,
+                                     cache=cache,
+                                     checksum=source_checksum(source))
+
+    if cache:
+        with events.ReportEventStack(
+                name=stack_prefix + '/image-cache', reporting_enabled=True,
+                level="INFO", description="image cache %s" % cache.path,
+                message="image cache %s: %d hits, %d misses" %
+                (cache.path, cache.hits, cache.misses)):
+            pass
 
     if cfg.get('write_files'):
         LOG.info("Applying write_files from config.")
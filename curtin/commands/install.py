@@ -5,6 +5,7 @@ from copy import deepcopy
 import json
 import os
 import re
+import selectors
 import shlex
 import shutil
 import subprocess
@@ -12,15 +13,20 @@ import sys
 import tempfile
 
 from curtin.block import iscsi, zfs
+from curtin.checksum import source_checksum
 from curtin import config
 from curtin import distro
+from curtin import image_cache
+from curtin import prefetch
 from curtin import util
 from curtin import paths
+from curtin import url_helper
 from curtin import version
 from curtin.log import LOG, logged_time
 from curtin.reporter.legacy import load_reporter
 from curtin.reporter import events
 from . import populate_one_subcmd
+from .extract import _get_image_stack
 
 INSTALL_LOG = "/var/log/curtin/install.log"
 # Upon error, curtin creates a tar of all related logs at ERROR_TARFILE
@@ -33,6 +39,16 @@ INSTALL_START_MSG = ("curtin: Installation started. (%s)" %
 INSTALL_PASS_MSG = "curtin: Installation finished."
 INSTALL_FAIL_MSG = "curtin: Installation failed with exception: {exception}"
 
+# stage command output is read in chunks of STAGE_READ_SIZE, partial lines
+# are held back until a newline arrives or the command is quiet for
+# STAGE_FLUSH_TIMEOUT seconds.  Only the last STAGE_OUTPUT_TAIL bytes of
+# output are kept for the error message of a failed command.
+STAGE_READ_SIZE = 64 * 1024
+STAGE_FLUSH_TIMEOUT = 0.5
+STAGE_OUTPUT_TAIL = 64 * 1024
+# default number of stage commands that may run at once, see Stage.run
+STAGE_JOBS = 4
+
 STAGE_DESCRIPTIONS = {
     'early': 'preparing for installation',
     'partitioning': 'configuring storage',
@@ -163,12 +179,48 @@ class WorkingDir(object):
                  'CONFIG': self.config_file})
 
 
+class StageCommand(object):
+    """A single stage command and the state of its output stream.
+
+    A command entry is either a command (list or shell string) or a dict
+    with a 'command' key and an optional 'depends' list naming the other
+    entries of the stage that must finish first.  Without 'depends' an
+    entry runs after the entry sorted before it, as it always has.
+    """
+
+    def __init__(self, name, entry, previous=None):
+        self.name = name
+        if isinstance(entry, dict):
+            self.cmd = entry.get('command')
+            depends = entry.get('depends')
+        else:
+            self.cmd = entry
+            depends = None
+        self.explicit_depends = depends is not None
+        if depends is None:
+            depends = [previous] if previous else []
+        elif not isinstance(depends, list):
+            depends = [depends]
+        self.depends = set(depends)
+        self.prefix = b""
+        self.at_bol = True
+        self.pending = b""
+        self.tail = bytearray()
+        self.sp = None
+        self.reportstack = None
+        self.timer = None
+
+
 class Stage(object):
 
-    def __init__(self, name, commands, env, reportstack=None, logfile=None):
+    def __init__(self, name, commands, env, reportstack=None, logfile=None,
+                 jobs=None):
         self.name = name
         self.commands = commands
         self.env = env
+        if jobs is None:
+            jobs = STAGE_JOBS
+        self.jobs = max(1, int(jobs))
         if logfile is None:
             logfile = INSTALL_LOG
         self.install_log = self._open_install_log(logfile)
@@ -208,44 +260,186 @@ class Stage(object):
             self.install_log.write(data)
             self.install_log.flush()
 
-    def run(self):
+    def load_commands(self):
+        """Return the StageCommands of this stage in sorted order.
+
+        Entries with an empty command are skipped, and dependencies on them
+        are dropped.  Raises ValueError on unknown or circular dependencies.
+        """
+        commands = []
+        skipped = set()
+        previous = None
         for cmdname in sorted(self.commands.keys()):
-            cmd = self.commands[cmdname]
-            if not cmd:
+            command = StageCommand(cmdname, self.commands[cmdname], previous)
+            if not command.cmd:
+                skipped.add(cmdname)
                 continue
-            cur_res = events.ReportEventStack(
-                name=cmdname, description="running '%s'" % ' '.join(cmd),
-                parent=self.reportstack, level="DEBUG")
-
-            env = self.env.copy()
-            env['CURTIN_REPORTSTACK'] = cur_res.fullname
+            commands.append(command)
+            previous = cmdname
+
+        names = set(c.name for c in commands)
+        for command in commands:
+            command.depends.difference_update(skipped)
+            unknown = command.depends - names
+            if unknown:
+                raise ValueError(
+                    "%s_commands entry '%s' depends on unknown entries: %s" %
+                    (self.name, command.name, ', '.join(sorted(unknown))))
+
+        done = set()
+        remaining = list(commands)
+        while remaining:
+            ready = [c for c in remaining if c.depends.issubset(done)]
+            if not ready:
+                raise ValueError(
+                    "%s_commands has circular dependencies between: %s" %
+                    (self.name, ', '.join(c.name for c in remaining)))
+            done.update(c.name for c in ready)
+            remaining = [c for c in remaining if c not in ready]
+
+        # label output lines when commands may run next to each other
+        if any(c.explicit_depends for c in commands):
+            for command in commands:
+                command.prefix = ("[%s] " % command.name).encode()
+        return commands
+
+    def _emit(self, command, data):
+        """Write data from command, labelling each line if required."""
+        if command.prefix:
+            lines = data.splitlines(True)
+            if not command.at_bol:
+                data = lines.pop(0)
+            else:
+                data = b""
+            data += b"".join(command.prefix + line for line in lines)
+            command.at_bol = data.endswith(b"\n")
+        self.write(data)
+
+    def _output(self, command, data):
+        """Handle a chunk of output from command.
+
+        Output is written a line at a time where possible, and the last
+        STAGE_OUTPUT_TAIL bytes are kept for error reporting.
+        """
+        command.tail += data
+        if len(command.tail) > 2 * STAGE_OUTPUT_TAIL:
+            del command.tail[:-STAGE_OUTPUT_TAIL]
+        command.pending += data
+        eol = command.pending.rfind(b"\n")
+        if eol != -1:
+            self._emit(command, command.pending[:eol + 1])
+            command.pending = command.pending[eol + 1:]
+        elif len(command.pending) >= STAGE_READ_SIZE:
+            self._flush(command)
+
+    def _flush(self, command):
+        """Write out any partial line held for command."""
+        if command.pending:
+            self._emit(command, command.pending)
+            command.pending = b""
+
+    def _start(self, command):
+        """Start command, returning the file descriptor of its output."""
+        cmd = command.cmd
+        command.reportstack = events.ReportEventStack(
+            name=command.name, description="running '%s'" % ' '.join(cmd),
+            parent=self.reportstack, level="DEBUG")
+        env = self.env.copy()
+        env['CURTIN_REPORTSTACK'] = command.reportstack.fullname
+        command.timer = util.LogTimer(LOG.debug, command.name)
+        command.timer.__enter__()
+        command.reportstack.__enter__()
+
+        shell = not isinstance(cmd, list)
+        try:
+            command.sp = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                env=env, shell=shell)
+        except OSError as e:
+            LOG.warn("%s command failed", command.name)
+            self._finish(command,
+                         util.ProcessExecutionError(cmd=cmd, reason=e))
+        return command.sp.stdout.fileno()
+
+    def _finish(self, command, error=None):
+        """Collect the exit status of command and close its report.
+
+        Raises ProcessExecutionError if the command failed."""
+        if command.sp and error is None:
+            self._flush(command)
+            command.sp.stdout.close()
+            rc = command.sp.wait()
+            if rc != 0:
+                LOG.warn("%s command failed", command.name)
+                tail = command.tail
+                if len(tail) > STAGE_OUTPUT_TAIL:
+                    del tail[:-STAGE_OUTPUT_TAIL]
+                    # do not start the tail in the middle of a (multibyte)
+                    # line
+                    del tail[:tail.find(b"\n") + 1]
+                error = util.ProcessExecutionError(
+                    stdout=bytes(tail), stderr="", exit_code=rc,
+                    cmd=command.cmd)
+        if error is not None:
+            exc_info = (type(error), error, None)
+        else:
+            exc_info = (None, None, None)
+        command.reportstack.__exit__(*exc_info)
+        command.timer.__exit__(*exc_info)
+        if error is not None:
+            raise error
 
-            shell = not isinstance(cmd, list)
-            with util.LogTimer(LOG.debug, cmdname):
-                with cur_res:
+    def run(self):
+        """Run the stage commands on a pool of up to self.jobs workers.
+
+        A command is started once all of its dependencies have finished.
+        After a failure no more commands are started; those already
+        running are waited for and the first failure is raised.
+        """
+        waiting = self.load_commands()
+        done = set()
+        failure = None
+        with selectors.DefaultSelector() as sel:
+            while True:
+                running = len(sel.get_map())
+                while failure is None and running < self.jobs:
+                    ready = [c for c in waiting if c.depends.issubset(done)]
+                    if not ready:
+                        break
+                    command = ready[0]
+                    waiting.remove(command)
+                    try:
+                        fd = self._start(command)
+                    except util.ProcessExecutionError as e:
+                        failure = e
+                        break
+                    sel.register(fd, selectors.EVENT_READ, command)
+                    running += 1
+                if not running:
+                    break
+
+                ready_fds = sel.select(timeout=STAGE_FLUSH_TIMEOUT)
+                if not ready_fds:
+                    # commands are quiet, show any partial lines we hold
+                    for key in list(sel.get_map().values()):
+                        self._flush(key.data)
+                    continue
+                for key, _mask in ready_fds:
+                    command = key.data
+                    data = os.read(key.fd, STAGE_READ_SIZE)
+                    if data:
+                        self._output(command, data)
+                        continue
+                    sel.unregister(key.fd)
                     try:
-                        sp = subprocess.Popen(
-                            cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            env=env, shell=shell)
-                    except OSError as e:
-                        LOG.warn("%s command failed", cmdname)
-                        raise util.ProcessExecutionError(cmd=cmd, reason=e)
-
-                    output = b""
-                    while True:
-                        data = sp.stdout.read(1)
-                        if not data and sp.poll() is not None:
-                            break
-                        self.write(data)
-                        output += data
-
-                    rc = sp.returncode
-                    if rc != 0:
-                        LOG.warn("%s command failed", cmdname)
-                        raise util.ProcessExecutionError(
-                            stdout=output, stderr="",
-                            exit_code=rc, cmd=cmd)
+                        self._finish(command)
+                    except util.ProcessExecutionError as e:
+                        if failure is None:
+                            failure = e
+                    else:
+                        done.add(command.name)
+        if failure is not None:
+            raise failure
 
 
 def apply_power_state(pstate):
@@ -371,6 +565,64 @@ def apply_kexec(kexec, target):
         return True
 
 
+def _prefetch_images(sources):
+    """Yield (url, source) of the remote images of sources.
+
+    dd-* images are left out, block-meta streams those straight to the
+    disk, which overlaps the download with writing and does not stage the
+    whole image in the working directory."""
+    if isinstance(sources, dict):
+        sources = [sources[k] for k in sorted(sources.keys())]
+    for source in sources:
+        source = util.sanitize_source(source)
+        uri = source['uri']
+        if url_helper.urlparse(uri).scheme not in ('http', 'https', 'ftp'):
+            continue
+        if source['type'] == 'fsimage-layered':
+            for url in _get_image_stack(uri):
+                yield url, source
+        elif source['type'] == 'fsimage':
+            yield uri, source
+
+
+def get_prefetch_urls(sources):
+    """Return the remote image urls of sources to download in advance."""
+    return [url for url, _source in _prefetch_images(sources)]
+
+
+def get_prefetch_checksums(sources):
+    """Return a dict of the prefetch urls of sources to the Checksum to
+    verify their download with."""
+    checksums = {}
+    for url, source in _prefetch_images(sources):
+        try:
+            checksum = source_checksum(source, url)
+        except Exception as e:
+            # extract reports this once it handles the source itself
+            LOG.warning("No checksum for prefetch of %s: %s", url, e)
+            continue
+        if checksum:
+            checksums[url] = checksum
+    return checksums
+
+
+def start_prefetch(cfg, workingd):
+    """Start downloading image sources into the working directory, so
+    that they are ready by the time the extract stage needs them."""
+    if not cfg.get('install', {}).get('prefetch', True):
+        return None
+    sources = cfg.get('sources', {})
+    urls = get_prefetch_urls(sources)
+    if not urls:
+        return None
+    prefetcher = prefetch.Prefetcher(
+        urls, os.path.join(workingd.scratch, prefetch.PREFETCH_SUBDIR),
+        cache=image_cache.ImageCache.from_config(cfg.get('image_cache')),
+        checksums=get_prefetch_checksums(sources))
+    prefetcher.start()
+    return prefetcher
+
+
 def migrate_proxy_settings(cfg):
     """Move the legacy proxy setting 'http_proxy' into cfg['proxy']."""
     proxy = cfg.get('proxy', {})
@@ -439,11 +691,13 @@ def cmd_install(args):
     writeline_and_stdout(logfile, INSTALL_START_MSG)
     args.reportstack.post_files = post_files
     workingd = None
+    prefetcher = None
     try:
         workingd = WorkingDir(cfg)
         dd_images = util.get_dd_images(cfg.get('sources', {}))
         if len(dd_images) > 1:
             raise ValueError("You may not use more than one disk image")
+        prefetcher = start_prefetch(cfg, workingd)
 
         LOG.debug(workingd.env())
         env = os.environ.copy()
@@ -460,7 +714,8 @@ def cmd_install(args):
                 commands_name = '%s_commands' % name
                 with util.LogTimer(LOG.debug, 'stage_%s' % name):
                     stage = Stage(name, cfg.get(commands_name, {}), env,
-                                  reportstack=reportstack, logfile=logfile)
+                                  reportstack=reportstack, logfile=logfile,
+                                  jobs=instcfg.get('stage_jobs'))
                     stage.run()
 
         if apply_kexec(cfg.get('kexec'), workingd.target):
@@ -478,6 +733,8 @@ def cmd_install(args):
             create_log_tarfile(error_tarfile, cfg)
         raise e
     finally:
+        if prefetcher:
+            prefetcher.stop()
         log_target_path = instcfg.get('save_install_log', SAVE_INSTALL_LOG)
         if log_target_path and workingd:
             copy_install_log(logfile, workingd.target, log_target_path)
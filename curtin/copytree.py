@@ -0,0 +1,290 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Copy a directory tree into a target directory.
+
+This is used in place of 'rsync -aXHAS --one-file-system' when copying a
+root filesystem into the install target.  The source is walked once, and
+regular files are copied on a pool of worker threads using
+copy_file_range(2) or sendfile(2).  Hardlinks, extended attributes (and so
+POSIX ACLs), sparse files and numeric ownership are preserved.  Like
+rsync, the target may already hold files: existing directories are kept
+and only get the metadata of the source, anything else is replaced.
+"""
+
+from concurrent import futures
+import errno
+import os
+import stat
+import threading
+import time
+
+from curtin.log import LOG
+
+# number of files copied at once by default
+COPY_JOBS = 16
+# chunk size for copy_file_range, sendfile and read/write
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# block size used to find runs of zeroes in sparse files
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+# errors from copy_file_range or sendfile that mean 'try something else'
+_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                    errno.EOPNOTSUPP, errno.EBADF)
+
+
+class CopyStats(object):
+    """Counters for a copy_tree run, safe to update from worker threads."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def add_file(self, nbytes):
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    @property
+    def rate(self):
+        """Bytes per second copied."""
+        if not self.elapsed:
+            return 0
+        return self.bytes / self.elapsed
+
+    def __str__(self):
+        return ("%d files, %d bytes in %.3f seconds (%.1f MiB/s)" %
+                (self.files, self.bytes, self.elapsed,
+                 self.rate / (1024 * 1024)))
+
+
+def _copy_xattrs(src, dst):
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTSUP):
+            return
+        raise
+    for name in names:
+        value = os.getxattr(src, name, follow_symlinks=False)
+        os.setxattr(dst, name, value, follow_symlinks=False)
+
+
+def _copy_metadata(src, dst, st):
+    """Apply ownership, xattrs, mode and times of src (stat st) to dst."""
+    is_link = stat.S_ISLNK(st.st_mode)
+    # chown drops setuid bits and file capabilities, so it comes first
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    _copy_xattrs(src, dst)
+    if not is_link:
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """Copy count bytes at offset from src_fd to the same offset of dst_fd."""
+    end = offset + count
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                done = os.copy_file_range(
+                    src_fd, dst_fd, min(COPY_CHUNK_SIZE, end - offset),
+                    offset, offset)
+                if done == 0:
+                    return
+                offset += done
+            return
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    try:
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        while offset < end:
+            done = os.sendfile(dst_fd, src_fd, offset,
+                               min(COPY_CHUNK_SIZE, end - offset))
+            if done == 0:
+                return
+            offset += done
+        return
+    except OSError as e:
+        if e.errno not in _FALLBACK_ERRNOS:
+            raise
+    while offset < end:
+        data = os.pread(src_fd, min(COPY_CHUNK_SIZE, end - offset), offset)
+        if not data:
+            return
+        os.pwrite(dst_fd, data, offset)
+        offset += len(data)
+
+
+def _data_segments(fd, size):
+    """Yield (offset, length) of the data regions of a sparse file."""
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # nothing but a hole up to the end of the file
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            # SEEK_DATA is not supported, treat the rest as data
+            yield offset, size - offset
+            return
+        hole = os.lseek(fd, data, os.SEEK_HOLE)
+        yield data, hole - data
+        offset = hole
+
+
+def _copy_sparse(src_fd, dst_fd, size):
+    """Copy the data regions of src_fd, leaving zero blocks as holes."""
+    zeroes = bytes(SPARSE_BLOCK_SIZE)
+    for offset, length in _data_segments(src_fd, size):
+        end = offset + length
+        while offset < end:
+            data = os.pread(src_fd, min(COPY_CHUNK_SIZE, end - offset),
+                            offset)
+            if not data:
+                break
+            for pos in range(0, len(data), SPARSE_BLOCK_SIZE):
+                block = data[pos:pos + SPARSE_BLOCK_SIZE]
+                if block != zeroes[:len(block)]:
+                    os.pwrite(dst_fd, block, offset + pos)
+            offset += len(data)
+
+
+def _remove_existing(dst):
+    """Remove what is at dst so a new file can be created there.  Like
+    rsync, a non-empty directory is not removed."""
+    try:
+        st = os.lstat(dst)
+    except FileNotFoundError:
+        return
+    if stat.S_ISDIR(st.st_mode):
+        os.rmdir(dst)
+    else:
+        os.unlink(dst)
+
+
+def _make_dir(dst):
+    """Create directory dst, reusing a directory already there."""
+    try:
+        if stat.S_ISDIR(os.lstat(dst).st_mode):
+            return
+    except FileNotFoundError:
+        pass
+    else:
+        _remove_existing(dst)
+    os.mkdir(dst, 0o700)
+
+
+def _copy_file(src, dst, st, stats):
+    """Copy regular file src (with stat st) to dst, replacing dst."""
+    src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        _remove_existing(dst)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if st.st_size:
+                if st.st_blocks * 512 < st.st_size:
+                    _copy_sparse(src_fd, dst_fd, st.st_size)
+                else:
+                    _copy_range(src_fd, dst_fd, 0, st.st_size)
+            os.ftruncate(dst_fd, st.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    _copy_metadata(src, dst, st)
+    stats.add_file(st.st_size)
+
+
+def _walk(source):
+    """Yield (relative path, lstat) for everything below source.
+
+    Parents are yielded before their contents.  Like rsync's
+    --one-file-system, mount points are yielded but not descended into.
+    """
+    root_dev = os.lstat(source).st_dev
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        for entry in os.scandir(os.path.join(source, reldir)):
+            relpath = os.path.join(reldir, entry.name)
+            st = entry.stat(follow_symlinks=False)
+            yield relpath, st
+            if stat.S_ISDIR(st.st_mode) and st.st_dev == root_dev:
+                stack.append(relpath)
+
+
+def copy_tree(source, target, jobs=None):
+    """Copy the contents of directory source into directory target.
+
+    target is created if needed.  Directories already in target are
+    reused, files already in target are replaced.  Returns a CopyStats of
+    the copy."""
+    if jobs is None:
+        jobs = COPY_JOBS
+    stats = CopyStats()
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    dirs = [('', os.lstat(source))]
+    hardlinks = []
+    inodes = {}
+    pending = []
+    with futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        try:
+            for relpath, st in _walk(source):
+                src = os.path.join(source, relpath)
+                dst = os.path.join(target, relpath)
+                mode = st.st_mode
+                if stat.S_ISDIR(mode):
+                    _make_dir(dst)
+                    dirs.append((relpath, st))
+                    continue
+                if st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    if key in inodes:
+                        hardlinks.append((inodes[key], relpath))
+                        continue
+                    inodes[key] = relpath
+                if stat.S_ISREG(mode):
+                    pending.append(
+                        pool.submit(_copy_file, src, dst, st, stats))
+                    continue
+                _remove_existing(dst)
+                if stat.S_ISLNK(mode):
+                    os.symlink(os.readlink(src), dst)
+                else:
+                    os.mknod(dst, mode, st.st_rdev)
+                _copy_metadata(src, dst, st)
+                stats.add_file(0)
+        finally:
+            # wait on everything submitted, then raise the first error
+            for future in futures.as_completed(pending):
+                future.result()
+
+    for first, relpath in hardlinks:
+        dst = os.path.join(target, relpath)
+        _remove_existing(dst)
+        os.link(os.path.join(target, first), dst)
+        stats.add_file(0)
+
+    # directory times change as their contents are created, so apply
+    # directory metadata last, deepest first
+    for relpath, st in reversed(dirs):
+        _copy_metadata(os.path.join(source, relpath),
+                       os.path.join(target, relpath), st)
+
+    stats.finish()
+    LOG.debug("copied %s to %s: %s", source, target, stats)
+    return stats
+
+# vi: ts=4 expandtab syntax=python
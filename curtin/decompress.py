@@ -0,0 +1,169 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Decompress image streams, on all cores when the tools allow it.
+
+The python gzip, bz2 and lzma modules decompress on a single core.  When a
+multi-threaded decompressor is installed the stream is piped through it
+instead.  zstd has no python module, so zstd streams need the zstd tool.
+helpers/smtar makes the same choice for tarballs extracted by tar.
+"""
+
+import bz2
+import gzip
+import lzma
+import subprocess
+import threading
+
+from curtin.log import LOG
+from curtin import util
+
+# external decompressors reading stdin and writing stdout, best first
+DECOMPRESSORS = {
+    'gz': (['pigz', '-dc'],),
+    'bz2': (['pbzip2', '-dc'], ['lbzip2', '-dc']),
+    'xz': (['pixz', '-d'], ['xz', '-T0', '-dc']),
+    'zst': (['zstd', '-T0', '-dc'],),
+}
+
+_MODULES = {
+    'gz': lambda fp: gzip.GzipFile(fileobj=fp, mode='rb'),
+    'bz2': bz2.BZ2File,
+    'xz': lzma.LZMAFile,
+}
+
+_MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+)
+
+# size of writes to an external decompressor
+FEED_BUFLEN = 1024 * 1024
+
+
+def find_decompressor(compression):
+    """Return the command of the preferred external decompressor for
+    compression, or None if none is installed."""
+    for cmd in DECOMPRESSORS.get(compression, ()):
+        if util.which(cmd[0]):
+            return cmd
+    return None
+
+
+class _PrefixReader(object):
+    """File-like object returning prefix before the rest of fp."""
+
+    def __init__(self, prefix, fp):
+        self.prefix = prefix
+        self.fp = fp
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fp.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.fp.read()
+            self.prefix = b''
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        return data
+
+    def close(self):
+        # fp belongs to the caller
+        pass
+
+
+def detect(fp):
+    """Detect the compression of the stream fp from its magic bytes.
+
+    Returns (compression, fp) where compression is a key of DECOMPRESSORS
+    or None for uncompressed data, and fp still returns the full stream."""
+    prefix = b''
+    while len(prefix) < 6:
+        data = fp.read(6 - len(prefix))
+        if not data:
+            break
+        prefix += data
+    for magic, compression in _MAGIC:
+        if prefix.startswith(magic):
+            return compression, _PrefixReader(prefix, fp)
+    return None, _PrefixReader(prefix, fp)
+
+
+class ProcessReader(object):
+    """Read the output of cmd run with the data read from fp as input.
+
+    fp is read on a thread feeding the process, so reading from fp and
+    decompressing happen in parallel.  A failure of either is raised when
+    the end of the output is reached."""
+
+    def __init__(self, fp, cmd):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self._error = None
+        self._thread = threading.Thread(target=self._feed, args=(fp,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _feed(self, fp):
+        try:
+            while True:
+                data = fp.read(FEED_BUFLEN)
+                if not data:
+                    break
+                self.proc.stdin.write(data)
+        except BrokenPipeError:
+            # the process exited early, its exit code tells why
+            pass
+        except Exception as e:
+            self._error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data:
+            self._finish()
+        return data
+
+    def _finish(self):
+        self._thread.join()
+        rc = self.proc.wait()
+        if self._error:
+            raise self._error
+        if rc != 0:
+            raise util.ProcessExecutionError(cmd=self.cmd, exit_code=rc)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self._thread.join()
+
+
+def open_decompressed(fp, compression):
+    """Return a file-like object reading the data of fp decompressed.
+
+    compression is a key of DECOMPRESSORS, None for data that is not
+    compressed, or 'auto' to detect it."""
+    if compression == 'auto':
+        compression, fp = detect(fp)
+    if compression is None:
+        return fp
+    cmd = find_decompressor(compression)
+    if cmd:
+        LOG.debug("decompressing %s stream with %s", compression,
+                  ' '.join(cmd))
+        return ProcessReader(fp, cmd)
+    if compression in _MODULES:
+        return _MODULES[compression](fp)
+    raise ValueError("no decompressor for %s data, install %s" %
+                     (compression, DECOMPRESSORS[compression][0][0]))
+
+# vi: ts=4 expandtab syntax=python
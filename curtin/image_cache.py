@@ -0,0 +1,159 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Content-addressed on-disk cache of downloaded install images.
+
+Entries are keyed by the checksum of the image when the source gives one,
+otherwise by the url together with the ETag or Last-Modified header the
+server returns for it.  Urls whose server provides neither are never
+cached.  The least recently used entries are evicted once the cache grows
+beyond its byte budget, except for entries returned by fetch and not yet
+released, which another thread may still be reading.
+
+Example config:
+
+  image_cache:
+    path: /var/cache/curtin/images
+    max_size: 20G
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from curtin.log import LOG
+from curtin import url_helper
+from curtin import util
+
+DEFAULT_MAX_SIZE = 10 * 2 ** 30
+
+
+class ImageCache(object):
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = os.path.abspath(path)
+        self.max_size = int(util.human2bytes(max_size))
+        self.hits = 0
+        self.misses = 0
+        # path of each entry handed out by fetch to its number of users
+        self._in_use = {}
+        self._lock = threading.Lock()
+        util.ensure_dir(self.path)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Return an ImageCache for the 'image_cache' config, or None if
+        the cache is not configured."""
+        if not cfg or not cfg.get('path'):
+            return None
+        return cls(cfg['path'], cfg.get('max_size', DEFAULT_MAX_SIZE))
+
+    def key(self, url, checksum=None):
+        """Return the cache key for url, or None if it cannot be cached."""
+        if checksum:
+            return checksum.key
+        if url_helper.urlparse(url).scheme not in ('http', 'https', 'ftp'):
+            return None
+        try:
+            headers = url_helper.get_headers(url)
+        except url_helper.UrlError as e:
+            LOG.debug("image cache: could not query %s: %s", url, e)
+            return None
+        validator = headers.get('etag') or headers.get('last-modified')
+        if not validator:
+            return None
+        ident = '%s\n%s' % (url, validator)
+        return 'url-%s' % hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+    def _entries(self):
+        """Return (mtime, size, path) of cached images, oldest first."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self, reserve=0):
+        """Remove least recently used images until the cache holds at
+        most max_size - reserve bytes.  Images in use are kept."""
+        with self._lock:
+            self._evict(reserve)
+
+    def _evict(self, reserve):
+        entries = self._entries()
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if total + reserve <= self.max_size:
+                break
+            if path in self._in_use:
+                continue
+            LOG.debug("image cache: evicting %s", path)
+            os.unlink(path)
+            total -= size
+
+    def _use(self, path):
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+
+    def fetch(self, url, checksum=None, download=None):
+        """Return a local path holding the content of url.
+
+        The cached copy is used when present, otherwise url is downloaded
+        into the cache and verified against checksum, if given.  Images
+        that cannot be cached are downloaded to a temporary file, so
+        callers should pass the returned path to release once done with
+        it."""
+        if download is None:
+            download = url_helper.download
+        key = self.key(url, checksum)
+        if key:
+            path = os.path.join(self.path, key)
+            with self._lock:
+                if os.path.exists(path):
+                    self.hits += 1
+                    LOG.info("image cache: using cached %s for %s", path,
+                             url)
+                    # mark as recently used
+                    os.utime(path, None)
+                    self._use(path)
+                    return path
+        self.misses += 1
+        LOG.info("image cache: miss for %s", url)
+
+        fd, tmp = tempfile.mkstemp(prefix='.download-', dir=self.path)
+        os.close(fd)
+        try:
+            download(url, tmp, retries=3, checksum=checksum)
+            if not key:
+                return tmp
+            with self._lock:
+                self._evict(os.path.getsize(tmp))
+                os.rename(tmp, path)
+                self._use(path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return path
+
+    def is_cached(self, path):
+        """Return True if path is an entry of this cache."""
+        return (os.path.dirname(path) == self.path and
+                not os.path.basename(path).startswith('.'))
+
+    def release(self, path):
+        """Mark path from fetch as no longer in use, removing it if it is
+        an uncached download."""
+        if self.is_cached(path):
+            with self._lock:
+                count = self._in_use.pop(path, 0) - 1
+                if count > 0:
+                    self._in_use[path] = count
+        elif os.path.exists(path):
+            os.unlink(path)
+
+# vi: ts=4 expandtab syntax=python
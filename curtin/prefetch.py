@@ -0,0 +1,230 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Download install images in the background while other stages run.
+
+'curtin install' starts a Prefetcher for the remote images of its sources
+before the first stage, so that downloads overlap with partitioning.  The
+images are staged in a directory below WORKING_DIR, where the extract
+command (which runs as a separate process) looks them up with
+get_prefetched.  For every url there is one of:
+
+  <key>.partial   download queued or in progress, holds the pid of the
+                  install and is touched while the download makes progress
+  <key>           download complete
+  <key>.failed    download failed or skipped, callers fetch url themselves
+"""
+
+import errno
+import functools
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from curtin.log import LOG
+from curtin import url_helper
+from curtin import util
+
+PREFETCH_SUBDIR = 'prefetch'
+# number of images downloaded at once
+PREFETCH_JOBS = 2
+# seconds between checks for an in-flight download to complete
+PREFETCH_POLL_INTERVAL = 0.5
+# fraction of free space in the prefetch directory an image may use
+PREFETCH_MAX_FREE_FRACTION = 0.9
+# seconds an in-flight download may go without progress before callers
+# give up on it and download the url themselves
+PREFETCH_STALL_TIMEOUT = 120
+# seconds between touches of <key>.partial by a running download
+PREFETCH_HEARTBEAT_INTERVAL = 1
+
+
+def _key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def get_prefetch_dir():
+    """Return the prefetch directory of the current install, or None."""
+    scratch = util.load_command_environment().get('scratch')
+    if not scratch:
+        return None
+    return os.path.join(scratch, PREFETCH_SUBDIR)
+
+
+def _owner_alive(partial):
+    """Return False if the install that wrote partial is gone."""
+    try:
+        with open(partial) as fp:
+            pid = int(fp.read().strip())
+    except (IOError, OSError, ValueError):
+        # removed meanwhile, or still being written
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _stalled(partial):
+    """Return True if the download of partial made no progress lately."""
+    try:
+        mtime = os.stat(partial).st_mtime
+    except OSError:
+        return False
+    return time.time() - mtime > PREFETCH_STALL_TIMEOUT
+
+
+def get_prefetched(url, prefetch_dir=None):
+    """Return a local path with the content of url if it was prefetched.
+
+    If the download of url is still in flight this waits for it to
+    complete.  Returns None if url was not prefetched, its download
+    failed, or it stalled for PREFETCH_STALL_TIMEOUT seconds or its
+    install is gone."""
+    if prefetch_dir is None:
+        prefetch_dir = get_prefetch_dir()
+    if not prefetch_dir:
+        return None
+    path = os.path.join(prefetch_dir, _key(url))
+    partial = path + '.partial'
+    if not os.path.exists(partial) and not os.path.exists(path):
+        return None
+    waited = False
+    while True:
+        if os.path.exists(path):
+            LOG.info("Using prefetched %s for %s", path, url)
+            return path
+        if not os.path.exists(partial):
+            LOG.debug("Prefetch of %s failed, fetching it directly", url)
+            return None
+        if _stalled(partial) or not _owner_alive(partial):
+            LOG.warning("Prefetch of %s is stalled, fetching it directly",
+                        url)
+            return None
+        if not waited:
+            LOG.info("Waiting for in-flight download of %s", url)
+            waited = True
+        time.sleep(PREFETCH_POLL_INTERVAL)
+
+
+class _PrefetchStopped(Exception):
+    pass
+
+
+class Prefetcher(object):
+    """Download urls into prefetch_dir on background threads.
+
+    checksums optionally maps urls to the Checksum their download is
+    verified against."""
+
+    def __init__(self, urls, prefetch_dir, cache=None, jobs=None,
+                 checksums=None):
+        self.urls = []
+        for url in urls:
+            if url not in self.urls:
+                self.urls.append(url)
+        self.prefetch_dir = prefetch_dir
+        self.cache = cache
+        self.checksums = checksums or {}
+        if jobs is None:
+            jobs = PREFETCH_JOBS
+        self.jobs = max(1, jobs)
+        self._queue = list(self.urls)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._heartbeats = {}
+
+    def _path(self, url):
+        return os.path.join(self.prefetch_dir, _key(url))
+
+    def _fits(self, url):
+        """Return False if url is known to be too big to stage."""
+        try:
+            size = int(url_helper.get_headers(url).get('content-length'))
+        except (url_helper.UrlError, TypeError, ValueError):
+            return True
+        free = util.get_fs_use_info(self.prefetch_dir)[1]
+        return size <= free * PREFETCH_MAX_FREE_FRACTION
+
+    def _progress(self, partial, *args):
+        """reporthook of the downloads, stops them once stop is called and
+        tells get_prefetched that they are alive."""
+        if self._stopped.is_set():
+            raise _PrefetchStopped("prefetch stopped")
+        now = time.time()
+        last = self._heartbeats.get(partial, 0)
+        if now - last >= PREFETCH_HEARTBEAT_INTERVAL:
+            self._heartbeats[partial] = now
+            os.utime(partial, None)
+
+    def _fetch(self, url):
+        path = self._path(url)
+        checksum = self.checksums.get(url)
+        download = functools.partial(
+            url_helper.download,
+            reporthook=functools.partial(self._progress, path + '.partial'))
+        if self.cache:
+            cached = self.cache.fetch(url, checksum=checksum,
+                                      download=download)
+            if self.cache.is_cached(cached):
+                os.symlink(cached, path)
+                self.cache.release(cached)
+            else:
+                shutil.move(cached, path)
+            return
+        if not self._fits(url):
+            raise ValueError("not enough space in %s" % self.prefetch_dir)
+        tmp = path + '.download'
+        try:
+            download(url, tmp, retries=3, checksum=checksum)
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return
+                url = self._queue.pop(0)
+            start = time.time()
+            try:
+                self._fetch(url)
+            except Exception as e:
+                LOG.warning("Prefetch of %s failed: %s", url, e)
+                util.write_file(self._path(url) + '.failed', str(e))
+            else:
+                LOG.debug("Prefetched %s in %.3f seconds", url,
+                          time.time() - start)
+            os.unlink(self._path(url) + '.partial')
+
+    def start(self):
+        """Mark all urls as in flight and start downloading them."""
+        if not self.urls:
+            return
+        util.ensure_dir(self.prefetch_dir)
+        for url in self.urls:
+            util.write_file(self._path(url) + '.partial', str(os.getpid()))
+        LOG.info("Prefetching %s", ', '.join(self.urls))
+        for _ in range(min(self.jobs, len(self.urls))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Cancel queued and running downloads and wait for the workers."""
+        self._stopped.set()
+        with self._lock:
+            for url in self._queue:
+                util.write_file(self._path(url) + '.failed', 'cancelled')
+                os.unlink(self._path(url) + '.partial')
+            self._queue = []
+        for thread in self._threads:
+            thread.join()
+
+# vi: ts=4 expandtab syntax=python
@@ -43,22 +43,22 @@ MBR_BOOT_FLAG = '0x80'
 
 PTABLE_TYPE_MAP = dict(GPT_GUID_TO_CURTIN_MAP, **MBR_TYPE_TO_CURTIN_MAP)
 
-StorageConfig = namedtuple('StorageConfig', ('type', 'schema'))
+StorageType = namedtuple('StorageType', ('type', 'schema'))
 STORAGE_CONFIG_TYPES = {
-    'bcache': StorageConfig(type='bcache', schema=schemas.BCACHE),
-    'dasd': StorageConfig(type='dasd', schema=schemas.DASD),
-    'disk': StorageConfig(type='disk', schema=schemas.DISK),
-    'dm_crypt': StorageConfig(type='dm_crypt', schema=schemas.DM_CRYPT),
-    'format': StorageConfig(type='format', schema=schemas.FORMAT),
-    'lvm_partition': StorageConfig(type='lvm_partition',
-                                   schema=schemas.LVM_PARTITION),
-    'lvm_volgroup': StorageConfig(type='lvm_volgroup',
-                                  schema=schemas.LVM_VOLGROUP),
-    'mount': StorageConfig(type='mount', schema=schemas.MOUNT),
-    'partition': StorageConfig(type='partition', schema=schemas.PARTITION),
-    'raid': StorageConfig(type='raid', schema=schemas.RAID),
-    'zfs': StorageConfig(type='zfs', schema=schemas.ZFS),
-    'zpool': StorageConfig(type='zpool', schema=schemas.ZPOOL),
+    'bcache': StorageType(type='bcache', schema=schemas.BCACHE),
+    'dasd': StorageType(type='dasd', schema=schemas.DASD),
+    'disk': StorageType(type='disk', schema=schemas.DISK),
+    'dm_crypt': StorageType(type='dm_crypt', schema=schemas.DM_CRYPT),
+    'format': StorageType(type='format', schema=schemas.FORMAT),
+    'lvm_partition': StorageType(type='lvm_partition',
+                                 schema=schemas.LVM_PARTITION),
+    'lvm_volgroup': StorageType(type='lvm_volgroup',
+                                schema=schemas.LVM_VOLGROUP),
+    'mount': StorageType(type='mount', schema=schemas.MOUNT),
+    'partition': StorageType(type='partition', schema=schemas.PARTITION),
+    'raid': StorageType(type='raid', schema=schemas.RAID),
+    'zfs': StorageType(type='zfs', schema=schemas.ZFS),
+    'zpool': StorageType(type='zpool', schema=schemas.ZPOOL),
 }
 
 
@@ -395,6 +395,151 @@ def extract_storage_ordered_dict(config):
     return OrderedDict((d["id"], d) for d in scfg)
 
 
+class StorageConfig(OrderedDict):
+    """Ordered dict of storage config items by id, indexed for the lookups
+    block-meta makes while configuring every item.
+
+    Partition numbers, the partitions of each device in config order,
+    extended partitions, logical partition counts and the direct
+    dependencies of each item and their reverse are computed in one pass
+    over the items on first use, so each lookup no longer scans the
+    config.  Adding or removing items drops the index, changing the items
+    themselves once it is in use does not.
+
+    volume_paths caches the device paths block-meta resolved for items,
+    see block_meta.get_path_to_storage_volume.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._index = None
+        self.volume_paths = {}
+        super(StorageConfig, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def of(cls, storage_config):
+        """Return storage_config if it is a StorageConfig, else a
+        StorageConfig of its items."""
+        if isinstance(storage_config, cls):
+            return storage_config
+        return cls(storage_config)
+
+    def __setitem__(self, key, value):
+        self._index = None
+        super(StorageConfig, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._index = None
+        super(StorageConfig, self).__delitem__(key)
+
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            index = self._build_index()
+            self._index = index
+        return index
+
+    def _build_index(self):
+        partitions = {}
+        position = {}
+        numbers = {}
+        extended = {}
+        logical = {}
+        depends = {}
+        dependents = {}
+        for item_id, item in self.items():
+            item_type = item.get('type')
+            deps = []
+            if item_type in STORAGE_CONFIG_TYPES:
+                for key in sorted(_stype_to_deps(item_type)):
+                    value = item.get(key)
+                    if not value:
+                        continue
+                    if not isinstance(value, list):
+                        value = [value]
+                    deps.extend(value)
+            depends[item_id] = deps
+            for dep in deps:
+                dependents.setdefault(dep, []).append(item_id)
+
+            if item_type != 'partition':
+                continue
+            device = item.get('device')
+            parts = partitions.setdefault(device, [])
+            number = item.get('number')
+            if item.get('flag') == 'logical':
+                if not number:
+                    number = 5 + logical.get(device, 0)
+                logical[device] = logical.get(device, 0) + 1
+            elif not number:
+                number = 1 + len(parts)
+            if item.get('flag') == 'extended':
+                extended.setdefault(device, item_id)
+            position[item_id] = len(parts)
+            parts.append(item_id)
+            numbers[item_id] = number
+
+        return {'partitions': partitions, 'position': position,
+                'numbers': numbers, 'extended': extended,
+                'logical': logical, 'depends': depends,
+                'dependents': dependents}
+
+    def partitions(self, device):
+        """Return the ids of the partitions of device in config order."""
+        return list(self._get_index()['partitions'].get(device, []))
+
+    def partition_number(self, item_id):
+        """Return the number of partition item_id, from its 'number' key
+        or counted from its position on the device."""
+        number = self._get_index()['numbers'][item_id]
+        if not self[item_id].get('number'):
+            LOG.warn('partition \'number\' key not set in config:\n%s',
+                     util.json_dumps(self[item_id]))
+        return number
+
+    def previous_partition(self, device, item_id):
+        """Return the number of the last partition of device that is not
+        extended and comes before item_id, or None."""
+        index = self._get_index()
+        parts = index['partitions'].get(device, [])
+        end = len(parts)
+        if item_id in index['position'] and self[item_id]['device'] == device:
+            end = index['position'][item_id]
+        for part_id in reversed(parts[:end]):
+            if self[part_id].get('flag') != 'extended':
+                return index['numbers'][part_id]
+        return None
+
+    def extended_partition(self, device):
+        """Return the id of the extended partition of device, or None."""
+        return self._get_index()['extended'].get(device)
+
+    def logical_partitions(self, device):
+        """Return the number of logical partitions of device."""
+        return self._get_index()['logical'].get(device, 0)
+
+    def depends(self, item_id):
+        """Return the ids of the items item_id references directly."""
+        return list(self._get_index()['depends'].get(item_id, []))
+
+    def dependents(self, item_id):
+        """Return the ids of the items referencing item_id directly."""
+        return list(self._get_index()['dependents'].get(item_id, []))
+
+    def all_dependents(self, item_id):
+        """Return the ids of the items built on item_id, directly or
+        through other items."""
+        dependents = self._get_index()['dependents']
+        found = []
+        todo = list(dependents.get(item_id, []))
+        while todo:
+            dep = todo.pop(0)
+            if dep in found:
+                continue
+            found.append(dep)
+            todo.extend(dependents.get(dep, []))
+        return found
+
+
 class ProbertParser(object):
     """ Base class for parsing probert storage configuration.
 
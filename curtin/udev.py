@@ -1,7 +1,12 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
-import shlex
+import errno
 import os
+import select
+import shlex
+import socket
+import struct
+import time
 
 from curtin import util
 from curtin.log import logged_call, LOG
@@ -13,6 +18,20 @@ except AttributeError:
     import pipes
     shlex_quote = pipes.quote
 
+NETLINK_KOBJECT_UEVENT = 15
+# multicast groups of the uevent socket: events as sent by the kernel, and
+# as sent by udevd once it processed them and created the symlinks
+UEVENT_KERNEL_GROUP = 1
+UEVENT_UDEV_GROUP = 2
+UEVENT_RCVBUF = 4 * 1024 * 1024
+# default seconds wait_for and wait_for_removal wait, same as udevadm settle
+UDEV_WAIT_TIMEOUT = 120
+# seconds between checks of the path when no event arrives
+UDEV_WAIT_POLL = 1
+# seconds udevadm_settle(exists=...) waits for the path on uevents before
+# it settles the udev queue instead
+UDEV_SETTLE_EXISTS_WAIT = 1
+
 
 def compose_udev_equality(key, value):
     """Return a udev comparison clause, like `ACTION=="add"`."""
@@ -50,13 +69,126 @@ def generate_udev_rule(interface, mac):
     return '%s\n' % rule
 
 
-@logged_call()
-def udevadm_settle(exists=None, timeout=None):
+def parse_uevent(data):
+    """Return the properties of a uevent message from the kernel or from
+    udevd as a dict."""
+    if data.startswith(b'libudev\0'):
+        # udevd messages have a binary header giving the properties offset
+        offset, length = struct.unpack_from('=II', data, 16)
+        data = data[offset:offset + length]
+    else:
+        # kernel messages start with 'action@devpath'
+        data = data.partition(b'\0')[2]
+    props = {}
+    for field in data.split(b'\0'):
+        key, sep, value = field.decode('utf-8', 'replace').partition('=')
+        if sep:
+            props[key] = value
+    return props
+
+
+class UeventMonitor(object):
+    """Receive the uevents of the kernel and udevd from the netlink
+    socket they are broadcast on."""
+
+    def __init__(self, groups=UEVENT_KERNEL_GROUP | UEVENT_UDEV_GROUP):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                 UEVENT_RCVBUF)
+            self.sock.bind((0, groups))
+        except Exception:
+            self.sock.close()
+            raise
+
+    @classmethod
+    def open(cls):
+        """Return a new UeventMonitor, or None if the uevent socket is not
+        available here, as in some containers."""
+        try:
+            return cls()
+        except (OSError, AttributeError) as e:
+            LOG.debug('uevent socket not available: %s', e)
+            return None
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+    def receive(self, timeout):
+        """Return the list of events received within timeout seconds, each
+        a dict of its properties, empty if none arrived."""
+        events = []
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        while ready:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except (OSError, socket.error) as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                # events were dropped, callers recheck what they wait for
+                if e.errno != errno.ENOBUFS:
+                    raise
+                events.append({})
+                continue
+            events.append(parse_uevent(data))
+        return events
+
+
+def _wait(path, present, timeout):
+    if os.path.exists(path) == present:
+        return True
+    if timeout is None:
+        timeout = UDEV_WAIT_TIMEOUT
+    deadline = time.time() + timeout
+    monitor = UeventMonitor.open()
+    if monitor is None:
+        # no events to wait for, settle the whole queue then poll
+        _udevadm_settle(exists=path if present else None, timeout=timeout)
+    try:
+        # check again now that no event can be missed
+        while os.path.exists(path) != present:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if monitor:
+                monitor.receive(min(remaining, UDEV_WAIT_POLL))
+            else:
+                time.sleep(min(remaining, UDEV_WAIT_POLL))
+    finally:
+        if monitor:
+            monitor.close()
+    return True
+
+
+def wait_for(devpath, timeout=None):
+    """Wait until devpath exists, for up to timeout seconds (default
+    UDEV_WAIT_TIMEOUT).
+
+    The path is checked whenever a uevent arrives, so this returns as soon
+    as the device node or udev symlink is created instead of waiting for
+    the whole udev queue.  Returns True if devpath exists."""
+    LOG.debug('waiting for %s to exist', devpath)
+    return _wait(devpath, True, timeout)
+
+
+def wait_for_removal(devpath, timeout=None):
+    """Wait until devpath no longer exists, like wait_for.
+
+    Returns True if devpath was removed."""
+    LOG.debug('waiting for %s to be removed', devpath)
+    return _wait(devpath, False, timeout)
+
+
+def _udevadm_settle(exists=None, timeout=None):
     settle_cmd = ["udevadm", "settle"]
     if exists:
-        # skip the settle if the requested path already exists
-        if os.path.exists(exists):
-            return
         settle_cmd.extend(['--exit-if-exists=%s' % exists])
     if timeout:
         settle_cmd.extend(['--timeout=%s' % timeout])
@@ -64,6 +196,28 @@ def udevadm_settle(exists=None, timeout=None):
     util.subp(settle_cmd)
 
 
+@logged_call()
+def udevadm_settle(exists=None, timeout=None):
+    """Wait for udev to process all queued events, or with exists, only
+    until that path exists or the queue is empty, like 'udevadm settle
+    --exit-if-exists'.
+
+    With exists the path is first waited for on uevents for up to
+    UDEV_SETTLE_EXISTS_WAIT seconds, which usually sees it created well
+    before the whole queue is processed."""
+    if exists:
+        # skip the settle if the requested path already exists
+        if os.path.exists(exists):
+            return
+        wait = UDEV_SETTLE_EXISTS_WAIT
+        if timeout:
+            wait = min(wait, timeout)
+        if wait_for(exists, timeout=wait):
+            return
+
+    _udevadm_settle(exists=exists, timeout=timeout)
+
+
 def udevadm_trigger(devices):
     if devices is None:
         devices = []
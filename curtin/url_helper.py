@@ -1,10 +1,13 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from email.utils import parsedate
+from concurrent import futures
 import json
 import os
+import re
 import socket
 import sys
+import threading
 import time
 import uuid
 from functools import partial
@@ -29,6 +32,15 @@ error = urllib_error
 
 DEFAULT_HEADERS = {'User-Agent': 'Curtin/' + version.version_string()}
 
+# read size for downloads
+DOWNLOAD_BUFLEN = 1024 * 1024
+# maximum number of concurrent Range requests per download, and the
+# smallest segment worth a request of its own
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_MIN_SEGMENT = 16 * 1024 * 1024
+# times a streamed read resumes after a failure, like wget's --tries
+STREAM_RETRIES = 20
+
 
 class _ReRaisedException(Exception):
     exc = None
@@ -56,6 +68,7 @@ class UrlReader(object):
 
         self.info = self.fp.info()
         self.size = self.info.get('content-length', -1)
+        self.status = self.fp.getcode()
 
     def read(self, buflen):
         try:
@@ -82,51 +95,297 @@ class UrlReader(object):
         self.close()
 
 
-def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3):
-    """Download url to path.
+def _retryable(exc):
+    """Return True if UrlError exc may go away when retried."""
+    return exc.code is None or exc.code >= 500
 
-    reporthook is compatible with py3 urllib.request.urlretrieve.
-    urlretrieve does not exist in py2."""
 
-    buflen = 8192
-    attempts = 0
+class ResumingUrlReader(object):
+    """Read url like UrlReader, resuming with a Range request from the
+    last byte read when the transfer fails, like wget does.
 
-    while True:
-        wfp = open(path, "wb")
+    Only http and https transfers are resumed."""
+
+    def __init__(self, url, headers=None, retries=None, retry_delay=3):
+        if retries is None:
+            retries = STREAM_RETRIES
+        if urlparse(url).scheme not in ('http', 'https'):
+            retries = 0
+        self.url = url
+        self.headers = headers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.attempts = 0
+        self.pos = 0
+        self.rfp = None
+        while self.rfp is None:
+            try:
+                self.rfp = UrlReader(url, headers=headers)
+            except UrlError as e:
+                self._retry(e)
+        self.info = self.rfp.info
+        self.size = self.rfp.size
+        self.status = self.rfp.status
         try:
-            buf = None
-            blocknum = 0
-            fsize = 0
-            start = time.time()
-            with UrlReader(url) as rfp:
-                if reporthook:
-                    reporthook(blocknum, buflen, rfp.size)
-
-                while True:
-                    buf = rfp.read(buflen)
+            self.length = int(self.size)
+        except (TypeError, ValueError):
+            self.length = -1
+
+    def _resume(self):
+        headers = dict(self.headers or {})
+        if self.length >= 0:
+            headers['Range'] = 'bytes=%d-%d' % (self.pos, self.length - 1)
+        else:
+            headers['Range'] = 'bytes=%d-' % self.pos
+        rfp = UrlReader(self.url, headers=headers)
+        if rfp.status != 206:
+            rfp.close()
+            raise RangeNotSatisfied(self.url, rfp.status)
+        self.rfp = rfp
+
+    def _retry(self, exc):
+        """Wait before the next attempt, or raise exc if there is none."""
+        if not _retryable(exc) or self.attempts >= self.retries:
+            raise exc
+        self.attempts += 1
+        LOG.debug("Reading %s failed at byte %d: %s. Retrying in %d"
+                  " seconds.", self.url, self.pos, exc, self.retry_delay)
+        self.close()
+        time.sleep(self.retry_delay)
+
+    def read(self, buflen):
+        while True:
+            try:
+                if self.rfp is None:
+                    self._resume()
+                buf = self.rfp.read(buflen)
+                if not buf and 0 <= self.pos < self.length:
+                    raise UrlError("short read", code=None, url=self.url,
+                                   reason="connection closed at byte %d" %
+                                   self.pos)
+                self.pos += len(buf)
+                return buf
+            except UrlError as e:
+                self._retry(e)
+
+    def close(self):
+        if self.rfp:
+            self.rfp.close()
+            self.rfp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+def _download_segment(url, fd, start, end, buflen, retries, retry_delay,
+                      progress):
+    """Download bytes start to end (exclusive) of url to the same offsets
+    of file descriptor fd, resuming from the last byte written on retry."""
+    attempts = 0
+    while start < end:
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        try:
+            with UrlReader(url, headers=headers) as rfp:
+                if rfp.status != 206:
+                    raise RangeNotSatisfied(url, rfp.status)
+                while start < end:
+                    buf = rfp.read(min(buflen, end - start))
                     if not buf:
                         break
-                    blocknum += 1
-                    if reporthook:
-                        reporthook(blocknum, buflen, rfp.size)
-                    wfp.write(buf)
-                    fsize += len(buf)
-            timedelta = time.time() - start
-            LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
-                      fsize, url, path, timedelta,
-                      fsize / timedelta / 1024 / 1024)
-            return path, rfp.info
+                    os.pwrite(fd, buf, start)
+                    start += len(buf)
+                    progress(start)
+            if start < end:
+                raise UrlError("short read", code=None, url=url,
+                               reason="connection closed at byte %d" % start)
         except UrlError as e:
-            # retry on internal server errors up to "retries #"
-            if (e.code < 500 or attempts >= retries):
+            if not _retryable(e) or attempts >= retries:
                 raise e
-            LOG.debug("Current download failed with error: %s. Retrying in"
-                      " %d seconds.",
-                      e.code, retry_delay)
             attempts += 1
+            LOG.debug("Download of %s failed at byte %d: %s. Resuming in %d"
+                      " seconds.", url, start, e, retry_delay)
             time.sleep(retry_delay)
-        finally:
-            wfp.close()
+
+
+def _download_segments(url, path, size, segments, buflen, reporthook,
+                       retries, retry_delay, checksum=None):
+    """Download url of length size to path using segments concurrent
+    HTTP Range requests.
+
+    Segments complete out of order, so checksum is updated by reading back
+    (from the page cache) whatever data just became contiguous with the
+    data already hashed."""
+    lock = threading.Lock()
+    seglen = -(-size // segments)
+    progress = {'blocknum': 0, 'hashed': 0,
+                'ends': dict((offset, offset) for offset in
+                             range(0, size, seglen))}
+
+    def _progress(segment, end):
+        with lock:
+            progress['ends'][segment] = end
+            if checksum:
+                _hash_contiguous()
+            if reporthook:
+                progress['blocknum'] += 1
+                reporthook(progress['blocknum'], buflen, size)
+
+    def _hash_contiguous():
+        hashed = progress['hashed']
+        while hashed < size:
+            segment = hashed - hashed % seglen
+            end = progress['ends'][segment]
+            while hashed < end:
+                buf = os.pread(fd, min(buflen, end - hashed), hashed)
+                checksum.update(buf)
+                hashed += len(buf)
+            if hashed < min(segment + seglen, size):
+                break
+        progress['hashed'] = hashed
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+        with futures.ThreadPoolExecutor(max_workers=segments) as pool:
+            jobs = [pool.submit(_download_segment, url, fd, offset,
+                                min(offset + seglen, size), buflen,
+                                retries, retry_delay,
+                                partial(_progress, offset))
+                    for offset in range(0, size, seglen)]
+            for job in futures.as_completed(jobs):
+                job.result()
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def get_headers(url, headers=None):
+    """Return the response headers of a HEAD request for url."""
+    try:
+        req = urllib_request.Request(url=url, headers=_get_headers(headers),
+                                     method='HEAD')
+        with urllib_request.urlopen(req) as fp:
+            return fp.info()
+    except urllib_error.HTTPError as exc:
+        raise UrlError(exc, code=exc.code, headers=exc.headers, url=url,
+                       reason=exc.reason)
+    except Exception as exc:
+        raise UrlError(exc, code=None, headers=None, url=url,
+                       reason="unknown")
+
+
+def _download_stream(rfp, path, buflen, reporthook, checksum=None):
+    """Write the content of UrlReader rfp to path, returning its length."""
+    if checksum:
+        checksum.reset()
+    blocknum = 0
+    fsize = 0
+    with open(path, "wb") as wfp:
+        if reporthook:
+            reporthook(blocknum, buflen, rfp.size)
+        while True:
+            buf = rfp.read(buflen)
+            if not buf:
+                break
+            blocknum += 1
+            if reporthook:
+                reporthook(blocknum, buflen, rfp.size)
+            wfp.write(buf)
+            if checksum:
+                checksum.update(buf)
+            fsize += len(buf)
+    return fsize
+
+
+def _ranged_size(url):
+    """Return (size, info) of url from a Range request for its first byte,
+    size None unless the server answers it and url may be downloaded with
+    Range requests."""
+    if urlparse(url).scheme not in ('http', 'https'):
+        return None, None
+    with UrlReader(url, headers={'Range': 'bytes=0-0'}) as rfp:
+        if rfp.status != 206:
+            return None, rfp.info
+        match = re.match(r'bytes\s+0-0/(\d+)$',
+                         rfp.info.get('content-range', '').strip())
+        if not match or not int(match.group(1)):
+            return None, rfp.info
+        return int(match.group(1)), rfp.info
+
+
+def _with_retries(func, url, retries, retry_delay):
+    """Return func(), called again up to retries times while it raises a
+    UrlError that may go away."""
+    attempts = 0
+    while True:
+        try:
+            return func()
+        except UrlError as e:
+            if not _retryable(e) or attempts >= retries:
+                raise e
+            LOG.debug("Current download of %s failed with error: %s. "
+                      "Retrying in %d seconds.", url, e, retry_delay)
+            attempts += 1
+            time.sleep(retry_delay)
+
+
+def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3,
+             buflen=None, segments=None, checksum=None):
+    """Download url to path.
+
+    reporthook is compatible with py3 urllib.request.urlretrieve.
+    urlretrieve does not exist in py2.
+
+    If the server answers a Range request for the first byte of url, the
+    file is fetched with up to 'segments' (default DOWNLOAD_SEGMENTS)
+    concurrent Range requests.  Each segment resumes where it stopped when
+    retried, which is the only retry of a ranged download.  Otherwise it is
+    read in a single stream which restarts from the beginning when retried.
+    buflen is the read size, default DOWNLOAD_BUFLEN.
+
+    If checksum (a curtin.checksum.Checksum) is given it is updated as the
+    data is written and verified once the download is complete."""
+
+    if buflen is None:
+        buflen = DOWNLOAD_BUFLEN
+    if segments is None:
+        segments = DOWNLOAD_SEGMENTS
+
+    def _single_stream():
+        with UrlReader(url) as rfp:
+            return rfp.info, _download_stream(rfp, path, buflen, reporthook,
+                                              checksum)
+
+    start = time.time()
+    size, info = _with_retries(partial(_ranged_size, url), url, retries,
+                               retry_delay)
+    fsize = None
+    if size:
+        nsegs = max(1, min(segments, size // DOWNLOAD_MIN_SEGMENT))
+        if checksum:
+            checksum.reset()
+        try:
+            _download_segments(url, path, size, nsegs, buflen, reporthook,
+                               retries, retry_delay, checksum)
+            fsize = size
+        except RangeNotSatisfied as e:
+            LOG.debug("%s, downloading in a single stream", e)
+    if fsize is None:
+        info, fsize = _with_retries(_single_stream, url, retries,
+                                    retry_delay)
+    if checksum:
+        checksum.verify()
+    timedelta = time.time() - start
+    LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
+              fsize, url, path, timedelta,
+              fsize / timedelta / 1024 / 1024)
+    return path, info
 
 
 def get_maas_version(endpoint):
@@ -278,6 +537,17 @@ class UrlError(IOError):
         return "[%s] " % self.url + msg
 
 
+class RangeNotSatisfied(UrlError):
+    """A Range request was answered with something other than 206."""
+    def __init__(self, url, status):
+        super(RangeNotSatisfied, self).__init__(
+            "range request answered with status %s" % status, code=status,
+            url=url, reason="range not satisfied")
+
+    def __str__(self):
+        return "[%s] %s" % (self.url, self.cause)
+
+
 class OauthUrlHelper(object):
     def __init__(self, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None,
@@ -911,9 +911,9 @@ def sanitize_source(source):
     if type(source) is dict:
         # already sanitized?
         return source
-    supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'dd-tar',
-                 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-raw', 'fsimage',
-                 'fsimage-layered']
+    supported = ['tgz', 'dd-tgz', 'tbz', 'dd-tbz', 'txz', 'dd-txz', 'tzst',
+                 'dd-tar', 'dd-bz2', 'dd-gz', 'dd-xz', 'dd-zst', 'dd-raw',
+                 'fsimage', 'fsimage-layered']
     deftype = 'tgz'
     for i in supported:
         prefix = i + ":"
@@ -2,6 +2,7 @@
 
 import functools
 import json
+import mmap
 import os
 import mock
 import sys
@@ -318,6 +319,62 @@ class TestWipeFile(CiTestCase):
         found = util.load_file(trgfile)
         self.assertEqual(data, found)
 
+    @mock.patch('curtin.block.fast_zero')
+    @mock.patch('curtin.block.is_block_device')
+    def test_block_device_zeroed_by_device(self, m_is_block, m_fast_zero):
+        """zeroing a block device is left to the device if it can."""
+        m_is_block.return_value = True
+        m_fast_zero.return_value = True
+        myfile = self.tmp_path("offload")
+        util.write_file(myfile, 8192 * b'\1', omode="wb")
+        block.wipe_file(myfile)
+        m_fast_zero.assert_called_with(mock.ANY, myfile, 0, 8192)
+        self.assertEqual(8192 * b'\1', util.load_file(myfile, decode=False))
+
+    @mock.patch('curtin.block.fast_zero')
+    @mock.patch('curtin.block.is_block_device')
+    def test_block_device_written_if_not_offloaded(self, m_is_block,
+                                                   m_fast_zero):
+        """block devices are written with direct or buffered writes."""
+        m_is_block.return_value = True
+        m_fast_zero.return_value = False
+        flen = 3 * 65536 + 512
+        myfile = self.tmp_path("direct")
+        util.write_file(myfile, flen * b'\1', omode="wb")
+        block.wipe_file(myfile, buflen=65536)
+        self.assertEqual(flen * b'\0', util.load_file(myfile, decode=False))
+
+        data = {'x': os.urandom(flen)}
+
+        def reader(size):
+            buf = data['x'][0:size]
+            data['x'] = data['x'][size:]
+            return buf
+
+        expected = data['x']
+        block.wipe_file(myfile, reader=reader, buflen=65536)
+        self.assertEqual(expected, util.load_file(myfile, decode=False))
+
+    @mock.patch('curtin.block.os.pwrite')
+    @mock.patch('curtin.block.fcntl.fcntl')
+    def test_direct_write_aligned_buffer(self, m_fcntl, m_pwrite):
+        """direct writes come from a page aligned buffer."""
+        m_fcntl.return_value = os.O_RDWR
+        writes = []
+        m_pwrite.side_effect = lambda fd, data, pos: writes.append(
+            (len(data), pos))
+        self.assertTrue(block._direct_write(
+            3, '/dev/sda', None, mmap.PAGESIZE * 2, mmap.PAGESIZE * 5))
+        self.assertEqual([(mmap.PAGESIZE * 2, 0),
+                          (mmap.PAGESIZE * 2, mmap.PAGESIZE * 2),
+                          (mmap.PAGESIZE, mmap.PAGESIZE * 4)], writes)
+        m_fcntl.assert_has_calls([
+            mock.call(3, block.fcntl.F_SETFL, os.O_RDWR | os.O_DIRECT),
+            mock.call(3, block.fcntl.F_SETFL, os.O_RDWR)])
+
+    def test_direct_write_needs_page_multiple(self):
+        self.assertFalse(block._direct_write(3, '/dev/sda', None, 1000, 1000))
+
     def test_exclusive_open_raise_missing(self):
         myfile = self.tmp_path("no-such-file")
 
@@ -393,6 +450,23 @@ class TestWipeFile(CiTestCase):
             self.assertEqual([], mock_os_close.call_args_list)
 
 
+class TestIsZeroed(CiTestCase):
+
+    def test_is_zeroed(self):
+        myfile = self.tmp_path("zeroed")
+        util.write_file(myfile, 4096 * b'\0', omode="wb")
+        self.assertTrue(block.is_zeroed(myfile, length=512))
+
+    def test_non_zero_samples(self):
+        """ data at the start, middle or end is found. """
+        for pos in (0, 2048, 4095):
+            myfile = self.tmp_path("data%d" % pos)
+            data = bytearray(4096)
+            data[pos] = 1
+            util.write_file(myfile, bytes(data), omode="wb")
+            self.assertFalse(block.is_zeroed(myfile, length=512))
+
+
 class TestWipeVolume(CiTestCase):
     dev = '/dev/null'
 
@@ -400,10 +474,9 @@ class TestWipeVolume(CiTestCase):
     @mock.patch('curtin.block.util')
     def test_wipe_pvremove(self, mock_util, mock_lvm):
         block.wipe_volume(self.dev, mode='pvremove')
-        mock_util.subp.assert_called_with(
-            ['pvremove', '--force', '--force', '--yes', self.dev], rcs=[0, 5],
-            capture=True)
-        self.assertTrue(mock_lvm.lvm_scan.called)
+        mock_lvm.run_lvm.assert_called_with(
+            ['pvremove', '--force', '--force', '--yes', self.dev], rcs=[0, 5])
+        self.assertTrue(mock_lvm.lvm_refresh.called)
 
     @mock.patch('curtin.block.quick_zero')
     def test_wipe_superblock(self, mock_quick_zero):
@@ -864,4 +937,36 @@ class TestSfdiskInfo(CiTestCase):
         self.assertEqual([], self.m_load_json.call_args_list)
 
 
+class TestFastZero(CiTestCase):
+
+    def setUp(self):
+        super(TestFastZero, self).setUp()
+        self.add_patch('curtin.block.get_queue_attr', 'm_attr')
+        self.add_patch('curtin.block.fcntl.ioctl', 'm_ioctl')
+
+    def _attrs(self, attrs):
+        self.m_attr.side_effect = lambda dev, name: attrs[name]
+
+    def test_zeroout_when_offloaded(self):
+        self._attrs({'write_zeroes_max_bytes': '33550336'})
+        self.assertTrue(block.fast_zero(3, '/dev/loop0', 0, 4096))
+        self.m_ioctl.assert_called_with(3, block.BLKZEROOUT, mock.ANY)
+
+    def test_unsupported(self):
+        self._attrs({'write_zeroes_max_bytes': '0'})
+        self.assertFalse(block.fast_zero(3, '/dev/sda', 0, 4096))
+        self.assertEqual(0, self.m_ioctl.call_count)
+
+    def test_no_write_zeroes_attribute(self):
+        """ kernels without write zeroes support do not zero fast. """
+        self.m_attr.side_effect = IOError('no such file')
+        self.assertFalse(block.fast_zero(3, '/dev/sda', 0, 4096))
+        self.assertEqual(0, self.m_ioctl.call_count)
+
+    def test_ioctl_failure(self):
+        self._attrs({'write_zeroes_max_bytes': '4096'})
+        self.m_ioctl.side_effect = OSError(95, 'not supported')
+        self.assertFalse(block.fast_zero(3, '/dev/sda', 0, 4096))
+
+
 # vi: ts=4 expandtab syntax=python
@@ -445,4 +445,117 @@ class TestBlockBcache(CiTestCase):
         m_wait.assert_called_with(stop_path, retries=bcache.BCACHE_RETRIES)
 
 
+class TestEnsureBcacheIsRegistered(CiTestCase):
+
+    def setUp(self):
+        super(TestEnsureBcacheIsRegistered, self).setUp()
+        self.add_patch('curtin.block.bcache.udev.wait_for', 'm_wait')
+        self.add_patch('curtin.block.bcache.validate_bcache_ready',
+                       'm_validate')
+        self.add_patch('curtin.block.bcache.register_bcache', 'm_register')
+        self.add_patch('curtin.block.bcache.time.sleep', 'm_sleep')
+        self.expected = '/sys/class/block/vdb/bcache'
+
+    def test_registered_by_udev(self):
+        """ no registration if udev registered the device. """
+        self.m_wait.return_value = True
+        bcache.ensure_bcache_is_registered('/dev/vdb', self.expected)
+        self.m_wait.assert_called_with(
+            self.expected + '/dev',
+            timeout=bcache.BCACHE_UDEV_REGISTRATION_TIMEOUT)
+        self.m_validate.assert_called_with('/dev/vdb', self.expected)
+        self.assertEqual(0, self.m_register.call_count)
+
+    def test_registers_device_and_waits_for_cacheset(self):
+        """ a cache device not registered by udev is registered. """
+        expected = '/sys/fs/bcache/' + self.random_string()
+        self.m_wait.side_effect = [False, True]
+        bcache.ensure_bcache_is_registered('/dev/vdc', expected)
+        self.m_register.assert_called_with('/dev/vdc')
+        self.assertEqual(
+            [mock.call(expected + '/cache0',
+                       timeout=bcache.BCACHE_UDEV_REGISTRATION_TIMEOUT),
+             mock.call(expected + '/cache0',
+                       timeout=bcache.BCACHE_REGISTRATION_TIMEOUT)],
+            self.m_wait.call_args_list)
+
+    def test_validation_is_retried(self):
+        """ a device failing validation at first is polled until ready. """
+        self.m_wait.return_value = True
+        self.m_validate.side_effect = [OSError('no slaves'),
+                                       IndexError('no slaves'), None]
+        bcache.ensure_bcache_is_registered('/dev/vdb', self.expected)
+        self.assertEqual(3, self.m_validate.call_count)
+        self.assertEqual(2, self.m_sleep.call_count)
+        self.assertEqual(0, self.m_register.call_count)
+
+    @mock.patch('curtin.block.bcache.BCACHE_UDEV_REGISTRATION_TIMEOUT', 0)
+    def test_register_error_is_not_fatal(self):
+        """ racing udev to register the device is not an error. """
+        self.m_wait.return_value = True
+        self.m_validate.side_effect = [OSError('not ready'), None]
+        self.m_register.side_effect = IOError('Invalid argument')
+        bcache.ensure_bcache_is_registered('/dev/vdb', self.expected)
+        self.assertEqual(1, self.m_register.call_count)
+        self.assertEqual(2, self.m_validate.call_count)
+
+    @mock.patch('curtin.block.bcache.BCACHE_UDEV_REGISTRATION_TIMEOUT', 0)
+    @mock.patch('curtin.block.bcache.BCACHE_REGISTRATION_TIMEOUT', 0)
+    def test_raises_if_never_valid(self):
+        self.m_wait.return_value = True
+        self.m_validate.side_effect = OSError('no slaves')
+        with self.assertRaises(RuntimeError):
+            bcache.ensure_bcache_is_registered('/dev/vdb', self.expected)
+
+    def test_raises_if_never_registered(self):
+        self.m_wait.return_value = False
+        with self.assertRaises(RuntimeError):
+            bcache.ensure_bcache_is_registered('/dev/vdb', self.expected)
+        self.assertEqual(1, self.m_register.call_count)
+        self.assertEqual(0, self.m_validate.call_count)
+
+
+class TestGetBcacheKname(CiTestCase):
+
+    def setUp(self):
+        super(TestGetBcacheKname, self).setUp()
+        self.add_patch('curtin.block.bcache._BCACHE_KNAMES', 'm_knames',
+                       new={}, autospec=False)
+        self.add_patch('curtin.block.bcache.glob.glob', 'm_glob')
+        self.add_patch('curtin.block.bcache.os.readlink', 'm_readlink')
+        self.add_patch('curtin.block.bcache.os.path.exists', 'm_exists')
+        self.m_glob.return_value = ['/sys/class/block/vdb/bcache/dev',
+                                    '/sys/class/block/vdc1/bcache/dev']
+        self.m_readlink.side_effect = lambda path: {
+            '/sys/class/block/vdb/bcache/dev':
+                '../../../../virtual/block/bcache1',
+            '/sys/class/block/vdc1/bcache/dev':
+                '../../../../virtual/block/bcache0'}[path]
+        self.m_exists.return_value = True
+
+    def test_single_sysfs_walk(self):
+        """ one walk of sysfs finds the bcache of every backing device. """
+        self.assertEqual('bcache1', bcache.get_bcache_kname('vdb'))
+        self.assertEqual('bcache0', bcache.get_bcache_kname('vdc1'))
+        self.assertEqual(1, self.m_glob.call_count)
+        self.m_exists.assert_called_with(
+            '/sys/class/block/bcache0/slaves/vdc1')
+
+    def test_walks_again_for_unknown_or_stale_devices(self):
+        self.assertIsNone(bcache.get_bcache_kname('vdd'))
+        self.m_exists.return_value = False
+        self.assertEqual('bcache1', bcache.get_bcache_kname('vdb'))
+        self.assertEqual(2, self.m_glob.call_count)
+
+    @mock.patch('curtin.block.bcache.util.write_file')
+    def test_set_tunables(self, m_write):
+        bcache.set_tunables('bcache0', {'writeback_percent': 20,
+                                        'congested_read_threshold_us': 0})
+        self.assertEqual([
+            mock.call('/sys/block/bcache0/bcache/cache/'
+                      'congested_read_threshold_us', '0', mode=None),
+            mock.call('/sys/block/bcache0/bcache/writeback_percent', '20',
+                      mode=None)], m_write.call_args_list)
+
+
 # vi: ts=4 expandtab syntax=python
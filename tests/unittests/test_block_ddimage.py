@@ -0,0 +1,202 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import gzip
+import hashlib
+import io
+import lzma
+import mock
+import os
+import subprocess
+import tarfile
+
+from curtin.block import ddimage
+from curtin.checksum import Checksum, ChecksumError
+from curtin import util
+from .helpers import CiTestCase
+
+MiB = 1024 * 1024
+
+BMAP = """<?xml version="1.0" ?>
+<bmap version="2.0">
+    <ImageSize> {size} </ImageSize>
+    <BlockSize> 4096 </BlockSize>
+    <BlocksCount> {blocks} </BlocksCount>
+    <MappedBlocksCount> 2 </MappedBlocksCount>
+    <ChecksumType> sha256 </ChecksumType>
+    <BmapFileChecksum> 0 </BmapFileChecksum>
+    <BlockMap>
+        <Range chksum="{first}"> 0 </Range>
+        <Range chksum="{last}"> {lastblock} </Range>
+    </BlockMap>
+</bmap>
+"""
+
+
+def _image(size=8 * MiB):
+    """Return a mostly empty image with data at both ends."""
+    data = bytearray(size)
+    data[0:4096] = b'\x01' * 4096
+    data[size - 4096:] = b'\x02' * 4096
+    return bytes(data)
+
+
+class TestWriteImage(CiTestCase):
+
+    def setUp(self):
+        super(TestWriteImage, self).setUp()
+        self.target = self.tmp_path('disk')
+        with open(self.target, 'wb') as fp:
+            fp.write(b'\xff' * MiB)
+
+    def _read_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_raw_image_skips_zero_blocks(self):
+        """Zero blocks of the image are left as holes in the target."""
+        image = _image()
+        stats = ddimage.write_image(io.BytesIO(image), self.target,
+                                    'dd-raw', buflen=MiB)
+        self.assertEqual(image, self._read_target())
+        self.assertEqual(len(image), stats.bytes)
+        self.assertEqual(2 * ddimage.ZERO_BLOCK_SIZE, stats.written)
+        self.assertEqual(len(image) - stats.written, stats.skipped)
+
+    def test_zero_blocks_written_if_target_not_zeroed(self):
+        """Every block is written if the target could not be zeroed."""
+        image = _image()
+        with mock.patch('curtin.block.ddimage._zero_target',
+                        return_value=False):
+            stats = ddimage.write_image(io.BytesIO(image), self.target,
+                                        'dd-raw', buflen=MiB)
+        self.assertEqual(len(image), stats.written)
+        self.assertEqual(image, self._read_target())
+
+    def test_compressed_images(self):
+        """dd-gz and dd-xz images are decompressed in-process."""
+        image = _image()
+        for image_type, data in (('dd-gz', gzip.compress(image)),
+                                 ('dd-xz', lzma.compress(image))):
+            ddimage.write_image(io.BytesIO(data), self.target, image_type)
+            self.assertEqual(image, self._read_target())
+
+    def test_tar_image(self):
+        """dd-tgz images write the content of the tar members."""
+        image = _image()
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            info = tarfile.TarInfo('disk.img')
+            info.size = len(image)
+            tar.addfile(info, io.BytesIO(image))
+        buf.seek(0)
+        ddimage.write_image(buf, self.target, 'dd-tgz')
+        self.assertEqual(image, self._read_target())
+
+    def _tar(self, members, mode):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode=mode) as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
+
+    def test_tar_image_unaligned_sizes(self):
+        """Tar members of any size are written, not just multiples of the
+        read size."""
+        for size in (3 * MiB, 3000000, 5 * MiB, 8 * MiB + 512):
+            image = _image(size)
+            for image_type, mode in (('dd-tar', 'w'), ('dd-tgz', 'w:gz')):
+                data = self._tar([('disk.img', image)], mode)
+                stats = ddimage.write_image(io.BytesIO(data), self.target,
+                                            image_type)
+                self.assertEqual(size, stats.bytes)
+                self.assertEqual(image, self._read_target())
+
+    def test_tar_image_several_members(self):
+        """Regular files of the tar are written back to back."""
+        first = b'\x01' * 3000000
+        second = b'\x02' * (MiB + 17)
+        data = self._tar([('a.img', first), ('b.img', second)], 'w:gz')
+        ddimage.write_image(io.BytesIO(data), self.target, 'dd-tgz')
+        self.assertEqual(first + second, self._read_target())
+
+    def test_tar_image_checksum_covers_padding(self):
+        """The source checksum covers the padding after the archive."""
+        data = self._tar([('disk.img', _image(3 * MiB))], 'w')
+        checksum = Checksum('sha256', hashlib.sha256(data).hexdigest())
+        ddimage.write_image(io.BytesIO(data), self.target, 'dd-tar',
+                            checksum=checksum)
+        with self.assertRaises(ChecksumError):
+            ddimage.write_image(io.BytesIO(data + b'\0' * 512), self.target,
+                                'dd-tar', checksum=checksum)
+
+    def test_zstd_image(self):
+        """dd-zst images are decompressed with the zstd tool."""
+        if not util.which('zstd'):
+            self.skipTest('zstd not installed')
+        image = _image()
+        data = subprocess.check_output(['zstd', '-q', '-c'], input=image)
+        ddimage.write_image(io.BytesIO(data), self.target, 'dd-zst')
+        self.assertEqual(image, self._read_target())
+
+    def test_checksum_mismatch_leaves_head_unwritten(self):
+        """On a checksum mismatch the first buffer is never written."""
+        image = _image()
+        with self.assertRaises(ChecksumError):
+            ddimage.write_image(io.BytesIO(image), self.target, 'dd-raw',
+                                checksum=Checksum('sha256', '0' * 64),
+                                buflen=MiB)
+        self.assertEqual(b'\x00' * 4096, self._read_target()[0:4096])
+
+    def test_checksum_match(self):
+        image = _image()
+        checksum = Checksum('sha512', hashlib.sha512(image).hexdigest())
+        ddimage.write_image(io.BytesIO(image), self.target, 'dd-raw',
+                            checksum=checksum)
+        self.assertEqual(image, self._read_target())
+
+    def _bmap(self, image, first=None, last=None):
+        return ddimage.parse_bmap(BMAP.format(
+            size=len(image), blocks=len(image) // 4096,
+            lastblock=len(image) // 4096 - 1,
+            first=first or hashlib.sha256(image[:4096]).hexdigest(),
+            last=last or hashlib.sha256(image[-4096:]).hexdigest()))
+
+    def test_parse_bmap(self):
+        image = _image()
+        bmap = self._bmap(image)
+        self.assertEqual(len(image), bmap.image_size)
+        self.assertEqual('sha256', bmap.checksum_type)
+        self.assertEqual([(0, 4096), (len(image) - 4096, len(image))],
+                         [(r.start, r.end) for r in bmap.ranges])
+
+    def test_bmap_writes_mapped_ranges(self):
+        """Only the ranges of a block map are written."""
+        image = _image()
+        with mock.patch('curtin.block.ddimage._zero_target',
+                        return_value=False):
+            stats = ddimage.write_image(io.BytesIO(image), self.target,
+                                        'dd-raw', bmap=self._bmap(image),
+                                        buflen=MiB)
+        self.assertEqual(2 * 4096, stats.written)
+        self.assertEqual(image[:4096], self._read_target()[:4096])
+
+    def test_bmap_checksum_mismatch(self):
+        image = _image()
+        with self.assertRaises(ValueError):
+            ddimage.write_image(io.BytesIO(image), self.target, 'dd-raw',
+                                bmap=self._bmap(image, last='0' * 64))
+
+    @mock.patch('curtin.block.ddimage.fast_zero')
+    @mock.patch('curtin.block.ddimage.os.fstat')
+    def test_block_device_is_zeroed_once(self, m_fstat, m_fast_zero):
+        """Block devices are zeroed up front with fast_zero."""
+        m_fstat.return_value = os.stat_result((0o60600,) + (0,) * 9)
+        m_fast_zero.return_value = True
+        fd = os.open(self.target, os.O_RDWR)
+        self.addCleanup(os.close, fd)
+        self.assertTrue(ddimage._zero_target(fd, self.target))
+        m_fast_zero.assert_called_with(fd, self.target, 0, MiB)
+
+# vi: ts=4 expandtab syntax=python
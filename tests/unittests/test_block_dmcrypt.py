@@ -0,0 +1,90 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+from mock import call
+
+from curtin.block import dmcrypt
+from curtin import util
+from .helpers import CiTestCase
+
+BENCHMARK_OUTPUT = """\
+# Tests are approximate using memory only (no storage IO).
+#     Algorithm |       Key |      Encryption |      Decryption
+{line}
+"""
+BENCHMARK_LINES = {
+    'aes-xts-plain64':
+        '        aes-xts        512b      2741.4 MiB/s      2749.7 MiB/s',
+    'serpent-xts-plain64':
+        '    serpent-xts        512b       812.0 MiB/s       798.3 MiB/s',
+    'twofish-xts-plain64':
+        '    twofish-xts        512b       455.6 MiB/s       460.1 MiB/s',
+}
+
+
+class TestParseBenchmark(CiTestCase):
+
+    def test_parse_benchmark_takes_slower_direction(self):
+        out = BENCHMARK_OUTPUT.format(
+            line=BENCHMARK_LINES['serpent-xts-plain64'])
+        self.assertEqual({('serpent-xts', 512): 798.3},
+                         dmcrypt.parse_benchmark(out))
+
+    def test_parse_benchmark_skips_unsupported(self):
+        out = BENCHMARK_OUTPUT.format(
+            line='    serpent-xts        512b               N/A  N/A')
+        self.assertEqual({}, dmcrypt.parse_benchmark(out))
+
+
+class TestAutoCipher(CiTestCase):
+
+    def setUp(self):
+        super(TestAutoCipher, self).setUp()
+        self.add_patch('curtin.block.dmcrypt.util.subp', 'm_subp')
+        self.add_patch('curtin.block.dmcrypt._BENCHMARKS', 'm_benchmarks',
+                       new={}, autospec=False)
+        self.m_subp.side_effect = self._benchmark
+
+    def _benchmark(self, cmd, capture=False):
+        return (BENCHMARK_OUTPUT.format(line=BENCHMARK_LINES[cmd[3]]), '')
+
+    def test_auto_cipher_picks_fastest(self):
+        self.assertEqual(('aes-xts-plain64', 512), dmcrypt.auto_cipher())
+        self.assertEqual(
+            [call(['cryptsetup', 'benchmark', '--cipher', cipher,
+                   '--key-size', '512'], capture=True)
+             for cipher in dmcrypt.DMCRYPT_AUTO_CIPHERS],
+            self.m_subp.call_args_list)
+
+    def test_auto_cipher_benchmarks_once(self):
+        dmcrypt.auto_cipher()
+        dmcrypt.auto_cipher()
+        self.assertEqual(len(dmcrypt.DMCRYPT_AUTO_CIPHERS),
+                         self.m_subp.call_count)
+
+    def test_auto_cipher_skips_failed_benchmarks(self):
+        def fail_aes(cmd, capture=False):
+            if cmd[3] == 'aes-xts-plain64':
+                raise util.ProcessExecutionError()
+            return self._benchmark(cmd, capture=capture)
+        self.m_subp.side_effect = fail_aes
+        self.assertEqual(('serpent-xts-plain64', '512'),
+                         dmcrypt.auto_cipher('512'))
+
+    def test_auto_cipher_none_benchmarked(self):
+        self.m_subp.side_effect = util.ProcessExecutionError()
+        self.assertEqual((None, None), dmcrypt.auto_cipher())
+
+
+class TestPerfOptions(CiTestCase):
+
+    def test_perf_options_none_set(self):
+        self.assertEqual(([], []), dmcrypt.perf_options({}))
+
+    def test_perf_options(self):
+        info = {'perf_no_read_workqueue': True,
+                'perf_no_write_workqueue': False}
+        self.assertEqual((['--perf-no_read_workqueue'],
+                          ['no-read-workqueue']),
+                         dmcrypt.perf_options(info))
+
+# vi: ts=4 expandtab syntax=python
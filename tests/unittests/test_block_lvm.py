@@ -1,9 +1,27 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from curtin.block import lvm
+from curtin import util
 
 from .helpers import CiTestCase
+import json
 import mock
+import os
+import sys
+import textwrap
+
+FULLREPORT = json.dumps({"report": [
+    {"vg": [{"vg_name": "vg0", "pv_count": "2", "lv_count": "2"}],
+     "pv": [{"pv_name": "/dev/vda1", "vg_name": "vg0"},
+            {"pv_name": "/dev/vdb1", "vg_name": "vg0"}],
+     "lv": [{"lv_name": "root", "vg_name": "vg0",
+             "lv_size": "8589934592B"},
+            {"lv_name": "swap", "vg_name": "vg0",
+             "lv_size": "1073741824B"}],
+     "pvseg": [], "seg": []},
+    {"vg": [],
+     "pv": [{"pv_name": "/dev/vdc", "vg_name": ""}],
+     "lv": [], "pvseg": [], "seg": []}]})
 
 
 class TestBlockLvm(CiTestCase):
@@ -41,19 +59,6 @@ class TestBlockLvm(CiTestCase):
                                            query_name, 'bad_match_val')
         self.assertEqual(len(result_list), 0)
 
-    @mock.patch('curtin.block.lvm._filter_lvm_info')
-    def test_get_lvm_info(self, mock_filter_lvm_info):
-        """
-        make sure that the get lvm info functions make the right calls to
-        lvm._filter_lvm_info
-        """
-        lvm.get_pvols_in_volgroup(self.vg_name)
-        mock_filter_lvm_info.assert_called_with(
-            'pvdisplay', 'vg_name', 'pv_name', self.vg_name)
-        lvm.get_lvols_in_volgroup(self.vg_name)
-        mock_filter_lvm_info.assert_called_with(
-            'lvdisplay', 'vg_name', 'lv_name', self.vg_name)
-
     @mock.patch('curtin.block.lvm.util')
     def test_split_lvm_name(self, mock_util):
         """
@@ -114,6 +119,161 @@ class TestBlockLvm(CiTestCase):
         mock_util.subp.has_calls(calls)
 
 
+class TestLvmState(CiTestCase):
+
+    def setUp(self):
+        super(TestLvmState, self).setUp()
+        self.add_patch('curtin.block.lvm._LVM_STATE', 'm_state', new=None,
+                       autospec=False)
+        self.add_patch('curtin.block.lvm.util.subp', 'm_subp')
+        self.add_patch('curtin.block.lvm.lvmetad_running', 'm_lvmetad')
+        self.m_lvmetad.return_value = False
+        self.m_subp.return_value = (FULLREPORT, '')
+
+    def test_parse_fullreport(self):
+        self.assertEqual(
+            {'vg0': {'pvs': ['/dev/vda1', '/dev/vdb1'],
+                     'lvs': {'root': '8589934592B', 'swap': '1073741824B'}},
+             '': {'pvs': ['/dev/vdc'], 'lvs': {}}},
+            lvm.parse_fullreport(FULLREPORT))
+
+    def test_lookups_share_one_report(self):
+        """every lookup is answered by a single lvm fullreport"""
+        self.assertEqual(['/dev/vda1', '/dev/vdb1'],
+                         lvm.get_pvols_in_volgroup('vg0'))
+        self.assertEqual(['root', 'swap'], lvm.get_lvols_in_volgroup('vg0'))
+        self.assertEqual(1073741824, lvm.get_lv_size_bytes('swap'))
+        self.assertEqual([], lvm.get_lvols_in_volgroup('vg1'))
+        self.assertIsNone(lvm.get_lv_size_bytes('home'))
+        self.assertEqual(
+            [mock.call(['lvm', 'fullreport', '--reportformat', 'json',
+                        '--units=B'], capture=True)],
+            self.m_subp.call_args_list)
+
+    def test_lvm_refresh_rereads_report(self):
+        lvm.get_lvols_in_volgroup('vg0')
+        lvm.lvm_refresh()
+        self.assertEqual(1, self.m_subp.call_count)
+        lvm.get_lvols_in_volgroup('vg0')
+        self.assertEqual(2, self.m_subp.call_count)
+
+    @mock.patch('curtin.block.lvm.lvm_scan')
+    def test_lvm_refresh_updates_lvmetad(self, m_scan):
+        self.m_lvmetad.return_value = True
+        lvm.lvm_refresh()
+        m_scan.assert_called_with()
+
+    def test_fallback_without_fullreport(self):
+        """pvs and lvs are used if lvm has no fullreport"""
+        self.m_subp.side_effect = [
+            util.ProcessExecutionError(),
+            ('  vg0{sep}/dev/vda1\n  vg0{sep}/dev/vdb1\n'.format(
+                sep=lvm._SEP), ''),
+            ('  vg0{sep}root{sep}8589934592B\n'.format(sep=lvm._SEP), '')]
+        self.assertEqual(['/dev/vda1', '/dev/vdb1'],
+                         lvm.get_pvols_in_volgroup('vg0'))
+        self.assertEqual(8589934592, lvm.get_lv_size_bytes('root'))
+        self.assertEqual(3, self.m_subp.call_count)
+
+
+# a fake lvm shell logging the commands it runs, commands with the word
+# fail in them fail with lvm return code 5
+FAKE_LVM = textwrap.dedent("""\
+    #!{python}
+    import json, os, sys
+    report = os.fdopen(int(os.environ['LVM_REPORT_FD']), 'w')
+    log = open({log!r}, 'a')
+    log.write('pid %d\\n' % os.getpid())
+    while True:
+        sys.stdout.write('lvm> ')
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line or line.strip() == 'exit':
+            break
+        log.write(line)
+        log.flush()
+        sys.stdout.write('output of ' + line)
+        ret_code = '5' if 'fail' in line else '1'
+        report.write(json.dumps({{'log': [
+            {{'log_type': 'status', 'log_ret_code': ret_code}}]}}))
+        report.flush()
+    """)
+
+
+class TestLvmShell(CiTestCase):
+
+    def setUp(self):
+        super(TestLvmShell, self).setUp()
+        self.log = self.tmp_path('lvm.log')
+        bindir = self.tmp_dir()
+        lvm_path = os.path.join(bindir, 'lvm')
+        with open(lvm_path, 'w') as fp:
+            fp.write(FAKE_LVM.format(python=sys.executable, log=self.log))
+        os.chmod(lvm_path, 0o755)
+        self.add_patch('curtin.block.lvm.os.environ', 'm_environ',
+                       new=dict(os.environ, PATH=bindir), autospec=False)
+        self.add_patch('curtin.block.lvm.util.subp', 'm_subp')
+        self.m_subp.return_value = ('', '')
+
+    def _log(self):
+        with open(self.log) as fp:
+            return fp.read().splitlines()
+
+    def test_session_runs_commands_in_one_shell(self):
+        with lvm.lvm_shell():
+            (out, _) = lvm.run_lvm(['vgcreate', 'vg0', '/dev/vda1'])
+            lvm.run_lvm(['lvcreate', 'vg0', '--name', 'root lv'])
+        self.assertEqual(0, self.m_subp.call_count)
+        log = self._log()
+        self.assertEqual(1, len([line for line in log
+                                 if line.startswith('pid ')]))
+        config = "'%s'" % lvm.LVM_SHELL_CONFIG
+        self.assertEqual(
+            ['vgcreate vg0 /dev/vda1 --config ' + config,
+             'lvcreate vg0 --name "root lv" --config ' + config], log[1:])
+        self.assertEqual('output of ' + log[1] + '\n', out)
+
+    def test_failed_command_raises(self):
+        with lvm.lvm_shell():
+            with self.assertRaises(util.ProcessExecutionError) as exc:
+                lvm.run_lvm(['vgremove', 'fail'])
+            self.assertEqual(5, exc.exception.exit_code)
+            lvm.run_lvm(['vgremove', 'fail'], rcs=[0, 5])
+
+    def test_existing_config_is_extended(self):
+        with lvm.lvm_shell():
+            lvm.run_lvm(['pvscan', '--config', 'devices{ filter = [] }'])
+        self.assertEqual(
+            ["pvscan --config 'devices{ filter = [] } %s'" %
+             lvm.LVM_SHELL_CONFIG], self._log()[1:])
+
+    def test_commands_run_as_processes_outside_session(self):
+        lvm.run_lvm(['vgcreate', 'vg0', '/dev/vda1'])
+        self.m_subp.assert_called_with(['vgcreate', 'vg0', '/dev/vda1'],
+                                       rcs=[0], capture=True)
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_fallback_without_lvm_shell(self):
+        """commands run as processes if lvm does not start a shell"""
+        self.m_environ['PATH'] = self.tmp_dir()
+        with lvm.lvm_shell():
+            lvm.run_lvm(['vgcreate', 'vg0', '/dev/vda1'])
+            lvm.run_lvm(['vgremove', 'vg0'], rcs=[0, 5])
+        self.assertEqual(
+            [mock.call(['vgcreate', 'vg0', '/dev/vda1'], rcs=[0],
+                       capture=True),
+             mock.call(['vgremove', 'vg0'], rcs=[0, 5], capture=True)],
+            self.m_subp.call_args_list)
+
+    def test_shell_quote(self):
+        self.assertEqual('vg0', lvm._shell_quote('vg0'))
+        self.assertEqual('"a b"', lvm._shell_quote('a b'))
+        self.assertEqual("'a=\"b\"'", lvm._shell_quote('a="b"'))
+        self.assertEqual('""', lvm._shell_quote(''))
+        with self.assertRaises(ValueError):
+            lvm._shell_quote('\'"')
+
+
 class TestBlockLvmMultipathFilter(CiTestCase):
 
     def test_generate_multipath_dev_mapper_filter(self):
@@ -233,6 +233,19 @@ class TestBlockMdadmCreate(CiTestCase):
                            devices=devices, spares=spares)
         self.mock_util.subp.assert_has_calls(expected_calls)
 
+    def test_mdadm_create_assume_clean_with_bitmap(self):
+        md_devname = "/dev/md0"
+        devices = ['/dev/vdc1', '/dev/vdd1']
+        self.mock_util.subp.return_value = ('ubuntu', '')
+        mdadm.mdadm_create(md_devname=md_devname, raidlevel=1,
+                           devices=devices, assume_clean=True,
+                           bitmap='internal')
+        cmd = [args[0][0] for args in self.mock_util.subp.call_args_list
+               if args[0][0][:2] == ['mdadm', '--create']][0]
+        self.assertIn('--assume-clean', cmd)
+        self.assertIn('--bitmap=internal', cmd)
+        self.assertEqual(devices, cmd[-2:])
+
     def test_mdadm_create_imsm_container(self):
         md_devname = "/dev/md/imsm"
         raidlevel = 'container'
@@ -1411,4 +1424,56 @@ class TestBlockMdadmZeroDevice(CiTestCase):
         self.mock_examine.assert_called_with(device, export=False)
         self.m_zero.assert_called_with(device, expected_offsets,
                                        buflen=1024, count=1024, strict=True)
+
+
+class TestMdBlockUntilInSync(CiTestCase):
+
+    def setUp(self):
+        super(TestMdBlockUntilInSync, self).setUp()
+        # a fake /sys/class/block/md0/md tree
+        self.sysmd = self.tmp_dir()
+        self.add_patch('curtin.block.mdadm.md_sysfs_attr_path', 'm_attr')
+        self.m_attr.side_effect = (
+            lambda md_devname, attr: os.path.join(self.sysmd, attr))
+        self.sync_completed = os.path.join(self.sysmd, 'sync_completed')
+
+    def _set(self, value):
+        util.write_file(self.sync_completed, value + '\n')
+
+    def test_no_sync_completed_is_in_sync(self):
+        self.assertTrue(mdadm.md_block_until_in_sync('/dev/md0'))
+
+    def test_in_sync(self):
+        self._set('none')
+        progress = []
+        self.assertTrue(mdadm.md_block_until_in_sync(
+            '/dev/md0', progress=lambda *args: progress.append(args)))
+        self.assertEqual([], progress)
+
+    def test_reports_progress_until_in_sync(self):
+        values = iter(['2048 / 8192', '4096 / 8192', 'none'])
+        progress = []
+
+        def report(done, total):
+            progress.append((done, total))
+            # the kernel moves the sync along while curtin waits
+            self._set(next(values))
+
+        self._set('1024 / 8192')
+        self.assertTrue(mdadm.md_block_until_in_sync(
+            '/dev/md0', progress=report, interval=0.01))
+        self.assertEqual([(1024, 8192), (2048, 8192), (4096, 8192)],
+                         progress)
+
+    def test_timeout(self):
+        for value in ('1024 / 8192', 'delayed'):
+            self._set(value)
+            self.assertFalse(mdadm.md_block_until_in_sync(
+                '/dev/md0', timeout=0.05, interval=0.01))
+
+    def test_set_sync_speed_max(self):
+        mdadm.md_set_sync_speed_max('/dev/md0', 5000)
+        self.assertEqual('5000', util.load_file(
+            os.path.join(self.sysmd, 'sync_speed_max')))
+
 # vi: ts=4 expandtab syntax=python
@@ -40,13 +40,14 @@ class TestBlockMkfs(CiTestCase):
     @mock.patch("curtin.block.mkfs.distro.lsb_release")
     def _run_mkfs_with_config(self, config, expected_cmd, expected_flags,
                               mock_lsb_release, mock_util, mock_os, mock_block,
-                              release="wily", strict=False):
+                              release="wily", strict=False, nodiscard=False):
         # Pretend we are on wily as there are no known edge cases for it
         mock_lsb_release.return_value = {"codename": release}
         mock_os.path.exists.return_value = True
         mock_block.get_blockdev_sector_size.return_value = (512, 512)
 
-        mkfs.mkfs_from_config("/dev/null", config, strict=strict)
+        mkfs.mkfs_from_config("/dev/null", config, strict=strict,
+                              nodiscard=nodiscard)
         self.assertTrue(mock_util.subp.called)
         calls = mock_util.subp.call_args_list
         self.assertEquals(len(calls), 1)
@@ -72,6 +73,64 @@ class TestBlockMkfs(CiTestCase):
                           ["-U", self.test_uuid]] + extra_options
         self._run_mkfs_with_config(conf, "mkfs.ext4", expected_flags)
 
+    def test_mkfs_ext_fast(self):
+        conf = self._get_config("ext4")
+        conf['fast'] = True
+        expected_flags = [["-L", "format1"], "-F", ["-U", self.test_uuid],
+                          ["-E", "lazy_itable_init=1,lazy_journal_init=1"]]
+        self._run_mkfs_with_config(conf, "mkfs.ext4", expected_flags)
+
+    def test_mkfs_ext_fast_nodiscard(self):
+        """the extended options of the profile are passed as one -E"""
+        conf = self._get_config("ext4")
+        conf['fast'] = True
+        expected_flags = [["-L", "format1"], "-F", ["-U", self.test_uuid],
+                          ["-E", "lazy_itable_init=1,lazy_journal_init=1,"
+                                 "nodiscard"]]
+        self._run_mkfs_with_config(conf, "mkfs.ext4", expected_flags,
+                                   nodiscard=True)
+
+    def test_mkfs_ext_fast_with_extended_extra_options(self):
+        """a -E in extra_options is merged with the one of the profile"""
+        conf = self._get_config("ext4")
+        conf['fast'] = True
+        conf['extra_options'] = ["-E", "stride=16", "-Estripe_width=32"]
+        expected_flags = [["-L", "format1"], "-F", ["-U", self.test_uuid],
+                          ["-E", "lazy_itable_init=1,lazy_journal_init=1,"
+                                 "nodiscard,stride=16,stripe_width=32"]]
+        self._run_mkfs_with_config(conf, "mkfs.ext4", expected_flags,
+                                   nodiscard=True)
+
+    def test_mkfs_nodiscard_needs_fast(self):
+        conf = self._get_config("xfs")
+        expected_flags = [["-L", "format1"], "-f",
+                          ["-m", "uuid={}".format(self.test_uuid)]]
+        self._run_mkfs_with_config(conf, "mkfs.xfs", expected_flags,
+                                   nodiscard=True)
+
+    def test_mkfs_xfs_and_btrfs_fast_nodiscard(self):
+        conf = self._get_config("xfs")
+        conf['fast'] = True
+        expected_flags = [["-L", "format1"], "-f", "-K",
+                          ["-m", "uuid={}".format(self.test_uuid)]]
+        self._run_mkfs_with_config(conf, "mkfs.xfs", expected_flags,
+                                   nodiscard=True)
+        conf = self._get_config("btrfs")
+        conf['fast'] = True
+        expected_flags = [["--label", "format1"], "--force", "--nodiscard",
+                          ["--uuid", self.test_uuid]]
+        self._run_mkfs_with_config(conf, "mkfs.btrfs", expected_flags,
+                                   nodiscard=True)
+
+    def test_join_extended_options(self):
+        self.assertEqual(
+            ['-q', '-K', '-E', 'a=1,b,c'],
+            mkfs.join_extended_options(['-E', 'a=1,b', '-q', '-E', 'c',
+                                        '-K']))
+        self.assertEqual(['-E', 'a,b'],
+                         mkfs.join_extended_options(['-Ea', '-E', 'b']))
+        self.assertEqual(['-q'], mkfs.join_extended_options(['-q']))
+
     def test_mkfs_btrfs(self):
         conf = self._get_config("btrfs")
         expected_flags = [["--label", "format1"], "--force",
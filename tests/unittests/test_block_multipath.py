@@ -119,59 +119,50 @@ class TestMultipath(CiTestCase):
         self.assertIsNone(
             multipath.mpath_partition_to_mpath_id_and_partnumber(dev))
 
-    @mock.patch('curtin.block.multipath.os.path.exists')
-    @mock.patch('curtin.block.multipath.util.wait_for_removal')
-    def test_remove_partition(self, m_wait, m_exists):
-        """multipath.remove_partition runs dmsetup skips wait if dev gone."""
+    def test_remove_partition(self):
+        """multipath.remove_partition runs dmsetup until the dev is gone."""
         devpath = self.random_string()
-        m_exists.side_effect = iter([True, True, False])
+        self.m_udev.wait_for_removal.side_effect = iter([False, False, True])
         multipath.remove_partition(devpath)
         expected = mock.call(
             ['dmsetup', 'remove', '--force', '--retry', devpath])
         self.m_subp.assert_has_calls([expected] * 3)
-        m_wait.assert_not_called()
-        self.assertEqual(3, self.m_udev.udevadm_settle.call_count)
+        self.m_udev.wait_for_removal.assert_called_with(
+            devpath, timeout=multipath.REMOVE_WAIT)
 
-    @mock.patch('curtin.block.multipath.os.path.exists')
-    @mock.patch('curtin.block.multipath.util.wait_for_removal')
-    def test_remove_partition_waits(self, m_wait, m_exists):
-        """multipath.remove_partition runs dmsetup waits if dev still there."""
+    def test_remove_partition_raises_if_dev_remains(self):
+        """multipath.remove_partition raises if dev still there."""
         devpath = self.random_string()
-        m_exists.side_effect = iter([True, True, True])
-        multipath.remove_partition(devpath, retries=3)
+        self.m_udev.wait_for_removal.return_value = False
+        with self.assertRaises(OSError):
+            multipath.remove_partition(devpath, retries=3)
         expected = mock.call(
             ['dmsetup', 'remove', '--force', '--retry', devpath])
         self.m_subp.assert_has_calls([expected] * 3)
-        self.assertEqual(3, self.m_udev.udevadm_settle.call_count)
-        self.assertEqual(1, m_wait.call_count)
+        self.assertEqual(3, self.m_udev.wait_for_removal.call_count)
 
-    @mock.patch('curtin.block.multipath.os.path.exists')
-    @mock.patch('curtin.block.multipath.util.wait_for_removal')
-    def test_remove_map(self, m_wait, m_exists):
-        """multipath.remove_map runs multipath -f skips wait if map gone."""
+    def test_remove_map(self):
+        """multipath.remove_map runs multipath -f until the map is gone."""
         map_id = self.random_string()
         devpath = '/dev/mapper/%s' % map_id
-        m_exists.side_effect = iter([True, True, False])
-        multipath.remove_map(devpath)
+        self.m_udev.wait_for_removal.side_effect = iter([False, False, True])
+        multipath.remove_map(map_id)
         expected = mock.call(
-            ['multipath', '-v3', '-R3', '-f', devpath], rcs=[0, 1])
+            ['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
         self.m_subp.assert_has_calls([expected] * 3)
-        m_wait.assert_not_called()
-        self.assertEqual(3, self.m_udev.udevadm_settle.call_count)
+        self.m_udev.wait_for_removal.assert_called_with(
+            devpath, timeout=multipath.REMOVE_WAIT)
 
-    @mock.patch('curtin.block.multipath.os.path.exists')
-    @mock.patch('curtin.block.multipath.util.wait_for_removal')
-    def test_remove_map_wait(self, m_wait, m_exists):
-        """multipath.remove_map runs multipath -f  wait if map remains."""
+    def test_remove_map_raises_if_map_remains(self):
+        """multipath.remove_map raises if map remains."""
         map_id = self.random_string()
-        devpath = '/dev/mapper/%s' % map_id
-        m_exists.side_effect = iter([True, True, True])
-        multipath.remove_map(devpath, retries=3)
+        self.m_udev.wait_for_removal.return_value = False
+        with self.assertRaises(OSError):
+            multipath.remove_map(map_id, retries=3)
         expected = mock.call(
-            ['multipath', '-v3', '-R3', '-f', devpath], rcs=[0, 1])
+            ['multipath', '-v3', '-R3', '-f', map_id], rcs=[0, 1])
         self.m_subp.assert_has_calls([expected] * 3)
-        self.assertEqual(3, self.m_udev.udevadm_settle.call_count)
-        self.assertEqual(1, m_wait.call_count)
+        self.assertEqual(3, self.m_udev.wait_for_removal.call_count)
 
     def test_find_mpath_members(self):
         """find_mpath_members enumerates kernel block devs of a mpath_id."""
@@ -0,0 +1,74 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import os
+
+from curtin import block
+from curtin.block import signatures
+from .helpers import CiTestCase
+
+MiB = 1024 * 1024
+
+
+class TestSignatures(CiTestCase):
+
+    def setUp(self):
+        super(TestSignatures, self).setUp()
+        self.dev = self.tmp_path('disk')
+        self.size = 128 * MiB
+        with open(self.dev, 'wb') as fp:
+            fp.truncate(self.size)
+
+    def _write(self, offset, data):
+        with open(self.dev, 'rb+') as fp:
+            fp.seek(offset)
+            fp.write(data)
+
+    def _read(self, offset, length):
+        with open(self.dev, 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+    def _find(self):
+        fd = os.open(self.dev, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        return signatures.find_signatures(fd, self.size)
+
+    def test_empty_device_has_no_signatures(self):
+        self.assertEqual([], self._find())
+
+    def test_finds_signatures_at_their_offsets(self):
+        md090 = self.size - 64 * 1024
+        self._write(1024 + 0x38, b'\x53\xef')
+        self._write(64 * MiB + 0x40, b'_BHRfS_M')
+        self._write(4096 - 10, b'SWAPSPACE2')
+        self._write(512, b'LABELONE')
+        self._write(md090, signatures.MD_MAGIC)
+        self._write(4096 + 24, signatures.BCACHE_MAGIC)
+        self._write(2 * MiB, b'SKUL\xba\xbe')
+        self._write(self.size - 512 * 1024 + 130 * 1024,
+                    signatures.ZFS_MAGICS[0])
+        self._write(self.size - 512, b'EFI PART')
+        self.assertEqual(
+            [('ext', 1024), ('btrfs', 64 * MiB), ('swap', 0),
+             ('LVM2_member', 0), ('linux_raid_member', md090),
+             ('bcache', 4096), ('crypto_LUKS', 2 * MiB),
+             ('zfs_member', self.size - 512 * 1024),
+             ('gpt', self.size - 512)],
+            [(sig.name, sig.offset) for sig in self._find()])
+
+    def test_locations_beyond_the_device_are_skipped(self):
+        self.size = 32 * 1024
+        self.assertEqual([], self._find())
+
+    def test_quick_zero_wipes_signatures_past_head_and_tail(self):
+        """signatures outside the first and last 1M are zeroed as well"""
+        self._write(64 * MiB + 0x40, b'_BHRfS_M')
+        self._write(2 * MiB, b'SKUL\xba\xbe')
+        self._write(0, b'\xff' * MiB)
+        block.quick_zero(self.dev, partitions=False)
+        self.assertEqual(b'\0' * 4096, self._read(64 * MiB, 4096))
+        self.assertEqual(b'\0' * 4096, self._read(2 * MiB, 4096))
+        self.assertEqual(b'\0' * MiB, self._read(0, MiB))
+        self.assertEqual([], self._find())
+
+# vi: ts=4 expandtab syntax=python
@@ -211,6 +211,49 @@ class TestBlockZfsZpoolCreate(CiTestCase):
             self.assertEqual(expected_kwargs, kwargs)
 
 
+class TestBlockZfsGetVdevsAshift(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockZfsGetVdevsAshift, self).setUp()
+        self.add_patch('curtin.block.zfs.get_blockdev_sector_size',
+                       'm_sector_size')
+
+    def test_largest_sector_size_of_vdevs(self):
+        """ ashift matches the largest sector size of all vdevs """
+        sizes = {'/dev/sda': (512, 512), '/dev/sdb': (512, 4096),
+                 '/dev/nvme0n1': (4096, 16384)}
+        self.m_sector_size.side_effect = lambda vdev: sizes[vdev]
+        self.assertEqual(12, zfs.get_vdevs_ashift(['/dev/sda', '/dev/sdb']))
+        self.assertEqual(14, zfs.get_vdevs_ashift(sorted(sizes)))
+
+    def test_ashift_is_at_least_default(self):
+        self.m_sector_size.return_value = (512, 512)
+        self.assertEqual(zfs.ZPOOL_DEFAULT_PROPERTIES['ashift'],
+                         zfs.get_vdevs_ashift(['/dev/sda']))
+
+    def test_ashift_is_at_most_max(self):
+        self.m_sector_size.return_value = (512, 1 << 20)
+        self.assertEqual(zfs.ZPOOL_MAX_ASHIFT,
+                         zfs.get_vdevs_ashift(['/dev/sda']))
+
+
+class TestBlockZfsProfileProperties(CiTestCase):
+
+    def test_no_profile(self):
+        self.assertEqual({'a': 1}, zfs.zfs_profile_properties(None, {'a': 1}))
+
+    def test_properties_override_profile(self):
+        props = zfs.zfs_profile_properties('database', {'atime': 'on'})
+        self.assertEqual('16K', props['recordsize'])
+        self.assertEqual('sa', props['xattr'])
+        self.assertEqual('on', props['atime'])
+        self.assertEqual('off', zfs.ZFS_PROFILES['database']['atime'])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            zfs.zfs_profile_properties('fastest')
+
+
 class TestBlockZfsZfsCreate(CiTestCase):
 
     def setUp(self):
@@ -0,0 +1,92 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import hashlib
+import io
+import mock
+
+from curtin import checksum
+from .helpers import CiTestCase
+
+SUMS = """\
+0a1b  disk.img.xz
+ff00 *root.squashfs
+"""
+
+
+class TestChecksum(CiTestCase):
+
+    def test_verify(self):
+        cksum = checksum.Checksum('sha512',
+                                  hashlib.sha512(b'data').hexdigest().upper())
+        reader = checksum.ChecksumReader(io.BytesIO(b'data'), cksum)
+        self.assertEqual(b'da', reader.read(2))
+        self.assertEqual(b'ta', reader.read())
+        cksum.verify()
+
+    def test_mismatch_raises(self):
+        cksum = checksum.Checksum('sha256', '00' * 32, 'http://a/b')
+        cksum.update(b'data')
+        with self.assertRaises(checksum.ChecksumError):
+            cksum.verify()
+
+    def test_reset(self):
+        cksum = checksum.Checksum('sha256',
+                                  hashlib.sha256(b'data').hexdigest())
+        cksum.update(b'partial')
+        cksum.reset()
+        cksum.update(b'data')
+        cksum.verify()
+
+    def test_verify_file(self):
+        path = self.tmp_path('image')
+        with open(path, 'wb') as fp:
+            fp.write(b'data')
+        cksum = checksum.Checksum('sha256',
+                                  hashlib.sha256(b'data').hexdigest())
+        cksum.update(b'stale')
+        cksum.verify_file(path)
+        with self.assertRaises(checksum.ChecksumError):
+            checksum.Checksum('sha256', '00' * 32).verify_file(path)
+
+    def test_unsupported_algorithm(self):
+        with self.assertRaises(ValueError):
+            checksum.Checksum('md5', '00')
+
+    def test_parse_sums(self):
+        self.assertEqual('0a1b', checksum.parse_sums(SUMS, 'disk.img.xz'))
+        self.assertEqual('ff00',
+                         checksum.parse_sums(SUMS.encode(), 'root.squashfs'))
+        self.assertIsNone(checksum.parse_sums(SUMS, 'other.img'))
+
+
+class TestSourceChecksum(CiTestCase):
+
+    def test_no_checksum(self):
+        self.assertIsNone(checksum.source_checksum(
+            {'type': 'fsimage', 'uri': 'http://a/root.squashfs'}))
+
+    def test_direct_checksum(self):
+        source = {'type': 'fsimage', 'uri': 'http://a/root.squashfs',
+                  'sha256': 'ABCD'}
+        self.assertEqual('sha256-abcd', checksum.source_checksum(source).key)
+        # a direct checksum is for the source uri only
+        self.assertIsNone(checksum.source_checksum(source, 'http://a/other'))
+
+    def test_sums_url(self):
+        sums = self.tmp_path('SHA256SUMS')
+        with open(sums, 'w') as fp:
+            fp.write(SUMS)
+        source = {'type': 'fsimage', 'uri': 'http://a/root.squashfs',
+                  'sha256sums': 'file://' + sums}
+        self.assertEqual('sha256-ff00', checksum.source_checksum(source).key)
+
+    @mock.patch('curtin.checksum.url_helper.geturl')
+    def test_sums_missing_entry_raises(self, m_geturl):
+        m_geturl.return_value = SUMS.encode()
+        source = {'type': 'dd-raw', 'uri': 'http://a/other.img',
+                  'sha256sums': 'http://a/SHA256SUMS'}
+        with self.assertRaises(checksum.ChecksumError):
+            checksum.source_checksum(source)
+        m_geturl.assert_called_with('http://a/SHA256SUMS')
+
+# vi: ts=4 expandtab syntax=python
@@ -3,6 +3,7 @@
 import mock
 import os
 import textwrap
+import threading
 import uuid
 
 from curtin.block import clear_holders
@@ -196,19 +197,19 @@ class TestClearHolders(CiTestCase):
         mock_zero.assert_called_with(devname, partitions=False)
         mock_lvm.split_lvm_name.assert_called_with(lvm_name.strip())
         self.assertTrue(mock_log.debug.called)
-        mock_util.subp.assert_called_with(
+        mock_lvm.run_lvm.assert_called_with(
             ['lvremove', '--force', '--force', vg_lv_name])
         mock_lvm.get_lvols_in_volgroup.assert_called_with(vg_name)
-        self.assertEqual(len(mock_util.subp.call_args_list), 1)
+        self.assertEqual(len(mock_lvm.run_lvm.call_args_list), 1)
         mock_lvm.get_lvols_in_volgroup.return_value = []
-        self.assertTrue(mock_lvm.lvm_scan.called)
+        self.assertTrue(mock_lvm.lvm_refresh.called)
         mock_lvm.get_pvols_in_volgroup.return_value = pvols
         clear_holders.shutdown_lvm(self.test_blockdev)
-        mock_util.subp.assert_called_with(
+        mock_lvm.run_lvm.assert_called_with(
             ['vgremove', '--force', '--force', vg_name], rcs=[0, 5])
         for pv in pvols:
             mock_zero.assert_any_call(pv, partitions=False)
-        self.assertTrue(mock_lvm.lvm_scan.called)
+        self.assertTrue(mock_lvm.lvm_refresh.called)
 
     @mock.patch('curtin.block.clear_holders.block')
     @mock.patch('curtin.block.clear_holders.util')
@@ -655,6 +656,92 @@ class TestClearHolders(CiTestCase):
                                   for e in res[:len(level)]}, level)
                 res = res[len(level):]
 
+    def _two_disk_trees(self):
+        return [
+            {'device': '/sys/class/block/%s' % disk, 'name': disk,
+             'dev_type': 'disk', 'holders':
+             [{'device': '/sys/class/block/%s/%s%d' % (disk, disk, num),
+               'name': '%s%d' % (disk, num), 'holders': [],
+               'dev_type': 'partition'} for num in (1, 2)]}
+            for disk in ('vdx', 'vdy')]
+
+    @mock.patch('curtin.block.clear_holders.os.path.realpath')
+    def test_group_shutdown_plan(self, m_realpath):
+        """wipes of one level are grouped by their physical device"""
+        m_realpath.side_effect = lambda path: path
+        plan = clear_holders.plan_shutdown_holder_trees(
+            self._two_disk_trees())
+        steps = [dict((os.path.basename(key),
+                       [os.path.basename(d['device']) for d in devs])
+                      for key, devs in step.items())
+                 for step in clear_holders.group_shutdown_plan(plan)]
+        self.assertEqual([{'vdx': ['vdx1', 'vdx2'], 'vdy': ['vdy1', 'vdy2']},
+                          {'vdx': ['vdx'], 'vdy': ['vdy']}], steps)
+
+        # stacked devices are shut down one at a time before the wipes
+        plan = clear_holders.plan_shutdown_holder_trees(
+            self.example_holders_trees[0])
+        steps = [[os.path.basename(d['device'])
+                  for devs in step.values() for d in devs]
+                 for step in clear_holders.group_shutdown_plan(plan)]
+        self.assertEqual([['dm-3'], ['dm-1'], ['dm-2'], ['dm-0'],
+                          ['sda1', 'sda2', 'sda5'], ['sda']], steps)
+
+    def _patch_wipe(self, wipe):
+        basepath = 'curtin.block.clear_holders.'
+        dev_types = {'disk': {'shutdown': wipe},
+                     'partition': {'shutdown': wipe}}
+        self.add_patch(basepath + 'DEV_TYPES', 'm_dev_types', new=dev_types,
+                       autospec=False)
+        self.add_patch(basepath + 'DATA_DESTROYING_HANDLERS', 'm_destroying',
+                       new=[wipe], autospec=False)
+        self.add_patch(basepath + 'gen_holders_tree', 'm_gen_holders_tree')
+        self.m_gen_holders_tree.side_effect = self._two_disk_trees()
+        self.add_patch(basepath + 'os.path.realpath', 'm_realpath')
+        self.m_realpath.side_effect = lambda path: path
+        self.add_patch(basepath + 'os.path.exists', 'm_exists')
+        self.m_exists.return_value = True
+
+    def test_clear_holders_wipes_devices_concurrently(self):
+        """clear_holders wipes different physical devices at once"""
+        barrier = threading.Barrier(2, timeout=10)
+        wiped = []
+
+        def wipe(device):
+            # fails with BrokenBarrierError unless both disks wipe at once
+            barrier.wait()
+            wiped.append(os.path.basename(device))
+
+        self._patch_wipe(wipe)
+        clear_holders.clear_holders(['/dev/vdx', '/dev/vdy'], jobs=2)
+        self.assertEqual(['vdx', 'vdy'], sorted(wiped[-2:]))
+        # partitions of a disk are wiped in plan order before the disk
+        self.assertEqual(['vdx1', 'vdx2'],
+                         [dev for dev in wiped[:4] if dev.startswith('vdx')])
+
+    def test_clear_holders_jobs_one_wipes_in_plan_order(self):
+        wiped = []
+        self._patch_wipe(lambda device: wiped.append(
+            os.path.basename(device)))
+        clear_holders.clear_holders(['/dev/vdx', '/dev/vdy'], jobs=1)
+        self.assertEqual(['vdx1', 'vdx2', 'vdy1', 'vdy2', 'vdx', 'vdy'],
+                         wiped)
+
+    def test_clear_holders_wipe_error_stops_before_next_step(self):
+        """a failed wipe is raised and the next step does not run"""
+        wiped = []
+
+        def wipe(device):
+            if device.endswith('vdy1'):
+                raise OSError('wipe failed')
+            wiped.append(os.path.basename(device))
+
+        self._patch_wipe(wipe)
+        with self.assertRaises(OSError):
+            clear_holders.clear_holders(['/dev/vdx', '/dev/vdy'], jobs=2)
+        self.assertNotIn('vdx', wiped)
+        self.assertNotIn('vdy2', wiped)
+
     def test_format_holders_tree(self):
         """test output of clear_holders.format_holders_tree"""
         test_trees_and_results = [
@@ -3,13 +3,14 @@
 from argparse import Namespace
 from collections import OrderedDict
 import copy
-from mock import patch, call
+from mock import patch, call, ANY
 import os
 import random
 
-from curtin.block import dasd
+from curtin.block import bcache, dasd
 from curtin.commands import block_meta
 from curtin import paths, util
+from curtin.storage_config import StorageConfig
 from .helpers import CiTestCase
 
 
@@ -23,6 +24,7 @@ class TestGetPathToStorageVolume(CiTestCase):
         self.add_patch(basepath + 'devsync', 'm_devsync')
         self.add_patch(basepath + 'util.subp', 'm_subp')
         self.add_patch(basepath + 'multipath.is_mpath_member', 'm_mp')
+        self.add_patch(basepath + 'udevadm_settle', 'm_uset')
 
     def test_block_lookup_called_with_disk_wwn(self):
         volume = 'mydisk'
@@ -106,6 +108,66 @@ class TestGetPathToStorageVolume(CiTestCase):
         self.assertEqual(expected_calls, self.m_lookup.call_args_list)
         self.m_exists.assert_has_calls([call(path)])
 
+    def _partition_config(self):
+        self.m_lookup.return_value = '/dev/sda'
+        self.add_patch('curtin.commands.block_meta.block.kname_to_path',
+                       'm_kname_to_path')
+        self.m_kname_to_path.side_effect = lambda kname: '/dev/' + kname
+        return StorageConfig(
+            (item['id'], item) for item in [
+                {'id': 'sda', 'type': 'disk', 'serial': 'disk-a'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                 'number': 1},
+                {'id': 'sda1_fmt', 'type': 'format', 'volume': 'sda1'},
+                {'id': 'sdb', 'type': 'disk', 'path': '/dev/sdb'},
+            ])
+
+    def test_storage_config_caches_synced_paths(self):
+        """Each volume of a StorageConfig is synced once."""
+        s_cfg = self._partition_config()
+        for _ in range(3):
+            self.assertEqual(
+                '/dev/sda1',
+                block_meta.get_path_to_storage_volume('sda1', s_cfg))
+        self.assertEqual(1, self.m_lookup.call_count)
+        self.assertEqual([call('/dev/sda'), call('/dev/sda')],
+                         self.m_devsync.call_args_list)
+
+    def test_forget_volume_paths_drops_volumes_on_device(self):
+        s_cfg = self._partition_config()
+        block_meta.get_path_to_storage_volume('sda1', s_cfg)
+        block_meta.get_path_to_storage_volume('sdb', s_cfg)
+        block_meta.forget_volume_paths('sda1', s_cfg)
+        self.assertEqual({'sda': '/dev/sda', 'sdb': '/dev/sdb'},
+                         s_cfg.volume_paths)
+        block_meta.forget_volume_paths('sda', s_cfg)
+        self.assertEqual({'sdb': '/dev/sdb'}, s_cfg.volume_paths)
+
+
+class TestDevsync(CiTestCase):
+
+    def setUp(self):
+        super(TestDevsync, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.add_patch(basepath + 'udevadm_settle', 'm_settle')
+        self.add_patch(basepath + 'wait_for', 'm_wait_for')
+
+    def test_devsync_waits_for_path_only(self):
+        """ devsync waits for the path, not for the whole udev queue. """
+        self.m_wait_for.return_value = True
+        block_meta.devsync('/dev/sda')
+        self.m_subp.assert_called_with(['partprobe', '/dev/sda'],
+                                       rcs=[0, 1])
+        self.assertEqual(0, self.m_settle.call_count)
+        self.m_wait_for.assert_called_with(
+            '/dev/sda', timeout=block_meta.DEVSYNC_TIMEOUT)
+
+    def test_devsync_raises_if_path_missing(self):
+        self.m_wait_for.return_value = False
+        with self.assertRaises(OSError):
+            block_meta.devsync('/dev/sda')
+
 
 class TestBlockMetaSimple(CiTestCase):
     def setUp(self):
@@ -136,7 +198,9 @@ class TestBlockMetaSimple(CiTestCase):
         self.add_patch('curtin.util.load_command_environment',
                        'mock_load_env')
 
-    def test_write_image_to_disk(self):
+    @patch('curtin.commands.block_meta.url_helper.ResumingUrlReader')
+    @patch('curtin.commands.block_meta.ddimage.write_image')
+    def test_write_image_to_disk(self, m_write_image, m_reader):
         source = {
             'type': 'dd-xz',
             'uri': 'http://myhost/curtin-unittest-dd.xz'
@@ -147,21 +211,25 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        wget = ['sh', '-c',
-                'wget "$1" --progress=dot:mega -O - |xzcat| dd bs=4M of="$2"',
-                '--', source['uri'], devnode]
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=wget),
-                                         call(['partprobe', devnode]),
+        m_reader.assert_called_with(source['uri'])
+        m_write_image.assert_called_with(
+            m_reader.return_value.__enter__.return_value, devnode, 'dd-xz',
+            bmap=None, checksum=None)
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'settle'])])
         paths = ["curtin", "system-data/var/lib/snapd", "snaps"]
         self.mock_block_get_root_device.assert_called_with([devname],
                                                            paths=paths)
 
-    def test_write_image_to_disk_ddtgz(self):
+    @patch('curtin.commands.block_meta.ddimage.write_image')
+    def test_write_image_to_disk_local(self, m_write_image):
+        local = self.tmp_path('image')
+        util.write_file(local, 'image')
         source = {
-            'type': 'dd-tgz',
-            'uri': 'http://myhost/curtin-unittest-dd.tgz'
+            'type': 'dd-xz',
+            'uri': local,
+            'sha256': 'abcd',
         }
         devname = "fakedisk1p1"
         devnode = "/dev/" + devname
@@ -169,17 +237,36 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        wget = ['sh', '-c',
-                'wget "$1" --progress=dot:mega -O - |'
-                'tar -xOzf -| dd bs=4M of="$2"',
-                '--', source['uri'], devnode]
-        self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=wget),
-                                         call(['partprobe', devnode]),
-                                         call(['udevadm', 'settle'])])
-        paths = ["curtin", "system-data/var/lib/snapd", "snaps"]
-        self.mock_block_get_root_device.assert_called_with([devname],
-                                                           paths=paths)
+        fp = m_write_image.call_args[0][0]
+        self.assertEqual(local, fp.name)
+        checksum = m_write_image.call_args[1]['checksum']
+        self.assertEqual(('sha256', 'abcd'),
+                         (checksum.algorithm, checksum.expected))
+
+    @patch('curtin.commands.block_meta.url_helper.geturl')
+    @patch('curtin.commands.block_meta.url_helper.ResumingUrlReader')
+    @patch('curtin.commands.block_meta.ddimage.write_image')
+    def test_write_image_to_disk_bmap(self, m_write_image, m_reader,
+                                      m_geturl):
+        source = {
+            'type': 'dd-raw',
+            'uri': 'http://myhost/disk.img',
+            'bmap': 'http://myhost/disk.bmap',
+        }
+        devname = "fakedisk1p1"
+        devnode = "/dev/" + devname
+        self.mock_block_get_dev_name_entry.return_value = (devname, devnode)
+        m_geturl.return_value = (
+            b'<bmap version="2.0"><ImageSize>8192</ImageSize>'
+            b'<BlockSize>4096</BlockSize><ChecksumType>sha256</ChecksumType>'
+            b'<BlockMap><Range chksum="ab">1</Range></BlockMap></bmap>')
+
+        block_meta.write_image_to_disk(source, devname)
+
+        m_geturl.assert_called_with(source['bmap'])
+        bmap = m_write_image.call_args[1]['bmap']
+        self.assertEqual(8192, bmap.image_size)
+        self.assertEqual([(4096, 8192, 'ab')], bmap.ranges)
 
     @patch('curtin.commands.block_meta.meta_clear')
     @patch('curtin.commands.block_meta.write_image_to_disk')
@@ -201,11 +288,13 @@ class TestBlockMetaSimple(CiTestCase):
         mock_write_image.return_value = devname
 
         args = Namespace(target=self.target, devices=None, mode=None,
-                         boot_fstype=None, fstype=None, force_mode=False)
+                         boot_fstype=None, fstype=None, force_mode=False,
+                         jobs=None)
 
         block_meta.block_meta(args)
 
-        mock_write_image.assert_called_with(sources.get('unittest'), devname)
+        mock_write_image.assert_called_with(sources.get('unittest'), devname,
+                                            report_prefix='')
         self.mock_subp.assert_has_calls(
             [call(['mount', devname, self.target])])
 
@@ -219,6 +308,9 @@ class TestBlockMeta(CiTestCase):
         self.add_patch(basepath + 'get_path_to_storage_volume', 'mock_getpath')
         self.add_patch(basepath + 'make_dname', 'mock_make_dname')
         self.add_patch(basepath + 'multipath', 'm_mp')
+        self.add_patch(basepath + 'use_partition_script', 'm_use_script')
+        self.m_use_script.return_value = False
+        self.add_patch('curtin.udev.wait_for', 'm_wait_for')
         self.add_patch('curtin.util.load_command_environment',
                        'mock_load_env')
         self.add_patch('curtin.util.subp', 'mock_subp')
@@ -486,6 +578,27 @@ class TestZpoolHandler(CiTestCase):
             altroot="mytarget",
             pool_properties={'ashift': 42},
             zfs_properties={'compression': 'lz4'})
+        self.assertEqual(0, m_zfs.get_vdevs_ashift.call_count)
+
+    @patch('curtin.commands.block_meta.zfs')
+    @patch('curtin.commands.block_meta.block')
+    @patch('curtin.commands.block_meta.util')
+    @patch('curtin.commands.block_meta.get_path_to_storage_volume')
+    def test_zpool_handler_detects_ashift(self, m_getpath, m_util, m_block,
+                                          m_zfs):
+        info = {'type': 'zpool', 'id': 'pool1', 'pool': 'rpool',
+                'vdevs': ['disk1p1'], 'pool_properties': {'version': 5000}}
+        m_getpath.return_value = '/dev/nvme0n1p1'
+        m_block.disk_to_byid_path.return_value = '/dev/disk/by-id/nvme-p1'
+        m_util.load_command_environment.return_value = {'target': 'target'}
+        m_zfs.get_vdevs_ashift.return_value = 13
+        block_meta.zpool_handler(info, OrderedDict())
+        m_zfs.get_vdevs_ashift.assert_called_with(['/dev/nvme0n1p1'])
+        m_zfs.zpool_create.assert_called_with(
+            'rpool', ['/dev/disk/by-id/nvme-p1'], mountpoint=None,
+            altroot='target', pool_properties={'version': 5000, 'ashift': 13},
+            zfs_properties={})
+        self.assertEqual({'version': 5000}, info['pool_properties'])
 
 
 class TestZFSRootUpdates(CiTestCase):
@@ -1354,9 +1467,9 @@ class TestLvmVolgroupHandler(CiTestCase):
                                         self.storage_config)
 
         self.assertEqual([call(['vgcreate', '--force', '--zero=y', '--yes',
-                                'vg1'] + devices,  capture=True)],
-                         self.m_subp.call_args_list)
-        self.assertEqual(1, self.m_lvm.lvm_scan.call_count)
+                                'vg1'] + devices)],
+                         self.m_lvm.run_lvm.call_args_list)
+        self.assertEqual(1, self.m_lvm.lvm_refresh.call_count)
 
     @patch('curtin.commands.block_meta.lvm_volgroup_verify')
     def test_lvmvolgroup_preserve_existing_volume_group(self, m_verify):
@@ -1370,7 +1483,7 @@ class TestLvmVolgroupHandler(CiTestCase):
                                         self.storage_config)
 
         self.assertEqual(0, self.m_subp.call_count)
-        self.assertEqual(1, self.m_lvm.lvm_scan.call_count)
+        self.assertEqual(1, self.m_lvm.lvm_refresh.call_count)
 
     def test_lvmvolgroup_preserve_verifies_volgroup_members(self):
         """ lvm_volgroup handler preserves existing volume group. """
@@ -1386,7 +1499,7 @@ class TestLvmVolgroupHandler(CiTestCase):
         self.assertEqual([call('vg1')],
                          self.m_lvm.get_pvols_in_volgroup.call_args_list)
         self.assertEqual(0, self.m_subp.call_count)
-        self.assertEqual(1, self.m_lvm.lvm_scan.call_count)
+        self.assertEqual(1, self.m_lvm.lvm_refresh.call_count)
 
     def test_lvmvolgroup_preserve_raises_exception_wrong_pvs(self):
         """ lvm_volgroup handler preserve raises execption on wrong pv devs."""
@@ -1403,7 +1516,7 @@ class TestLvmVolgroupHandler(CiTestCase):
         self.assertEqual([call('vg1')],
                          self.m_lvm.get_pvols_in_volgroup.call_args_list)
         self.assertEqual(0, self.m_subp.call_count)
-        self.assertEqual(0, self.m_lvm.lvm_scan.call_count)
+        self.assertEqual(0, self.m_lvm.lvm_refresh.call_count)
 
 
 class TestLvmPartitionHandler(CiTestCase):
@@ -1450,7 +1563,8 @@ class TestLvmPartitionHandler(CiTestCase):
         block_meta.lvm_partition_handler(self.storage_config['lvm-part1'],
                                          self.storage_config)
 
-        call_name, call_args, call_kwargs = self.m_subp.mock_calls[0]
+        call_name, call_args, call_kwargs = (
+            self.m_lvm.run_lvm.mock_calls[0])
         # call_args is an n-tuple of arg list
         self.assertIn(expected_size_str, call_args[0])
 
@@ -1621,6 +1735,50 @@ class TestDmCryptHandler(CiTestCase):
         self.m_subp.assert_has_calls(expected_calls)
         self.assertEqual(len(util.load_file(self.crypttab).splitlines()), 1)
 
+    def test_dm_crypt_sector_size_and_perf_options(self):
+        """ verify dm_crypt formats luks2 with sector_size, opens the volume
+            with the perf flags and writes them to the crypttab. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        self.m_block.get_volume_uuid.return_value = 'myuuid'
+        info = self.storage_config['dmcrypt0']
+        info['sector_size'] = 4096
+        info['perf_no_read_workqueue'] = True
+        info['perf_no_write_workqueue'] = True
+
+        block_meta.dm_crypt_handler(info, self.storage_config)
+        expected_calls = [
+            call(['cryptsetup', '--cipher', self.cipher,
+                  '--key-size', self.keysize,
+                  '--type', 'luks2', '--sector-size', '4096',
+                  'luksFormat', volume_path, self.keyfile]),
+            call(['cryptsetup', 'open', '--type', 'luks2', volume_path,
+                  info['dm_name'], '--key-file', self.keyfile,
+                  '--perf-no_read_workqueue', '--perf-no_write_workqueue'])
+        ]
+        self.m_subp.assert_has_calls(expected_calls)
+        self.assertEqual(
+            'cryptroot UUID=myuuid none '
+            'luks,no-read-workqueue,no-write-workqueue\n',
+            util.load_file(self.crypttab))
+
+    @patch('curtin.commands.block_meta.dmcrypt.auto_cipher')
+    def test_dm_crypt_auto_cipher(self, m_auto_cipher):
+        """ verify dm_crypt formats with the cipher auto_cipher picks. """
+        volume_path = self.random_string()
+        self.m_getpath.return_value = volume_path
+        m_auto_cipher.return_value = ('serpent-xts-plain64', 512)
+        info = self.storage_config['dmcrypt0']
+        info['cipher'] = 'auto'
+        del info['keysize']
+
+        block_meta.dm_crypt_handler(info, self.storage_config)
+        m_auto_cipher.assert_called_with(None)
+        self.m_subp.assert_has_calls([
+            call(['cryptsetup', '--cipher', 'serpent-xts-plain64',
+                  '--key-size', '512',
+                  'luksFormat', volume_path, self.keyfile])])
+
     def test_dm_crypt_zkey_cryptsetup(self):
         """ verify dm_crypt zkey calls generates and run before crypt open."""
 
@@ -1905,8 +2063,70 @@ class TestRaidHandler(CiTestCase):
         self.m_getpath.side_effect = iter(devices)
         block_meta.raid_handler(self.storage_config['mddevice'],
                                 self.storage_config)
-        self.assertEqual([call(md_devname, 5, devices, [], None, '', None)],
+        self.assertEqual([call(md_devname, 5, devices, [], None, '', None,
+                               assume_clean=False, bitmap=None)],
                          self.m_mdadm.mdadm_create.call_args_list)
+        self.assertEqual(0, self.m_mdadm.md_block_until_in_sync.call_count)
+
+    def test_raid_handler_resync_full_waits_for_sync(self):
+        self.storage_config['mddevice']['resync'] = 'full'
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config)
+        self.m_mdadm.md_block_until_in_sync.assert_called_with(
+            '/dev/md0', progress=ANY)
+
+    def test_raid_handler_resync_assume_clean_zeroes_members(self):
+        """ raid_handler zeroes members not wiped with zeroes already. """
+        devices = ['/dev/sda1', '/dev/sdb1', '/dev/sdc1']
+        self.m_getpath.side_effect = iter(devices * 2)
+        self.storage_config['sda1']['wipe'] = 'zero'
+        self.storage_config['mddevice']['resync'] = 'assume-clean'
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config)
+        self.assertEqual(
+            [call('/dev/sdb1', mode='zero', exclusive=False),
+             call('/dev/sdc1', mode='zero', exclusive=False)],
+            self.m_block.wipe_volume.call_args_list)
+        self.assertEqual(
+            [call('/dev/md0', 5, devices, [], None, '', None,
+                  assume_clean=True, bitmap=None)],
+            self.m_mdadm.mdadm_create.call_args_list)
+        self.assertEqual([call(dev) for dev in devices],
+                         self.m_block.is_zeroed.call_args_list)
+
+    def test_raid_handler_assume_clean_checks_members(self):
+        """ the array is not created on members that are not zeroed. """
+        self.m_block.is_zeroed.return_value = False
+        self.storage_config['mddevice']['resync'] = 'assume-clean'
+        with self.assertRaises(RuntimeError):
+            block_meta.raid_handler(self.storage_config['mddevice'],
+                                    self.storage_config)
+        self.assertEqual(0, self.m_mdadm.mdadm_create.call_count)
+
+    def test_raid_handler_assume_clean_in_container(self):
+        raid = self.storage_config['mddevice']
+        del raid['devices']
+        raid['container'] = 'sda'
+        raid['resync'] = 'assume-clean'
+        with self.assertRaises(ValueError):
+            block_meta.raid_handler(raid, self.storage_config)
+        self.assertEqual(0, self.m_mdadm.mdadm_create.call_count)
+
+    def test_raid_handler_resync_throttle(self):
+        self.storage_config['mddevice']['resync'] = 'throttle'
+        self.storage_config['mddevice']['sync_speed_max'] = 5000
+        block_meta.raid_handler(self.storage_config['mddevice'],
+                                self.storage_config)
+        self.assertEqual('internal',
+                         self.m_mdadm.mdadm_create.call_args[1]['bitmap'])
+        self.m_mdadm.md_set_sync_speed_max.assert_called_with(
+            '/dev/md0', 5000)
+
+    def test_raid_handler_invalid_resync(self):
+        self.storage_config['mddevice']['resync'] = 'later'
+        with self.assertRaises(ValueError):
+            block_meta.raid_handler(self.storage_config['mddevice'],
+                                    self.storage_config)
 
     @patch('curtin.commands.block_meta.raid_verify')
     def test_raid_handler_preserves_existing_device(self, m_verify):
@@ -2063,6 +2283,36 @@ class TestBcacheHandler(CiTestCase):
         self.assertEqual([
             call(backing_device, caching_device, cache_mode, cset_uuid)],
                          self.m_bcache.create_backing_device.call_args_list)
+        self.assertEqual(0, self.m_bcache.set_tunables.call_count)
+
+    def test_bcache_handler_tunables(self):
+        """ bcache_handler sets tunables and writes a udev rule for them. """
+        backing_device = '/dev/vdb2'
+        self.m_getpath.side_effect = iter([backing_device, '/dev/vdc'])
+        self.m_bcache.BCACHE_TUNABLES = bcache.BCACHE_TUNABLES
+        self.m_bcache.get_bcache_kname.return_value = 'bcache0'
+        self.m_bcache.superblock_asdict.return_value = {'dev.uuid': 'uuid'}
+        self.m_block.path_to_kname.return_value = 'vdb2'
+        self.m_util.human2bytes.return_value = 0
+        scratch = self.tmp_dir()
+        self.m_util.load_command_environment.return_value = {
+            'scratch': scratch}
+        info = self.storage_config['id_bcache0']
+        info.update({'sequential_cutoff': '0', 'writeback_percent': 20})
+
+        block_meta.bcache_handler(info, self.storage_config)
+        self.m_bcache.get_bcache_kname.assert_called_with('vdb2')
+        self.m_bcache.set_tunables.assert_called_with(
+            'bcache0', {'sequential_cutoff': 0, 'writeback_percent': 20})
+        self.m_util.write_file.assert_called_with(
+            os.path.join(scratch, 'rules.d',
+                         'bcache-tuning-id_bcache0.rules'),
+            '\n'.join([
+                '# Written by curtin',
+                'SUBSYSTEM=="block", ACTION=="add|change", '
+                'ENV{CACHED_UUID}=="uuid", '
+                'ATTR{bcache/sequential_cutoff}="0", '
+                'ATTR{bcache/writeback_percent}="20"\n']))
 
 
 class TestPartitionHandler(CiTestCase):
@@ -2078,6 +2328,8 @@ class TestPartitionHandler(CiTestCase):
         self.add_patch(basepath + 'multipath', 'm_mp')
         self.add_patch(basepath + 'udevadm_settle', 'm_uset')
         self.add_patch(basepath + 'udevadm_info', 'm_uinfo')
+        self.add_patch(basepath + 'use_partition_script', 'm_use_script')
+        self.m_use_script.return_value = False
 
         self.target = "my_target"
         self.config = {
@@ -2232,6 +2484,98 @@ class TestPartitionHandler(CiTestCase):
         m_verify_fdasd.assert_has_calls([call(devpath, 1, sconfig[1])])
 
 
+class TestWritePartitionTable(CiTestCase):
+
+    def setUp(self):
+        super(TestWritePartitionTable, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.add_patch(basepath + 'util.which', 'm_which')
+        self.add_patch(basepath + 'block.rescan_block_devices', 'm_rescan')
+        self.add_patch(basepath + 'block.zero_file_at_offsets', 'm_zero')
+        self.add_patch(basepath + 'multipath.is_mpath_device', 'm_is_mpath')
+        self.add_patch(basepath + 'udevadm_settle', 'm_uset')
+        self.add_patch(basepath + '_partition_path', 'm_part_path')
+        self.m_is_mpath.return_value = False
+        self.m_part_path.side_effect = lambda disk, num: disk + str(num)
+        self.m_which.return_value = '/sbin/sfdisk'
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'msdos',
+                     'serial': 'disk-a'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'number': 1, 'size': '100M', 'flag': 'boot',
+                     'wipe': 'superblock'},
+                    {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                     'number': 2, 'size': '300M', 'flag': 'extended'},
+                    {'id': 'sda5', 'type': 'partition', 'device': 'sda',
+                     'number': 5, 'size': '100M', 'flag': 'logical'},
+                    {'id': 'sda6', 'type': 'partition', 'device': 'sda',
+                     'number': 6, 'size': '100M', 'flag': 'logical'},
+                ],
+            }
+        }
+        self.storage_config = (
+            block_meta.extract_storage_ordered_dict(self.config))
+
+    def test_layout_matches_incremental_placement(self):
+        """Partitions are placed as created one at a time: aligned, with
+        logical partitions 1M into the extended partition and apart."""
+        self.assertEqual(
+            [('sda1', 1, 2048, 204799),
+             ('sda2', 2, 206848, 618495),
+             ('sda5', 5, 208896, 204799),
+             ('sda6', 6, 415744, 204799)],
+            block_meta.calc_partition_layout('sda', self.storage_config, 512))
+
+    def test_single_sfdisk_run(self):
+        block_meta.write_partition_table('sda', self.storage_config,
+                                         '/dev/sda', 512)
+        self.m_subp.assert_called_once_with(
+            ['sfdisk', '--no-reread', '/dev/sda'], data=(
+                'label: dos\n'
+                'unit: sectors\n'
+                '\n'
+                '/dev/sda1 : start=2048, size=204800, type=83, bootable\n'
+                '/dev/sda2 : start=206848, size=618496, type=f\n'
+                '/dev/sda5 : start=208896, size=204800, type=83\n'
+                '/dev/sda6 : start=415744, size=204800, type=83\n'
+            ).encode(), capture=True)
+        self.m_zero.assert_called_once_with('/dev/sda', [2048 * 512],
+                                            exclusive=False)
+        self.m_rescan.assert_called_once_with(['/dev/sda'])
+        self.m_uset.assert_called_once_with(exists='/dev/sda6')
+
+    def test_gpt_types(self):
+        self.storage_config['sda']['ptable'] = 'gpt'
+        del self.storage_config['sda5']
+        del self.storage_config['sda6']
+        self.storage_config['sda2']['flag'] = 'swap'
+        block_meta.write_partition_table('sda', self.storage_config,
+                                         '/dev/sda', 512)
+        script = self.m_subp.call_args[1]['data'].decode()
+        self.assertIn('label: gpt\n', script)
+        self.assertIn(
+            '/dev/sda1 : start=2048, size=204800, '
+            'type=C12A7328-F81F-11D2-BA4B-00A0C93EC93B\n', script)
+        self.assertIn(
+            '/dev/sda2 : start=206848, size=614400, '
+            'type=0657FD6D-A4AB-43C4-84E5-0933C84B4F4F\n', script)
+
+    def test_use_partition_script(self):
+        self.assertTrue(
+            block_meta.use_partition_script('sda', self.storage_config))
+        self.storage_config['sda5']['preserve'] = True
+        self.assertFalse(
+            block_meta.use_partition_script('sda', self.storage_config))
+        self.storage_config['sda5']['preserve'] = False
+        self.storage_config['sda']['ptable'] = 'vtoc'
+        self.assertFalse(
+            block_meta.use_partition_script('sda', self.storage_config))
+
+
 class TestMultipathPartitionHandler(CiTestCase):
 
     def setUp(self):
@@ -2245,6 +2589,8 @@ class TestMultipathPartitionHandler(CiTestCase):
         self.add_patch(basepath + 'multipath', 'm_mp')
         self.add_patch(basepath + 'udevadm_settle', 'm_uset')
         self.add_patch(basepath + 'udevadm_info', 'm_uinfo')
+        self.add_patch(basepath + 'use_partition_script', 'm_use_script')
+        self.m_use_script.return_value = False
 
         self.target = self.tmp_dir()
         self.config = {
@@ -2794,4 +3140,197 @@ class TestGetDevicePathsFromStorageConfig(CiTestCase):
             self.m_exists.call_args_list)
 
 
+class TestStorageItemScheduling(CiTestCase):
+
+    def setUp(self):
+        super(TestStorageItemScheduling, self).setUp()
+        self.sconfig = block_meta.extract_storage_ordered_dict({
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'gpt',
+                     'serial': 'disk-a'},
+                    {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt',
+                     'serial': 'disk-b'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'number': 1, 'size': '1G'},
+                    {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                     'number': 2, 'size': '1G'},
+                    {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+                     'number': 1, 'size': '1G'},
+                    {'id': 'sda1_fmt', 'type': 'format', 'volume': 'sda1',
+                     'fstype': 'ext4'},
+                    {'id': 'sdb1_fmt', 'type': 'format', 'volume': 'sdb1',
+                     'fstype': 'ext4'},
+                    {'id': 'sda1_mnt', 'type': 'mount', 'path': '/',
+                     'device': 'sda1_fmt'},
+                    {'id': 'sdb1_mnt', 'type': 'mount', 'path': '/srv',
+                     'device': 'sdb1_fmt'},
+                ],
+            }
+        })
+
+    def test_depends(self):
+        """Partitions of a disk are serialized, items on them wait for
+        all of them and mounts run in config order."""
+        depends = block_meta.storage_item_depends(self.sconfig)
+        self.assertEqual(set(), depends['sda'])
+        self.assertEqual({'sda'}, depends['sda1'])
+        self.assertEqual({'sda', 'sda1'}, depends['sda2'])
+        self.assertEqual({'sdb'}, depends['sdb1'])
+        self.assertEqual({'sda1', 'sda2'}, depends['sda1_fmt'])
+        self.assertEqual({'sdb1'}, depends['sdb1_fmt'])
+        self.assertEqual({'sda1_fmt'}, depends['sda1_mnt'])
+        self.assertEqual({'sdb1_fmt', 'sda1_mnt'}, depends['sdb1_mnt'])
+
+    def test_run_respects_depends(self):
+        depends = block_meta.storage_item_depends(self.sconfig)
+        order = []
+        block_meta.run_storage_handlers(self.sconfig, order.append, jobs=4)
+        self.assertEqual(sorted(self.sconfig), sorted(order))
+        for item_id, deps in depends.items():
+            for dep in deps:
+                self.assertLess(order.index(dep), order.index(item_id))
+
+    def test_single_job_runs_in_config_order(self):
+        order = []
+        block_meta.run_storage_handlers(self.sconfig, order.append, jobs=1)
+        self.assertEqual(list(self.sconfig), order)
+
+    def test_default_runs_in_config_order(self):
+        order = []
+        block_meta.run_storage_handlers(self.sconfig, order.append)
+        self.assertEqual(list(self.sconfig), order)
+
+    def test_failure_stops_scheduling(self):
+        """Nothing depending on a failed item is started and the error is
+        raised."""
+        order = []
+
+        def handle(item_id):
+            if item_id == 'sdb1':
+                raise RuntimeError('failed')
+            order.append(item_id)
+
+        with self.assertRaises(RuntimeError):
+            block_meta.run_storage_handlers(self.sconfig, handle, jobs=4)
+        self.assertNotIn('sdb1_fmt', order)
+        self.assertNotIn('sdb1_mnt', order)
+
+
+class TestZfsDatasetScheduling(CiTestCase):
+
+    def test_sibling_datasets_run_concurrently(self):
+        """Datasets wait for their parents and for the datasets mounted
+        above them, not for their siblings."""
+        sconfig = block_meta.extract_storage_ordered_dict({
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'serial': 'disk-a'},
+                    {'id': 'pool', 'type': 'zpool', 'pool': 'rpool',
+                     'vdevs': ['sda']},
+                    {'id': 'root', 'type': 'zfs', 'pool': 'pool',
+                     'volume': '/ROOT/ubuntu',
+                     'properties': {'mountpoint': '/'}},
+                    {'id': 'var', 'type': 'zfs', 'pool': 'pool',
+                     'volume': '/var', 'properties': {'mountpoint': '/var'}},
+                    {'id': 'srv', 'type': 'zfs', 'pool': 'pool',
+                     'volume': '/srv', 'properties': {'mountpoint': '/srv'}},
+                    {'id': 'varlog', 'type': 'zfs', 'pool': 'pool',
+                     'volume': '/var/log'},
+                    {'id': 'db', 'type': 'zfs', 'pool': 'pool',
+                     'volume': '/db',
+                     'properties': {'mountpoint': 'legacy'}},
+                    {'id': 'sda_mnt', 'type': 'mount', 'path': '/boot',
+                     'device': 'sda'},
+                ],
+            }
+        })
+        depends = block_meta.storage_item_depends(sconfig)
+        self.assertEqual({'pool'}, depends['root'])
+        self.assertEqual({'pool', 'root'}, depends['var'])
+        self.assertEqual({'pool', 'root'}, depends['srv'])
+        self.assertEqual({'pool', 'root', 'var', 'srv'}, depends['varlog'])
+        self.assertEqual({'pool'}, depends['db'])
+        self.assertEqual({'sda', 'pool', 'root', 'var', 'srv', 'varlog',
+                          'db'}, depends['sda_mnt'])
+
+
+class TestFormatHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestFormatHandler, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath')
+        self.add_patch(basepath + 'mkfs.mkfs_from_config', 'm_mkfs')
+        self.add_patch(basepath + 'udevadm_settle', 'm_settle')
+        self.m_getpath.return_value = '/dev/sda1'
+        self.m_mkfs.return_value = None
+        self.fmt = {'id': 'sda1_fmt', 'type': 'format', 'fstype': 'ext4',
+                    'volume': 'sda1', 'fast': True}
+
+    def _config(self, wipe):
+        part = {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                'number': 1, 'size': '1G'}
+        if wipe:
+            part['wipe'] = wipe
+        return OrderedDict([('sda1', part), ('sda1_fmt', self.fmt)])
+
+    def test_zero_wiped_volume_is_not_discarded(self):
+        block_meta.format_handler(self.fmt, self._config('zero'))
+        self.m_mkfs.assert_called_with('/dev/sda1', self.fmt, nodiscard=True)
+
+    def test_waits_for_uuid_link(self):
+        """ format waits for the by-uuid link of the new filesystem. """
+        self.m_mkfs.return_value = 'fs-uuid'
+        block_meta.format_handler(self.fmt, self._config(None))
+        self.m_settle.assert_called_with(exists='/dev/disk/by-uuid/fs-uuid')
+
+    def test_other_volumes_are_discarded(self):
+        for wipe in (None, 'superblock'):
+            block_meta.format_handler(self.fmt, self._config(wipe))
+            self.m_mkfs.assert_called_with('/dev/sda1', self.fmt,
+                                           nodiscard=False)
+
+    def _stack_config(self, disk_wipe='zero', **lv):
+        """ an lv on a raid1 of a partition on each of two disks. """
+        items = [{'id': 'sda', 'type': 'disk', 'wipe': disk_wipe},
+                 {'id': 'sdb', 'type': 'disk', 'wipe': 'zero'},
+                 {'id': 'sda1', 'type': 'partition', 'device': 'sda'},
+                 {'id': 'sdb1', 'type': 'partition', 'device': 'sdb'},
+                 {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+                  'devices': ['sda1', 'sdb1']},
+                 {'id': 'vg0', 'type': 'lvm_volgroup', 'devices': ['md0']},
+                 dict({'id': 'lv0', 'type': 'lvm_partition',
+                       'volgroup': 'vg0'}, **lv)]
+        self.fmt['volume'] = 'lv0'
+        return OrderedDict((item['id'], item) for item in items)
+
+    def test_volume_on_zeroed_devices_is_not_discarded(self):
+        """ the wipe of the devices underneath the volume counts too. """
+        block_meta.format_handler(self.fmt, self._stack_config())
+        self.m_mkfs.assert_called_with('/dev/sda1', self.fmt, nodiscard=True)
+
+    def test_volume_on_partly_zeroed_devices_is_discarded(self):
+        for s_cfg in (self._stack_config(disk_wipe='superblock'),
+                      self._stack_config(wipe='random'),
+                      self._stack_config(preserve=True)):
+            block_meta.format_handler(self.fmt, s_cfg)
+            self.m_mkfs.assert_called_with('/dev/sda1', self.fmt,
+                                           nodiscard=False)
+
+    def test_volume_zeroed_stops_at_dm_crypt(self):
+        s_cfg = self._config(None)
+        s_cfg['sda'] = {'id': 'sda', 'type': 'disk', 'wipe': 'zero'}
+        self.assertTrue(block_meta.volume_zeroed('sda1', s_cfg))
+        s_cfg['crypt0'] = {'id': 'crypt0', 'type': 'dm_crypt',
+                           'volume': 'sda1'}
+        self.assertFalse(block_meta.volume_zeroed('crypt0', s_cfg))
+
+    def test_assume_clean_raid_is_zeroed(self):
+        s_cfg = self._stack_config(disk_wipe='superblock')
+        s_cfg['md0']['resync'] = 'assume-clean'
+        self.assertTrue(block_meta.volume_zeroed('lv0', s_cfg))
+
 # vi: ts=4 expandtab syntax=python
@@ -1,18 +1,26 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
+import hashlib
+import mock
 import os
+import threading
+import time
 
 from .helpers import CiTestCase
 
 from curtin import util
-from curtin.commands.extract import (extract_root_fsimage_url,
+from curtin.checksum import Checksum, ChecksumError
+from curtin.commands.extract import (copy_to_target,
+                                     extract_root_fsimage_url,
                                      extract_root_layered_fsimage_url,
+                                     extract_root_tgz_url,
                                      _get_image_stack)
+from curtin.image_cache import ImageCache
 from curtin.url_helper import UrlError
 
 
 class TestExtractRootFsImageUrl(CiTestCase):
     """Test extract_root_fsimage_url."""
-    def _fake_download(self, url, path, retries=0):
+    def _fake_download(self, url, path, retries=0, checksum=None):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -62,6 +70,50 @@ class TestExtractRootFsImageUrl(CiTestCase):
         self.assertEqual(1, len(self.downloads))
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    @mock.patch('curtin.image_cache.url_helper.get_headers')
+    def test_http_url_with_cache(self, m_headers):
+        """extract_root_fsimage_url reuses images from an image cache."""
+        m_headers.return_value = {'etag': '"1234"'}
+        cache = ImageCache(self.tmp_dir())
+        target = self.tmp_path("target_d")
+        myurl = "http://bogus.example.com/my.img"
+        extract_root_fsimage_url(myurl, target, cache=cache)
+        extract_root_fsimage_url(myurl, target, cache=cache)
+        self.assertEqual(2, self.m__extract_root_fsimage.call_count)
+        self.assertEqual(1, self.m_download.call_count)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # the cached image is kept
+        self.assertEqual(1, len(self.downloads))
+        self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
+        cached = self.m__extract_root_fsimage.call_args[0][0]
+        self.assertTrue(cache.is_cached(cached))
+        self.assertTrue(os.path.exists(cached))
+
+    def test_http_url_with_checksum(self):
+        """The download is verified before the image is extracted."""
+        checksum = Checksum('sha256', '00' * 32)
+        self.m_download.side_effect = ChecksumError('mismatch')
+        with self.assertRaises(ChecksumError):
+            extract_root_fsimage_url("http://bogus.example.com/my.img",
+                                     self.tmp_path("target_d"),
+                                     checksum=checksum)
+        self.assertEqual(checksum,
+                         self.m_download.call_args[1]['checksum'])
+        self.assertEqual(0, self.m__extract_root_fsimage.call_count)
+
+    def test_local_file_checksum(self):
+        """The checksum of a local image is verified before it is used."""
+        fpath = self.tmp_path("my.img")
+        util.write_file(fpath, "data")
+        target = self.tmp_path("target_d")
+        good = Checksum('sha256', hashlib.sha256(b'data').hexdigest())
+        extract_root_fsimage_url("file://" + fpath, target, checksum=good)
+        self.assertEqual(1, self.m__extract_root_fsimage.call_count)
+        with self.assertRaises(ChecksumError):
+            extract_root_fsimage_url(fpath, target,
+                                     checksum=Checksum('sha256', '00' * 32))
+        self.assertEqual(1, self.m__extract_root_fsimage.call_count)
+
     def test_file_path_not_url(self):
         """extract_root_fsimage_url supports normal file path without file:."""
         tmpd = self.tmp_dir()
@@ -75,7 +127,8 @@ class TestExtractRootFsImageUrl(CiTestCase):
 
 class TestExtractRootLayeredFsImageUrl(CiTestCase):
     """Test extract_root_layared_fsimage_url."""
-    def _fake_download(self, url, path, retries=0):
+    def _fake_download(self, url, path, retries=0, reporthook=None,
+                       checksum=None):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -124,6 +177,16 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         self.assertEqual(1, self.m__extract_root_layered_fsimage.call_count)
         self.assertEqual(0, self.m_download.call_count)
 
+    def test_local_file_checksums(self):
+        """Checksums of local layers are verified before they are used."""
+        fpath = self.tmp_path("my.img")
+        util.write_file(fpath, "data")
+        with self.assertRaises(ChecksumError):
+            extract_root_layered_fsimage_url(
+                fpath, self.tmp_path("target_d"),
+                checksums={fpath: Checksum('sha256', '00' * 32)})
+        self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
+
     def test_local_file_path_multiple(self):
         """extract_root_layered_fsimage_url supports normal hierarchy file
            path"""
@@ -210,7 +273,8 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         """extract_root_layered_fsimage_url supports normal hierarchy from
            http:// urls with one layer missing."""
 
-        def fail_download_minimal_standard(url, path, retries=0):
+        def fail_download_minimal_standard(url, path, retries=0,
+                                           reporthook=None, checksum=None):
             if url == "http://example.io/minimal.standard.squashfs":
                 raise UrlError(url, 404, "Couldn't download",
                                None, None)
@@ -221,7 +285,7 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         target = self.tmp_path("target_d", tmpd)
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         self.assertRaises(UrlError, extract_root_layered_fsimage_url,
-                          myurl, target)
+                          myurl, target, jobs=1)
         self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
         self.assertEqual(2, self.m_download.call_count)
         for i, image_url in enumerate(["minimal.squashfs",
@@ -231,11 +295,63 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         # ensure the file got cleaned up.
         self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
 
+    def test_remote_file_multiple_concurrent(self):
+        """Layers are downloaded concurrently."""
+        started = threading.Barrier(3, timeout=5)
+
+        def wait_for_all(url, path, retries=0, reporthook=None,
+                         checksum=None):
+            # fails with BrokenBarrierError unless all layers download
+            # at the same time
+            started.wait()
+            return self._fake_download(url, path, retries)
+        self.m_download.side_effect = wait_for_all
+
+        target = self.tmp_path("target_d")
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        extract_root_layered_fsimage_url(myurl, target, jobs=3)
+        self.assertEqual(1, self.m__extract_root_layered_fsimage.call_count)
+        self.assertEqual(
+            ["minimal.squashfs", "minimal.standard.squashfs",
+             "minimal.standard.debug.squashfs"],
+            [os.path.basename(f) for f in
+             self.m__extract_root_layered_fsimage.call_args[0][0]])
+        self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
+
+    def test_remote_file_failure_cancels_siblings(self):
+        """A failed layer interrupts the downloads of the other layers."""
+        started = threading.Barrier(3, timeout=5)
+        interrupted = []
+
+        def download(url, path, retries=0, reporthook=None, checksum=None):
+            started.wait()
+            if url == "http://example.io/minimal.squashfs":
+                raise UrlError(url, 404, "Couldn't download", None, None)
+            self._fake_download(url, path, retries)
+            # keep 'downloading' until cancelled
+            for _ in range(500):
+                try:
+                    reporthook(1, 1, 1)
+                except Exception as e:
+                    interrupted.append(url)
+                    raise e
+                time.sleep(0.01)
+        self.m_download.side_effect = download
+
+        target = self.tmp_path("target_d")
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        self.assertRaises(UrlError, extract_root_layered_fsimage_url,
+                          myurl, target, jobs=3)
+        self.assertEqual(2, len(interrupted))
+        self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
+        self.assertEqual([], [f for f in self.downloads if os.path.exists(f)])
+
     def test_remote_file_multiple_one_empty(self):
         """extract_root_layered_fsimage_url supports normal hierarchy from
            http:// urls with one layer empty."""
 
-        def empty_download_minimal_standard(url, path, retries=0):
+        def empty_download_minimal_standard(url, path, retries=0,
+                                            reporthook=None, checksum=None):
             if url == "http://example.io/minimal.standard.squashfs":
                 self.downloads.append(os.path.abspath(path))
                 with open(path, "w") as fp:
@@ -248,12 +364,12 @@ class TestExtractRootLayeredFsImageUrl(CiTestCase):
         target = self.tmp_path("target_d", tmpd)
         myurl = "http://example.io/minimal.standard.debug.squashfs"
         self.assertRaises(ValueError, extract_root_layered_fsimage_url,
-                          myurl, target)
+                          myurl, target, jobs=1)
         self.assertEqual(0, self.m__extract_root_layered_fsimage.call_count)
-        self.assertEqual(3, self.m_download.call_count)
+        # the empty layer is found before the next layer is downloaded
+        self.assertEqual(2, self.m_download.call_count)
         for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs",
-                                       "minimal.standard.debug.squashfs"]):
+                                       "minimal.standard.squashfs"]):
             self.assertEqual("http://example.io/" + image_url,
                              self.m_download.call_args_list[i][0][0])
         # ensure the file got cleaned up.
@@ -294,4 +410,68 @@ class TestGetImageStack(CiTestCase):
              'https://path.com/to/aa.bbb.cccc.fs'],
             _get_image_stack("https://path.com/to/aa.bbb.cccc.fs"))
 
+
+class TestExtractRootTgzUrl(CiTestCase):
+
+    def setUp(self):
+        super(TestExtractRootTgzUrl, self).setUp()
+        self.content = b'tarball content'
+        self.add_patch('curtin.commands.extract.url_helper.download',
+                       'm_download', side_effect=self._download)
+
+    def _download(self, url, path, retries=0, checksum=None):
+        util.write_file(path, self.content, omode='wb')
+        if checksum:
+            checksum.verify_file(path)
+
+    @mock.patch('curtin.commands.extract.extract_root_tgz_file')
+    def test_http_url_with_checksum_is_staged(self, m_extract_file):
+        """A remote tarball is downloaded and verified before tar runs."""
+        checksum = Checksum('sha256',
+                            hashlib.sha256(self.content).hexdigest())
+
+        def extract(path, target):
+            with open(path, 'rb') as fp:
+                self.assertEqual(self.content, fp.read())
+        m_extract_file.side_effect = extract
+        extract_root_tgz_url('http://example.com/root.tgz', 'target',
+                             checksum=checksum)
+        staged = m_extract_file.call_args[0][0]
+        self.assertEqual('target', m_extract_file.call_args[0][1])
+        self.assertFalse(os.path.exists(staged))
+
+    @mock.patch('curtin.commands.extract.extract_root_tgz_file')
+    def test_local_file_checksum(self, m_extract_file):
+        """The checksum of a local tarball is verified before tar runs."""
+        fpath = self.tmp_path('root.tgz')
+        util.write_file(fpath, self.content, omode='wb')
+        with self.assertRaises(ChecksumError):
+            extract_root_tgz_url('file://' + fpath, self.tmp_dir(),
+                                 checksum=Checksum('sha256', '00' * 32))
+        self.assertEqual(0, m_extract_file.call_count)
+        checksum = Checksum('sha256',
+                            hashlib.sha256(self.content).hexdigest())
+        extract_root_tgz_url(fpath, 'target', checksum=checksum)
+        m_extract_file.assert_called_with(fpath, 'target')
+
+    @mock.patch('curtin.commands.extract.extract_root_tgz_file')
+    def test_http_url_checksum_mismatch(self, m_extract_file):
+        """Nothing is extracted from a tarball that does not match."""
+        with self.assertRaises(ChecksumError):
+            extract_root_tgz_url('http://example.com/root.tgz',
+                                 self.tmp_dir(),
+                                 checksum=Checksum('sha256', '00' * 32))
+        self.assertEqual(0, m_extract_file.call_count)
+
+
+class TestCopyToTarget(CiTestCase):
+
+    @mock.patch('curtin.commands.extract.copytree.copy_tree')
+    def test_cp_source_uses_copy_tree(self, m_copy_tree):
+        """copy_to_target strips cp:// and copies with copytree."""
+        source = self.tmp_dir()
+        target = self.tmp_dir()
+        copy_to_target('cp://' + source, target)
+        m_copy_tree.assert_called_with(source, target)
+
 # vi: ts=4 expandtab syntax=python
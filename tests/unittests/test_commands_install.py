@@ -1,6 +1,7 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import copy
+import os
 import mock
 
 from curtin import config
@@ -191,6 +192,64 @@ class TestCmdInstall(CiTestCase):
             self.m_copy_log.call_args_list)
 
 
+class TestPrefetch(CiTestCase):
+
+    def test_get_prefetch_urls(self):
+        """Remote fsimage and layered sources are prefetched, dd sources
+        are streamed to disk instead."""
+        sources = {
+            '00': 'http://example.com/root.squashfs',
+            '01': {'type': 'fsimage-layered',
+                   'uri': 'http://example.com/base.ext.squashfs'},
+            '02': 'dd-xz:https://example.com/disk.img.xz',
+            '03': 'http://example.com/root.tar.gz',
+            '04': {'type': 'fsimage', 'uri': '/local/root.squashfs'},
+            '05': 'cp:///'}
+        self.assertEqual(
+            ['http://example.com/root.squashfs',
+             'http://example.com/base.squashfs',
+             'http://example.com/base.ext.squashfs'],
+            install.get_prefetch_urls(sources))
+
+    @mock.patch('curtin.commands.install.prefetch.Prefetcher')
+    def test_start_prefetch(self, m_prefetcher):
+        """start_prefetch stages images below the working directory."""
+        workingd = mock.Mock(scratch='/tmp/work/scratch')
+        cfg = {'sources': {'00': 'http://example.com/root.squashfs'}}
+        self.assertEqual(m_prefetcher.return_value,
+                         install.start_prefetch(cfg, workingd))
+        m_prefetcher.assert_called_with(
+            ['http://example.com/root.squashfs'],
+            '/tmp/work/scratch/prefetch', cache=None, checksums={})
+        m_prefetcher.return_value.start.assert_called_with()
+
+    @mock.patch('curtin.checksum.url_helper.geturl')
+    def test_get_prefetch_checksums(self, m_geturl):
+        """Checksums of sources are passed on for their prefetch urls."""
+        m_geturl.return_value = b'aa  base.squashfs\nbb *base.ext.squashfs\n'
+        sources = {
+            '00': {'type': 'fsimage', 'sha512': 'CC',
+                   'uri': 'http://example.com/root.squashfs'},
+            '01': {'type': 'fsimage-layered',
+                   'uri': 'http://example.com/base.ext.squashfs',
+                   'sha256sums': 'http://example.com/SHA256SUMS'},
+            '02': 'dd-xz:https://example.com/disk.img.xz'}
+        checksums = install.get_prefetch_checksums(sources)
+        self.assertEqual(
+            {'http://example.com/root.squashfs': 'sha512-cc',
+             'http://example.com/base.squashfs': 'sha256-aa',
+             'http://example.com/base.ext.squashfs': 'sha256-bb'},
+            dict((url, c.key) for url, c in checksums.items()))
+
+    @mock.patch('curtin.commands.install.prefetch.Prefetcher')
+    def test_start_prefetch_disabled(self, m_prefetcher):
+        """install/prefetch: false disables prefetching."""
+        cfg = {'install': {'prefetch': False},
+               'sources': {'00': 'http://example.com/root.squashfs'}}
+        self.assertIsNone(install.start_prefetch(cfg, mock.Mock()))
+        self.assertEqual(0, m_prefetcher.call_count)
+
+
 class TestWorkingDir(CiTestCase):
     def test_target_dir_may_exist(self):
         """WorkingDir supports existing empty target directory."""
@@ -229,3 +288,145 @@ class TestWorkingDir(CiTestCase):
             wd = install.WorkingDir({})
         self.assertEqual(1, m_mkdtemp.call_count)
         self.assertTrue(wd.target.startswith(work_d + "/"))
+
+
+class TestStage(CiTestCase):
+
+    def setUp(self):
+        super(TestStage, self).setUp()
+        self.logfile = self.tmp_path('install.log')
+        self.add_patch('curtin.commands.install.Stage._write_stdout3',
+                       'm_stdout')
+
+    def _stage(self, commands):
+        return install.Stage('test', commands, {}, logfile=self.logfile)
+
+    def test_run_writes_output_to_install_log(self):
+        """Stage.run copies command output to stdout and the install log."""
+        stage = self._stage({'10_a': ['sh', '-c', 'echo one; echo two'],
+                             '20_b': 'printf three'})
+        stage.run()
+        stage.install_log.close()
+        with open(self.logfile, 'rb') as fp:
+            self.assertEqual(b'one\ntwo\nthree', fp.read())
+        written = b''.join(c[0][1] for c in self.m_stdout.call_args_list)
+        self.assertEqual(b'one\ntwo\nthree', written)
+
+    def test_run_writes_whole_lines(self):
+        """Stage.run does not split output lines across writes."""
+        stage = self._stage({'a': ['sh', '-c', 'seq 1 20000']})
+        stage.run()
+        for call in self.m_stdout.call_args_list:
+            self.assertTrue(call[0][1].endswith(b'\n'))
+
+    def test_run_failure_raises_with_output_tail(self):
+        """A failing command raises ProcessExecutionError with output tail."""
+        stage = self._stage(
+            {'a': ['sh', '-c', 'seq 1 100000; echo lastline; exit 3']})
+        with mock.patch('curtin.commands.install.STAGE_OUTPUT_TAIL', 100):
+            with self.assertRaises(install.util.ProcessExecutionError) as cm:
+                stage.run()
+        self.assertEqual(3, cm.exception.exit_code)
+        self.assertIn('lastline', cm.exception.stdout)
+        self.assertNotIn('\n        1\n', cm.exception.stdout)
+        self.assertTrue(cm.exception.stdout.startswith('9'))
+        self.assertLessEqual(len(cm.exception.stdout), 300)
+
+    def test_run_legacy_commands_serial_unlabelled(self):
+        """Plain command entries run one at a time in sorted order."""
+        marker = self.tmp_path('marker')
+        stage = self._stage({
+            '10_a': ['sh', '-c', 'sleep 0.2; touch %s' % marker],
+            '20_b': ['sh', '-c', 'test -e %s && echo seen' % marker]})
+        stage.run()
+        stage.install_log.close()
+        with open(self.logfile, 'rb') as fp:
+            self.assertEqual(b'seen\n', fp.read())
+
+    def test_run_depends_runs_concurrently_and_labels_output(self):
+        """Entries with depends run concurrently with labelled output."""
+        fifo = self.tmp_path('fifo')
+        os.mkfifo(fifo)
+        stage = self._stage({
+            '10_reader': {'command': ['sh', '-c', 'cat %s' % fifo],
+                          'depends': []},
+            '20_writer': {'command': ['sh', '-c', 'echo hi > %s' % fifo],
+                          'depends': []},
+            '30_last': {'command': ['echo', 'done'],
+                        'depends': ['10_reader', '20_writer']}})
+        stage.run()
+        stage.install_log.close()
+        with open(self.logfile, 'rb') as fp:
+            self.assertEqual(b'[10_reader] hi\n[30_last] done\n', fp.read())
+
+    def test_run_partial_lines_are_labelled_once(self):
+        """Partial lines flushed early are not labelled twice."""
+        stage = self._stage({
+            'a': {'command': ['sh', '-c', 'printf "a"; sleep 0.7; echo b'],
+                  'depends': []}})
+        stage.run()
+        stage.install_log.close()
+        with open(self.logfile, 'rb') as fp:
+            self.assertEqual(b'[a] ab\n', fp.read())
+
+    def test_run_jobs_limits_concurrency(self):
+        """With jobs=1 independent entries still run one at a time."""
+        marker = self.tmp_path('marker')
+        commands = {
+            '10_a': {'command': ['sh', '-c', 'touch %s; sleep 0.5; rm %s' %
+                                 (marker, marker)],
+                     'depends': []},
+            '20_b': {'command': ['sh', '-c', 'sleep 0.2; test -e %s && '
+                                 'echo overlap || echo alone' % marker],
+                     'depends': []}}
+        for jobs, expected in ((1, b'[20_b] alone\n'),
+                               (2, b'[20_b] overlap\n')):
+            stage = install.Stage('test', commands, {}, logfile=self.logfile,
+                                  jobs=jobs)
+            stage.run()
+            stage.install_log.close()
+            with open(self.logfile, 'rb') as fp:
+                self.assertEqual(expected, fp.read())
+            os.unlink(self.logfile)
+
+    def test_run_failure_stops_dependents(self):
+        """A failed command prevents its dependents from starting."""
+        marker = self.tmp_path('marker')
+        stage = self._stage({
+            '10_fail': {'command': ['false'], 'depends': []},
+            '20_after': {'command': ['touch', marker],
+                         'depends': ['10_fail']}})
+        with self.assertRaises(install.util.ProcessExecutionError):
+            stage.run()
+        self.assertFalse(os.path.exists(marker))
+
+    def test_run_reports_each_command(self):
+        """Each command gets its own child ReportEventStack."""
+        stage = self._stage({'10_a': {'command': ['true'], 'depends': []},
+                             '20_b': {'command': ['false'], 'depends': []}})
+        with self.assertRaises(install.util.ProcessExecutionError):
+            stage.run()
+        children = stage.reportstack.children
+        self.assertEqual('SUCCESS', children['10_a'][0])
+        self.assertEqual('FAIL', children['20_b'][0])
+
+    def test_load_commands_unknown_dependency(self):
+        """Depending on an unknown entry raises ValueError."""
+        stage = self._stage({'a': {'command': ['true'], 'depends': ['b']}})
+        with self.assertRaises(ValueError):
+            stage.load_commands()
+
+    def test_load_commands_circular_dependency(self):
+        """Circular dependencies raise ValueError."""
+        stage = self._stage({'a': {'command': ['true'], 'depends': ['b']},
+                             'b': {'command': ['true'], 'depends': ['a']}})
+        with self.assertRaises(ValueError):
+            stage.load_commands()
+
+    def test_load_commands_skips_empty_entries(self):
+        """Empty entries are skipped, also as dependencies."""
+        stage = self._stage({'a': [], 'b': ['true'],
+                             'c': {'command': ['true'], 'depends': ['a']}})
+        commands = stage.load_commands()
+        self.assertEqual(['b', 'c'], [c.name for c in commands])
+        self.assertEqual(set(), commands[1].depends)
@@ -0,0 +1,155 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import errno
+import mock
+import os
+import stat
+
+from curtin import copytree
+from .helpers import CiTestCase, populate_dir
+
+
+class TestCopyTree(CiTestCase):
+
+    def setUp(self):
+        super(TestCopyTree, self).setUp()
+        self.source = self.tmp_dir()
+        self.target = os.path.join(self.tmp_dir(), 'target')
+
+    def test_copies_files_dirs_and_symlinks(self):
+        """copy_tree copies contents, directories and symlinks."""
+        populate_dir(self.source, {'etc/hostname': 'myhost\n',
+                                   'usr/bin/tool': b'\x00\x01binary',
+                                   'empty': ''})
+        os.symlink('../etc/hostname', os.path.join(self.source, 'usr/link'))
+        stats = copytree.copy_tree(self.source, self.target)
+        with open(os.path.join(self.target, 'etc/hostname')) as fp:
+            self.assertEqual('myhost\n', fp.read())
+        with open(os.path.join(self.target, 'usr/bin/tool'), 'rb') as fp:
+            self.assertEqual(b'\x00\x01binary', fp.read())
+        self.assertEqual(0, os.path.getsize(os.path.join(self.target,
+                                                         'empty')))
+        self.assertEqual('../etc/hostname',
+                         os.readlink(os.path.join(self.target, 'usr/link')))
+        self.assertEqual(4, stats.files)
+        self.assertEqual(len('myhost\n') + len(b'\x00\x01binary'),
+                         stats.bytes)
+
+    def test_preserves_mode_owner_and_mtime(self):
+        """copy_tree preserves permissions, ownership and times."""
+        populate_dir(self.source, {'bin/su': 'su'})
+        path = os.path.join(self.source, 'bin/su')
+        os.chmod(path, 0o4755)
+        os.utime(path, (1000000, 2000000))
+        os.chmod(os.path.join(self.source, 'bin'), 0o751)
+        os.utime(os.path.join(self.source, 'bin'), (1000000, 3000000))
+        with mock.patch('curtin.copytree.os.chown') as m_chown:
+            copytree.copy_tree(self.source, self.target)
+        dst = os.path.join(self.target, 'bin/su')
+        st = os.stat(path)
+        m_chown.assert_any_call(dst, st.st_uid, st.st_gid,
+                                follow_symlinks=False)
+        self.assertEqual(0o4755, stat.S_IMODE(os.stat(dst).st_mode))
+        self.assertEqual(2000000, os.stat(dst).st_mtime)
+        bindir = os.path.join(self.target, 'bin')
+        self.assertEqual(0o751, stat.S_IMODE(os.stat(bindir).st_mode))
+        self.assertEqual(3000000, os.stat(bindir).st_mtime)
+
+    def test_copies_into_populated_target(self):
+        """Existing directories are reused and existing files replaced."""
+        populate_dir(self.source, {'boot/efi/EFI/ubuntu/grubx64.efi': 'new',
+                                   'etc/hostname': 'myhost\n',
+                                   'etc/link': 'was a file'})
+        os.chmod(os.path.join(self.source, 'boot/efi'), 0o755)
+        populate_dir(self.target, {'boot/efi/EFI/ubuntu/grubx64.efi': 'old',
+                                   'boot/efi/other': 'kept',
+                                   'etc/hostname': 'a longer old hostname'})
+        os.chmod(os.path.join(self.target, 'boot/efi'), 0o700)
+        os.symlink('hostname', os.path.join(self.target, 'etc/link'))
+        copytree.copy_tree(self.source, self.target)
+        with open(os.path.join(self.target,
+                               'boot/efi/EFI/ubuntu/grubx64.efi')) as fp:
+            self.assertEqual('new', fp.read())
+        with open(os.path.join(self.target, 'boot/efi/other')) as fp:
+            self.assertEqual('kept', fp.read())
+        with open(os.path.join(self.target, 'etc/hostname')) as fp:
+            self.assertEqual('myhost\n', fp.read())
+        self.assertFalse(os.path.islink(os.path.join(self.target,
+                                                     'etc/link')))
+        self.assertEqual(0o755, stat.S_IMODE(
+            os.stat(os.path.join(self.target, 'boot/efi')).st_mode))
+
+    def test_copies_hardlinks_into_populated_target(self):
+        """Hardlinks replace files already in the target."""
+        populate_dir(self.source, {'a/file': 'content'})
+        os.link(os.path.join(self.source, 'a/file'),
+                os.path.join(self.source, 'linked'))
+        populate_dir(self.target, {'a/file': 'old', 'linked': 'old'})
+        copytree.copy_tree(self.source, self.target)
+        self.assertEqual(os.stat(os.path.join(self.target, 'a/file')).st_ino,
+                         os.stat(os.path.join(self.target, 'linked')).st_ino)
+
+    def test_preserves_hardlinks(self):
+        """Hardlinked files stay hardlinked in the target."""
+        populate_dir(self.source, {'a/file': 'content'})
+        os.link(os.path.join(self.source, 'a/file'),
+                os.path.join(self.source, 'linked'))
+        copytree.copy_tree(self.source, self.target)
+        self.assertEqual(os.stat(os.path.join(self.target, 'a/file')).st_ino,
+                         os.stat(os.path.join(self.target, 'linked')).st_ino)
+
+    def test_preserves_sparse_files(self):
+        """Holes and zero blocks of sparse files are not written."""
+        path = os.path.join(self.source, 'sparse')
+        size = 64 * 1024 * 1024
+        with open(path, 'wb') as fp:
+            fp.write(b'start')
+            fp.seek(size - 3)
+            fp.write(b'end')
+        if os.stat(path).st_blocks * 512 >= size:
+            self.skipTest('filesystem does not support sparse files')
+        copytree.copy_tree(self.source, self.target)
+        dst = os.path.join(self.target, 'sparse')
+        st = os.stat(dst)
+        self.assertEqual(size, st.st_size)
+        self.assertLess(st.st_blocks * 512, size // 2)
+        with open(dst, 'rb') as fp:
+            self.assertEqual(b'start', fp.read(5))
+            fp.seek(size - 3)
+            self.assertEqual(b'end', fp.read())
+
+    def test_copies_xattrs(self):
+        """Extended attributes are copied."""
+        populate_dir(self.source, {'file': 'x'})
+        path = os.path.join(self.source, 'file')
+        try:
+            os.setxattr(path, 'user.curtin', b'value')
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTSUP):
+                self.skipTest('filesystem does not support xattrs')
+            raise
+        copytree.copy_tree(self.source, self.target)
+        self.assertEqual(b'value', os.getxattr(
+            os.path.join(self.target, 'file'), 'user.curtin'))
+
+    def test_copy_range_falls_back_to_read_write(self):
+        """Copies still work when copy_file_range and sendfile fail."""
+        populate_dir(self.source, {'file': 'x' * 100000})
+        exdev = OSError(errno.EXDEV, 'cross device')
+        with mock.patch('curtin.copytree.os.copy_file_range',
+                        side_effect=exdev, create=True):
+            with mock.patch('curtin.copytree.os.sendfile',
+                            side_effect=exdev):
+                copytree.copy_tree(self.source, self.target)
+        with open(os.path.join(self.target, 'file')) as fp:
+            self.assertEqual('x' * 100000, fp.read())
+
+    def test_worker_errors_are_raised(self):
+        """An error copying a file is raised from copy_tree."""
+        populate_dir(self.source, {'file': 'x'})
+        with mock.patch('curtin.copytree._copy_range',
+                        side_effect=OSError(errno.EIO, 'io error')):
+            with self.assertRaises(OSError):
+                copytree.copy_tree(self.source, self.target)
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,87 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import bz2
+import gzip
+import io
+import lzma
+import mock
+
+from curtin import decompress
+from curtin import util
+from .helpers import CiTestCase
+
+DATA = b'curtin ' * 100000
+
+
+class TestDetect(CiTestCase):
+
+    def test_detect(self):
+        for compression, data in (('gz', gzip.compress(DATA)),
+                                  ('bz2', bz2.compress(DATA)),
+                                  ('xz', lzma.compress(DATA)),
+                                  (None, DATA)):
+            found, fp = decompress.detect(io.BytesIO(data))
+            self.assertEqual(compression, found)
+            # the magic bytes read are not lost
+            self.assertEqual(data, fp.read(3) + fp.read())
+
+    def test_detect_short_stream(self):
+        found, fp = decompress.detect(io.BytesIO(b'ab'))
+        self.assertIsNone(found)
+        self.assertEqual(b'ab', fp.read())
+
+
+class TestOpenDecompressed(CiTestCase):
+
+    @mock.patch('curtin.decompress.find_decompressor', return_value=None)
+    def test_python_module_fallback(self, m_find):
+        """Without external tools the python modules are used."""
+        for compression, data in (('gz', gzip.compress(DATA)),
+                                  ('bz2', bz2.compress(DATA)),
+                                  ('xz', lzma.compress(DATA))):
+            reader = decompress.open_decompressed(io.BytesIO(data),
+                                                  'auto')
+            self.assertNotIsInstance(reader, decompress.ProcessReader)
+            self.assertEqual(DATA, reader.read())
+
+    @mock.patch('curtin.decompress.find_decompressor', return_value=None)
+    def test_zstd_needs_tool(self, m_find):
+        with self.assertRaises(ValueError):
+            decompress.open_decompressed(io.BytesIO(b''), 'zst')
+
+    @mock.patch('curtin.decompress.util.which')
+    def test_prefers_parallel_tools(self, m_which):
+        m_which.side_effect = lambda prog: prog in ('lbzip2', 'xz')
+        self.assertEqual(['lbzip2', '-dc'],
+                         decompress.find_decompressor('bz2'))
+        self.assertEqual(['xz', '-T0', '-dc'],
+                         decompress.find_decompressor('xz'))
+        self.assertIsNone(decompress.find_decompressor('gz'))
+
+    def test_external_tool(self):
+        if not util.which('gzip'):
+            self.skipTest('gzip not installed')
+        with mock.patch.dict(decompress.DECOMPRESSORS,
+                             {'gz': (['gzip', '-dc'],)}):
+            reader = decompress.open_decompressed(
+                io.BytesIO(gzip.compress(DATA)), 'gz')
+        self.assertIsInstance(reader, decompress.ProcessReader)
+        chunks = []
+        while True:
+            data = reader.read(4096)
+            if not data:
+                break
+            chunks.append(data)
+        reader.close()
+        self.assertEqual(DATA, b''.join(chunks))
+
+    def test_external_tool_failure_raises(self):
+        if not util.which('gzip'):
+            self.skipTest('gzip not installed')
+        reader = decompress.ProcessReader(io.BytesIO(b'not gzip data'),
+                                          ['gzip', '-dc'])
+        with self.assertRaises(util.ProcessExecutionError):
+            reader.read(4096)
+        reader.close()
+
+# vi: ts=4 expandtab syntax=python
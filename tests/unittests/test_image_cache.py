@@ -0,0 +1,137 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import hashlib
+import mock
+import os
+
+from curtin import image_cache
+from curtin.checksum import Checksum
+from .helpers import CiTestCase
+
+
+class TestImageCache(CiTestCase):
+
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        self.cache_dir = self.tmp_dir()
+        self.cache = image_cache.ImageCache(self.cache_dir, max_size=100)
+        self.add_patch('curtin.image_cache.url_helper.get_headers',
+                       'm_headers', return_value={'etag': '"abc"'})
+        self.downloads = []
+
+    def _download(self, url, path, retries=0, checksum=None):
+        self.downloads.append(url)
+        with open(path, 'wb') as fp:
+            fp.write(b'x' * 40)
+        if checksum:
+            checksum.reset()
+            checksum.update(b'x' * 40)
+            checksum.verify()
+
+    def test_from_config_requires_path(self):
+        """from_config returns None unless a path is configured."""
+        self.assertIsNone(image_cache.ImageCache.from_config(None))
+        self.assertIsNone(image_cache.ImageCache.from_config({}))
+        cache = image_cache.ImageCache.from_config(
+            {'path': self.cache_dir, 'max_size': '1K'})
+        self.assertEqual(1024, cache.max_size)
+
+    def test_fetch_miss_then_hit(self):
+        """A second fetch of the same url and ETag is a cache hit."""
+        url = 'http://example.com/root.squashfs'
+        first = self.cache.fetch(url, download=self._download)
+        second = self.cache.fetch(url, download=self._download)
+        self.assertEqual(first, second)
+        self.assertTrue(self.cache.is_cached(first))
+        self.assertEqual([url], self.downloads)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_changed_etag_is_a_miss(self):
+        """A new ETag for the same url downloads the image again."""
+        url = 'http://example.com/root.squashfs'
+        self.cache.fetch(url, download=self._download)
+        self.m_headers.return_value = {'etag': '"def"'}
+        self.cache.fetch(url, download=self._download)
+        self.assertEqual([url, url], self.downloads)
+
+    def test_no_validator_is_not_cached(self):
+        """Images without ETag or Last-Modified are not kept."""
+        self.m_headers.return_value = {}
+        path = self.cache.fetch('http://example.com/a',
+                                download=self._download)
+        self.assertFalse(self.cache.is_cached(path))
+        self.cache.release(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_checksum_key_and_verification(self):
+        """A source checksum keys the cache and is verified."""
+        sha = hashlib.sha256(b'x' * 40).hexdigest()
+        path = self.cache.fetch('http://example.com/a',
+                                checksum=Checksum('sha256', sha),
+                                download=self._download)
+        self.assertEqual(os.path.join(self.cache_dir, 'sha256-' + sha), path)
+        self.cache.fetch('http://other.example.com/a',
+                         checksum=Checksum('sha256', sha),
+                         download=self._download)
+        self.assertEqual(1, len(self.downloads))
+        self.assertEqual(0, self.m_headers.call_count)
+
+    def test_checksum_mismatch_raises(self):
+        """A download not matching the checksum raises and is discarded."""
+        with self.assertRaises(ValueError):
+            self.cache.fetch('http://example.com/a',
+                             checksum=Checksum('sha256', '00' * 32),
+                             download=self._download)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def _fetch_released(self, url):
+        path = self.cache.fetch(url, download=self._download)
+        self.cache.release(path)
+        return path
+
+    def test_lru_eviction(self):
+        """Least recently used images are evicted to fit max_size."""
+        first = self._fetch_released('http://example.com/1')
+        second = self._fetch_released('http://example.com/2')
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        # a hit marks the first image as recently used
+        self._fetch_released('http://example.com/1')
+        third = self._fetch_released('http://example.com/3')
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+    def test_images_in_use_are_not_evicted(self):
+        """Images fetched and not yet released survive eviction."""
+        first = self.cache.fetch('http://example.com/1',
+                                 download=self._download)
+        second = self._fetch_released('http://example.com/2')
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        third = self.cache.fetch('http://example.com/3',
+                                 download=self._download)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        # still in use once, after a second user released it
+        self.cache.fetch('http://example.com/1', download=self._download)
+        self.cache.release(first)
+        self.cache.release(third)
+        self.cache.evict(reserve=100)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(third))
+        self.cache.release(first)
+        self.cache.evict(reserve=100)
+        self.assertFalse(os.path.exists(first))
+
+    def test_file_urls_are_not_cached(self):
+        """Only remote urls get a cache key."""
+        self.assertIsNone(self.cache.key('file:///tmp/root.tgz'))
+
+    @mock.patch('curtin.image_cache.url_helper.download')
+    def test_fetch_uses_url_helper_download(self, m_download):
+        """fetch downloads with url_helper.download by default."""
+        m_download.side_effect = self._download
+        self.cache.fetch('http://example.com/a')
+        self.assertEqual(1, m_download.call_count)
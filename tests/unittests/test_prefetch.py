@@ -0,0 +1,140 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import errno
+import mock
+import os
+import threading
+
+from curtin import prefetch
+from .helpers import CiTestCase
+
+
+class TestPrefetcher(CiTestCase):
+
+    def setUp(self):
+        super(TestPrefetcher, self).setUp()
+        self.prefetch_dir = os.path.join(self.tmp_dir(), 'prefetch')
+        self.add_patch('curtin.prefetch.url_helper.download', 'm_download',
+                       side_effect=self._download)
+        self.add_patch('curtin.prefetch.url_helper.get_headers', 'm_headers',
+                       return_value={})
+        patcher = mock.patch('curtin.prefetch.PREFETCH_POLL_INTERVAL', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.release = threading.Event()
+        self.release.set()
+
+    def _download(self, url, path, retries=0, reporthook=None,
+                  checksum=None):
+        while not self.release.wait(0.01):
+            reporthook(0, 0, 0)
+        with open(path, 'w') as fp:
+            fp.write('content of %s' % url)
+
+    def _start(self, urls):
+        prefetcher = prefetch.Prefetcher(urls, self.prefetch_dir)
+        prefetcher.start()
+        self.addCleanup(prefetcher.stop)
+        return prefetcher
+
+    def test_get_prefetched_returns_downloaded_file(self):
+        """get_prefetched returns the path of a completed download."""
+        url = 'http://example.com/root.squashfs'
+        self._start([url, url])
+        path = prefetch.get_prefetched(url, self.prefetch_dir)
+        with open(path) as fp:
+            self.assertEqual('content of %s' % url, fp.read())
+        self.assertEqual(1, self.m_download.call_count)
+
+    def test_get_prefetched_waits_for_in_flight_download(self):
+        """get_prefetched waits for a download that is in progress."""
+        url = 'http://example.com/root.squashfs'
+        self.release.clear()
+        self._start([url])
+        timer = threading.Timer(0.2, self.release.set)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertIsNotNone(prefetch.get_prefetched(url, self.prefetch_dir))
+        self.assertTrue(self.release.is_set())
+
+    def test_get_prefetched_gives_up_on_stalled_download(self):
+        """A download without progress is given up on after a while."""
+        url = 'http://example.com/root.squashfs'
+        self.release.clear()
+        self.addCleanup(self.release.set)
+        self._start([url])
+        with mock.patch('curtin.prefetch.PREFETCH_STALL_TIMEOUT', 0.2):
+            with mock.patch('curtin.prefetch.PREFETCH_HEARTBEAT_INTERVAL',
+                            3600):
+                self.assertIsNone(
+                    prefetch.get_prefetched(url, self.prefetch_dir))
+
+    def test_get_prefetched_waits_for_progressing_download(self):
+        """A download that makes progress is waited for."""
+        url = 'http://example.com/root.squashfs'
+        self.release.clear()
+        self._start([url])
+        timer = threading.Timer(0.5, self.release.set)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        with mock.patch('curtin.prefetch.PREFETCH_STALL_TIMEOUT', 0.2):
+            with mock.patch('curtin.prefetch.PREFETCH_HEARTBEAT_INTERVAL',
+                            0.05):
+                self.assertIsNotNone(
+                    prefetch.get_prefetched(url, self.prefetch_dir))
+
+    def test_get_prefetched_partial_of_dead_install(self):
+        """A .partial left by an install that is gone is ignored."""
+        url = 'http://example.com/root.squashfs'
+        partial = os.path.join(self.prefetch_dir,
+                               prefetch._key(url) + '.partial')
+        os.makedirs(self.prefetch_dir)
+        with open(partial, 'w') as fp:
+            fp.write('1')
+        with mock.patch('curtin.prefetch.os.kill',
+                        side_effect=OSError(errno.ESRCH, 'No such process')):
+            self.assertIsNone(prefetch.get_prefetched(url, self.prefetch_dir))
+
+    def test_get_prefetched_unknown_url(self):
+        """Urls that were not prefetched return None."""
+        self._start(['http://example.com/a'])
+        self.assertIsNone(prefetch.get_prefetched('http://example.com/b',
+                                                  self.prefetch_dir))
+
+    def test_get_prefetched_failed_download(self):
+        """A failed prefetch returns None so callers download themselves."""
+        self.m_download.side_effect = ValueError('boom')
+        url = 'http://example.com/a'
+        self._start([url])
+        self.assertIsNone(prefetch.get_prefetched(url, self.prefetch_dir))
+
+    def test_images_too_big_are_skipped(self):
+        """Images larger than the free space are not prefetched."""
+        self.m_headers.return_value = {'content-length': str(2 ** 60)}
+        url = 'http://example.com/a'
+        self._start([url])
+        self.assertIsNone(prefetch.get_prefetched(url, self.prefetch_dir))
+        self.assertEqual(0, self.m_download.call_count)
+
+    def test_stop_interrupts_downloads(self):
+        """stop interrupts running downloads and cancels queued ones."""
+        self.release.clear()
+        urls = ['http://example.com/%d' % i for i in range(4)]
+        prefetcher = prefetch.Prefetcher(urls, self.prefetch_dir, jobs=1)
+        prefetcher.start()
+        prefetcher.stop()
+        for url in urls:
+            self.assertIsNone(prefetch.get_prefetched(url, self.prefetch_dir))
+        self.assertEqual(1, self.m_download.call_count)
+        self.assertEqual([], [f for f in os.listdir(self.prefetch_dir)
+                              if not f.endswith('.failed')])
+
+    @mock.patch('curtin.prefetch.util.load_command_environment')
+    def test_get_prefetch_dir_from_environment(self, m_env):
+        """The prefetch directory lives below WORKING_DIR."""
+        m_env.return_value = {'scratch': '/tmp/work/scratch'}
+        self.assertEqual('/tmp/work/scratch/prefetch',
+                         prefetch.get_prefetch_dir())
+        m_env.return_value = {'scratch': None}
+        self.assertIsNone(prefetch.get_prefetch_dir())
+        self.assertIsNone(prefetch.get_prefetched('http://example.com/a'))
@@ -997,4 +997,65 @@ class TestExtractStorageConfig(CiTestCase):
         self.assertEqual(expected_dict, disks[0])
 
 
+class TestStorageConfigIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestStorageConfigIndex, self).setUp()
+        self.sconfig = storage_config.StorageConfig(
+            (item['id'], item) for item in [
+                {'id': 'sda', 'type': 'disk', 'ptable': 'msdos'},
+                {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                 'size': '1G'},
+                {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                 'size': '3G', 'flag': 'extended'},
+                {'id': 'sda5', 'type': 'partition', 'device': 'sda',
+                 'size': '1G', 'flag': 'logical'},
+                {'id': 'sda6', 'type': 'partition', 'device': 'sda',
+                 'size': '1G', 'flag': 'logical'},
+                {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                {'id': 'sdb3', 'type': 'partition', 'device': 'sdb',
+                 'size': '1G', 'number': 3},
+                {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+                 'devices': ['sda5', 'sdb3']},
+            ])
+
+    def test_partition_numbers(self):
+        """Numbers come from 'number' or the position on the device."""
+        self.assertEqual(
+            [1, 2, 5, 6, 3],
+            [self.sconfig.partition_number(item_id) for item_id in
+             ('sda1', 'sda2', 'sda5', 'sda6', 'sdb3')])
+
+    def test_partitions_and_flags(self):
+        self.assertEqual(['sda1', 'sda2', 'sda5', 'sda6'],
+                         self.sconfig.partitions('sda'))
+        self.assertEqual([], self.sconfig.partitions('md0'))
+        self.assertEqual('sda2', self.sconfig.extended_partition('sda'))
+        self.assertIsNone(self.sconfig.extended_partition('sdb'))
+        self.assertEqual(2, self.sconfig.logical_partitions('sda'))
+
+    def test_previous_partition_skips_extended(self):
+        self.assertIsNone(self.sconfig.previous_partition('sda', 'sda1'))
+        self.assertEqual(1, self.sconfig.previous_partition('sda', 'sda2'))
+        self.assertEqual(1, self.sconfig.previous_partition('sda', 'sda5'))
+        self.assertEqual(5, self.sconfig.previous_partition('sda', 'sda6'))
+        self.assertEqual(6, self.sconfig.previous_partition('sda', 'new'))
+
+    def test_depends_and_dependents(self):
+        self.assertEqual(['sda5', 'sdb3'], self.sconfig.depends('md0'))
+        self.assertEqual(['md0'], self.sconfig.dependents('sdb3'))
+        self.assertEqual(['sdb3'], self.sconfig.dependents('sdb'))
+
+    def test_adding_items_rebuilds_index(self):
+        self.assertEqual(['sdb3'], self.sconfig.partitions('sdb'))
+        self.sconfig['sdb4'] = {'id': 'sdb4', 'type': 'partition',
+                                'device': 'sdb', 'size': '1G'}
+        self.assertEqual(['sdb3', 'sdb4'], self.sconfig.partitions('sdb'))
+        self.assertEqual(2, self.sconfig.partition_number('sdb4'))
+
+    def test_of_keeps_storage_config(self):
+        self.assertIs(self.sconfig,
+                      storage_config.StorageConfig.of(self.sconfig))
+
+
 # vi: ts=4 expandtab syntax=python
@@ -1,13 +1,15 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import mock
+import os
 import shlex
+import struct
 
 from curtin.udev import (
         udevadm_info,
         shlex_quote,
         )
-from curtin import util
+from curtin import udev, util
 from .helpers import CiTestCase
 
 
@@ -116,3 +118,101 @@ class TestUdevInfo(CiTestCase):
             ['udevadm', 'info', '--query=property', '--export', mypath],
             capture=True)
         self.assertEqual({'SCSI_IDENT_TARGET_VENDOR': 'clusterid=92901'}, info)
+
+
+class FakeMonitor(object):
+    """UeventMonitor creating path on the first receive."""
+
+    def __init__(self, path, create=True):
+        self.path = path
+        self.create = create
+        self.receives = 0
+        self.closed = False
+
+    def receive(self, timeout):
+        self.receives += 1
+        if self.create:
+            util.write_file(self.path, '')
+        else:
+            os.unlink(self.path)
+        return [{'ACTION': 'add'}]
+
+    def close(self):
+        self.closed = True
+
+
+class TestUeventWait(CiTestCase):
+
+    def setUp(self):
+        super(TestUeventWait, self).setUp()
+        self.add_patch('curtin.udev.UeventMonitor.open', 'm_open')
+        self.add_patch('curtin.udev.util.subp', 'm_subp')
+        self.path = self.tmp_path('dev')
+
+    def test_parse_kernel_uevent(self):
+        data = b'add@/block/sda/sda1\0ACTION=add\0DEVNAME=sda1\0'
+        self.assertEqual({'ACTION': 'add', 'DEVNAME': 'sda1'},
+                         udev.parse_uevent(data))
+
+    def test_parse_udev_uevent(self):
+        props = b'ACTION=remove\0DEVNAME=/dev/sda1\0'
+        header = b'libudev\0' + struct.pack('>I', 0xfeedcafe) + struct.pack(
+            '=IIIIIII', 40, 40, len(props), 0, 0, 0, 0)
+        self.assertEqual({'ACTION': 'remove', 'DEVNAME': '/dev/sda1'},
+                         udev.parse_uevent(header + props))
+
+    def test_wait_for_existing_path(self):
+        util.write_file(self.path, '')
+        self.assertTrue(udev.wait_for(self.path))
+        self.m_open.assert_not_called()
+
+    def test_wait_for_returns_on_event(self):
+        """wait_for checks the path again when an event arrives."""
+        monitor = FakeMonitor(self.path)
+        self.m_open.return_value = monitor
+        self.assertTrue(udev.wait_for(self.path, timeout=60))
+        self.assertEqual(1, monitor.receives)
+        self.assertTrue(monitor.closed)
+        self.m_subp.assert_not_called()
+
+    def test_wait_for_removal_returns_on_event(self):
+        util.write_file(self.path, '')
+        monitor = FakeMonitor(self.path, create=False)
+        self.m_open.return_value = monitor
+        self.assertTrue(udev.wait_for_removal(self.path, timeout=60))
+        self.assertEqual(1, monitor.receives)
+
+    @mock.patch('curtin.udev.time.sleep')
+    def test_wait_for_falls_back_to_settle(self, m_sleep):
+        """Without the uevent socket the udev queue is settled and the
+        path polled until the timeout."""
+        self.m_open.return_value = None
+        self.assertFalse(udev.wait_for(self.path, timeout=0.01))
+        self.m_subp.assert_called_with(
+            ['udevadm', 'settle', '--exit-if-exists=%s' % self.path,
+             '--timeout=0.01'])
+
+    @mock.patch('curtin.udev.wait_for')
+    def test_udevadm_settle_exists_waits_for_path(self, m_wait_for):
+        m_wait_for.return_value = True
+        udev.udevadm_settle(exists=self.path)
+        m_wait_for.assert_called_with(
+            self.path, timeout=udev.UDEV_SETTLE_EXISTS_WAIT)
+        self.m_subp.assert_not_called()
+
+    @mock.patch('curtin.udev.wait_for')
+    def test_udevadm_settle_exists_falls_back_to_settle(self, m_wait_for):
+        """A path not showing up briefly settles the queue instead of
+        waiting the whole timeout for it."""
+        m_wait_for.return_value = False
+        udev.udevadm_settle(exists=self.path, timeout=0.5)
+        m_wait_for.assert_called_with(self.path, timeout=0.5)
+        self.m_subp.assert_called_with(
+            ['udevadm', 'settle', '--exit-if-exists=%s' % self.path,
+             '--timeout=0.5'])
+
+    def test_udevadm_settle_settles_queue(self):
+        udev.udevadm_settle()
+        self.m_subp.assert_called_with(['udevadm', 'settle'])
+
+# vi: ts=4 expandtab syntax=python
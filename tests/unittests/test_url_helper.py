@@ -1,10 +1,22 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import filecmp
+import hashlib
 import json
 import mock
+import os
+import re
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
 from curtin import url_helper
+from curtin.checksum import Checksum, ChecksumError
 
 from .helpers import CiTestCase
 
@@ -78,6 +90,198 @@ class TestDownload(CiTestCase):
                         "Downloaded file differed from source file.")
 
 
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serve server.content, honouring Range requests if
+    server.ranges is set.  server.fail_after drops the connection of the
+    first ranged response longer than that many bytes after that many
+    bytes, server.fail_stream_after that of the first response without a
+    range."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        content = self.server.content
+        rng = self.headers.get('Range')
+        self.server.requests.append(rng)
+        match = re.match(r'bytes=(\d+)-(\d*)', rng or '')
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(content) - 1) + 1
+            body = content[start:end]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end - 1, len(content)))
+        else:
+            body = content
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with self.server.lock:
+            if match:
+                fail_after = self.server.fail_after
+                if fail_after and fail_after < len(body):
+                    self.server.fail_after = None
+                else:
+                    fail_after = None
+            else:
+                fail_after = self.server.fail_stream_after
+                self.server.fail_stream_after = None
+        if fail_after:
+            self.wfile.write(body[:fail_after])
+            return
+        self.wfile.write(body)
+
+
+class TestDownloadHTTP(CiTestCase):
+    """Test download against a local http server."""
+
+    def setUp(self):
+        super(TestDownloadHTTP, self).setUp()
+        self.server = _ThreadedHTTPServer(('127.0.0.1', 0), _RangeHandler)
+        self.server.content = os.urandom(1024 * 1024 + 17)
+        self.server.ranges = True
+        self.server.fail_after = None
+        self.server.fail_stream_after = None
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/image' % self.server.server_port
+        self.target = self.tmp_path('target')
+        patcher = mock.patch('curtin.url_helper.DOWNLOAD_MIN_SEGMENT',
+                             64 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _content(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_download_segmented(self):
+        """Servers accepting ranges are downloaded in segments."""
+        url_helper.download(self.url, self.target, segments=4,
+                            buflen=4096)
+        self.assertEqual(self.server.content, self._content())
+        ranges = [r for r in self.server.requests if r != 'bytes=0-0']
+        self.assertEqual(4, len(ranges))
+        self.assertIn('bytes=0-262148', ranges)
+
+    def test_download_single_stream_without_accept_ranges(self):
+        """Servers not advertising ranges are read in one stream."""
+        self.server.ranges = False
+        url_helper.download(self.url, self.target, segments=4)
+        self.assertEqual(self.server.content, self._content())
+        self.assertEqual(['bytes=0-0', None], self.server.requests)
+
+    def test_download_segment_resumes_after_failure(self):
+        """A failed segment resumes from the last byte received."""
+        self.server.fail_after = 1000
+        url_helper.download(self.url, self.target, segments=1, retries=1,
+                            retry_delay=0, buflen=100)
+        self.assertEqual(self.server.content, self._content())
+        self.assertEqual(
+            ['bytes=0-0', 'bytes=0-1048592', 'bytes=1000-1048592'],
+            self.server.requests)
+
+    def test_download_segment_failure_without_retries_raises(self):
+        """A failed segment raises UrlError when out of retries."""
+        self.server.fail_after = 1000
+        with self.assertRaises(url_helper.UrlError):
+            url_helper.download(self.url, self.target, segments=1,
+                                retry_delay=0)
+
+    @mock.patch('curtin.url_helper._download_segments')
+    def test_download_range_not_satisfied_falls_back(self, m_segments):
+        """Falls back to a single stream if a range is refused."""
+        m_segments.side_effect = url_helper.RangeNotSatisfied(self.url, 200)
+        url_helper.download(self.url, self.target)
+        self.assertEqual(self.server.content, self._content())
+        self.assertEqual(['bytes=0-0', None], self.server.requests)
+
+    @mock.patch('curtin.url_helper._download_segment')
+    def test_download_segments_are_the_only_retry(self, m_segment):
+        """A ranged download failing after the segment retries is not
+        started over."""
+        m_segment.side_effect = url_helper.UrlError('reset', code=None)
+        with self.assertRaises(url_helper.UrlError):
+            url_helper.download(self.url, self.target, segments=1,
+                                retries=3, retry_delay=0)
+        self.assertEqual(1, m_segment.call_count)
+        self.assertEqual(['bytes=0-0'], self.server.requests)
+
+    def _checksum(self, content=None):
+        if content is None:
+            content = self.server.content
+        return Checksum('sha256', hashlib.sha256(content).hexdigest(),
+                        self.url)
+
+    def test_download_segmented_verifies_checksum(self):
+        """Segments are hashed in order as they become contiguous."""
+        checksum = self._checksum()
+        url_helper.download(self.url, self.target, segments=4,
+                            buflen=4096, checksum=checksum)
+        self.assertEqual(checksum.expected, checksum.hexdigest())
+
+    def test_download_single_stream_verifies_checksum(self):
+        self.server.ranges = False
+        url_helper.download(self.url, self.target,
+                            checksum=self._checksum())
+
+    def test_download_checksum_mismatch_raises(self):
+        """A download not matching its checksum raises ChecksumError."""
+        for ranges in (True, False):
+            self.server.ranges = ranges
+            with self.assertRaises(ChecksumError):
+                url_helper.download(self.url, self.target, segments=4,
+                                    checksum=self._checksum(b'other'))
+
+    def test_download_checksum_restarts_with_retry(self):
+        """A resumed segment does not hash data twice."""
+        self.server.fail_after = 1000
+        url_helper.download(self.url, self.target, segments=1, retries=1,
+                            retry_delay=0, buflen=100,
+                            checksum=self._checksum())
+
+    def _read_stream(self, **kwargs):
+        chunks = []
+        with url_helper.ResumingUrlReader(self.url, **kwargs) as rfp:
+            while True:
+                buf = rfp.read(4096)
+                if not buf:
+                    break
+                chunks.append(buf)
+        return b''.join(chunks)
+
+    def test_resuming_reader_resumes_after_failure(self):
+        """A dropped stream resumes from the last byte read."""
+        self.server.fail_stream_after = 1000
+        self.assertEqual(self.server.content,
+                         self._read_stream(retry_delay=0))
+        self.assertEqual([None, 'bytes=1000-1048592'], self.server.requests)
+
+    def test_resuming_reader_without_retries_raises(self):
+        self.server.fail_stream_after = 1000
+        with self.assertRaises(url_helper.UrlError):
+            self._read_stream(retries=0, retry_delay=0)
+
+    def test_resuming_reader_needs_ranges_to_resume(self):
+        """A server not answering the range does not restart the read."""
+        self.server.ranges = False
+        self.server.fail_stream_after = 1000
+        with self.assertRaises(url_helper.RangeNotSatisfied):
+            self._read_stream(retry_delay=0)
+
+
 class TestGetMaasVersion(CiTestCase):
     @mock.patch('curtin.url_helper.geturl')
     def test_get_maas_version(self, mock_get_url):